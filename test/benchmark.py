@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import yaml
+
+import tuxrun.assets
+import tuxrun.yaml
+from tuxrun.decoder import decode
+from tuxrun.requests import requests_get
+
+BASE = (Path(__file__) / "..").resolve()
+
+
+###########
+# Helpers #
+###########
+def load_lines(count):
+    lines = []
+    for log in sorted((BASE / "unit" / "logs").glob("*.yaml")):
+        lines.extend(
+            line[2:] for line in log.read_text(encoding="utf-8").split("\n") if line
+        )
+    return (lines * (count // len(lines) + 1))[:count]
+
+
+def measure(name, func, lines):
+    start = time.perf_counter()
+    for line in lines:
+        func(line)
+    duration = time.perf_counter() - start
+    print(f"{name:>32}: {len(lines) / duration:12,.0f} lines/s")
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    data = b""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.data)))
+        self.end_headers()
+        view = memoryview(self.data)
+        for start in range(0, len(view), 1024 * 1024):
+            end = start + 1024 * 1024
+            self.wfile.write(view[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+##############
+# Benchmarks #
+##############
+def bench_decoder(options):
+    lines = load_lines(options.lines)
+    print(f"Decoding {len(lines)} lines")
+    for loader in ["CFullLoader", "FullLoader"]:
+        if not hasattr(yaml, loader):
+            print(f"{'yaml.' + loader:>32}: not available")
+            continue
+        measure(
+            f"yaml.{loader}",
+            lambda line: yaml.load(line, Loader=getattr(yaml, loader)),
+            lines,
+        )
+        # The decoder falls back to the yaml loader selected by tuxrun.yaml
+        tuxrun.yaml.FullLoader = getattr(yaml, loader)
+        measure(f"decoder ({loader} fallback)", decode, lines)
+
+
+def bench_download(options):
+    BlobHandler.data = os.urandom(options.size * 1024 * 1024)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BlobHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/blob"
+    print(f"Downloading {options.size} MiB from {url}")
+
+    def iter_content(path):
+        # Previous download loop
+        sha256 = hashlib.sha256()
+        response = requests_get(url, stream=True)
+        with open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=4096):
+                f.write(chunk)
+                sha256.update(chunk)
+
+    with tempfile.TemporaryDirectory() as home:
+        # Empty cache for each download
+        os.environ["XDG_CACHE_HOME"] = home
+
+        for name, func in [
+            ("iter_content(4096)", lambda i: iter_content(Path(home) / "blob")),
+            (
+                "download engine",
+                lambda i: tuxrun.assets.__download_and_cache__(f"{url}?{i}"),
+            ),
+        ]:
+            start = time.perf_counter()
+            for i in range(options.count):
+                func(i)
+            duration = time.perf_counter() - start
+            rate = options.count * options.size / duration
+            print(f"{name:>32}: {rate:12,.0f} MiB/s")
+        stats = list(tuxrun.assets.DOWNLOADS.values())[-1]
+        print(
+            f"{'last download':>32}: latency {stats['latency']}s, "
+            f"buffer {stats['buffer'] // 1024} KiB"
+        )
+    server.shutdown()
+
+
+##############
+# Entrypoint #
+##############
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmarks")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    decoder = sub.add_parser("decoder", help="LAVA log line decoder")
+    decoder.add_argument("--lines", default=100000, type=int, help="lines to decode")
+    decoder.set_defaults(func=bench_decoder)
+
+    download = sub.add_parser("download", help="assets download engine")
+    download.add_argument("--size", default=256, type=int, help="MiB to download")
+    download.add_argument("--count", default=4, type=int, help="downloads")
+    download.set_defaults(func=bench_download)
+
+    options = parser.parse_args()
+    options.func(options)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
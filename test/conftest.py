@@ -1,10 +1,14 @@
 import pytest
 
+import tuxrun.assets
+
 
 @pytest.fixture(autouse=True)
 def home(monkeypatch, tmp_path):
     home = tmp_path / "home"
     monkeypatch.setenv("HOME", str(home))
+    # The cache is looked up in XDG_CACHE_HOME first
+    monkeypatch.delenv("XDG_CACHE_HOME", raising=False)
     return home
 
 
@@ -18,3 +22,20 @@ def get(mocker, response):
     f = mocker.patch("requests.Session.get")
     f.return_value = response
     return f
+
+
+@pytest.fixture(autouse=True)
+def decompress_tools(monkeypatch):
+    # subprocess.Popen is mocked by some tests: decompress in python
+    monkeypatch.setattr("tuxrun.decompress.TOOLS", {})
+
+
+@pytest.fixture(autouse=True)
+def assets_mode(monkeypatch, get):
+    # Set by tuxrun.__main__.main()
+    monkeypatch.setattr("tuxrun.assets.OFFLINE", False)
+    monkeypatch.setattr("tuxrun.assets.MANIFEST", {})
+    monkeypatch.setattr("tuxrun.assets.USED_URLS", set())
+    yield
+    # Background revalidations have to finish while requests is mocked
+    tuxrun.assets.wait_refreshes()
@@ -22,3 +22,29 @@ def test_timeouts_parser():
 
     with pytest.raises(SystemExit):
         setup_parser().parse_args(["--timeouts", "booting=1"])
+
+
+def test_cache_size_parser():
+    assert setup_parser().parse_args([]).cache_size is None
+    assert setup_parser().parse_args(["--cache-size", "42"]).cache_size == 42
+    assert setup_parser().parse_args(["--cache-size", "2k"]).cache_size == 2048
+    assert setup_parser().parse_args(["--cache-size", "3GiB"]).cache_size == 3 << 30
+
+    with pytest.raises(SystemExit):
+        setup_parser().parse_args(["--cache-size", "3X"])
+
+
+def test_cache_stats(capsys):
+    with pytest.raises(SystemExit):
+        setup_parser().parse_args(["--cache-stats"])
+    stdout, _ = capsys.readouterr()
+    assert "Hit rate:         0.0%\n" in stdout
+
+
+def test_cache_gc(mocker, capsys):
+    cache_gc = mocker.patch("tuxrun.argparse.cache_gc", return_value=(2, 3 << 20))
+    with pytest.raises(SystemExit):
+        setup_parser().parse_args(["--cache-gc", "1G"])
+    cache_gc.assert_called_once_with(1 << 30)
+    stdout, _ = capsys.readouterr()
+    assert stdout == "Evicted 2 entries, freed 3.0 MiB\n"
@@ -1,19 +1,72 @@
+import json
+import lzma
+import os
 import subprocess
+import threading
 import time
-from hashlib import sha1
+from functools import partial
+from hashlib import sha1, sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
 import pytest
+import requests
 
-from tuxrun.assets import get_rootfs
+from tuxrun import assets
+from tuxrun.assets import (
+    Prefetch,
+    __download_and_cache__,
+    asset_digests,
+    asset_index,
+    asset_paths,
+    cache_gc,
+    cache_size,
+    cache_stats,
+    get_decompressed,
+    get_rootfs,
+    get_test_definitions,
+    load_manifest,
+    write_manifest,
+)
 from tuxrun.devices import Device
+from tuxrun.exceptions import InvalidArgument
 
-seven_hours = 7 * 60 * 60
+six_and_a_half_hours = 6.5 * 60 * 60
+eight_hours = 8 * 60 * 60
 
 
 def rewind_timestamp(filename, interval):
     past = time.time() - interval
     subprocess.check_call(["touch", "-d", f"@{past}", str(filename)])
+    index = Path(f"{filename}.json")
+    if index.exists():
+        data = json.loads(index.read_text())
+        data["checked"] = past
+        index.write_text(json.dumps(data))
+
+
+def wait_refreshes():
+    assets.wait_refreshes()
+    assert assets.REFRESHES == []
+
+
+def release_assets():
+    # As if tuxrun had exited
+    for f in assets.__IN_USE__.values():
+        f.close()
+    assets.__IN_USE__.clear()
+
+
+@pytest.fixture
+def build_response(mocker):
+    def __build_response__(data, etag=None):
+        r = mocker.MagicMock(status_code=200)
+        r.iter_content.return_value = [data]
+        etag = etag or f'"{sha1(data).hexdigest()}"'
+        r.headers = {"ETag": etag, "Content-Length": str(len(data))}
+        return r
+
+    return __build_response__
 
 
 class TestGetRootfs:
@@ -44,44 +97,78 @@ class TestGetRootfs:
         rootfs = get_rootfs(Device.select("qemu-x86_64"))
         assert Path(rootfs).read_text() == "123"
 
-    @pytest.fixture
-    def build_response(self, mocker):
-        def __build_response__(data):
-            r = mocker.MagicMock()
-            r.iter_content.return_value = [data]
-            data_hash = sha1(data).hexdigest()
-            r.headers = {"ETag": f'"{data_hash}"', "Content-Length": str(len(data))}
-            return r
-
-        return __build_response__
-
     def test_update_after_6h_if_etag_changed(self, get, build_response):
         response1 = build_response(b"123")
         response2 = build_response(b"456")
         get.side_effect = [response1, response2]
 
         rootfs = get_rootfs(Device.select("qemu-x86_64"))
-        rewind_timestamp(rootfs, seven_hours)
+        rewind_timestamp(rootfs, six_and_a_half_hours)
 
+        # Stale: used right away and refreshed in background
+        rootfs = get_rootfs(Device.select("qemu-x86_64"))
+        assert Path(rootfs).read_text() == "123"
+        wait_refreshes()
+        assert get.call_count == 2
         rootfs = get_rootfs(Device.select("qemu-x86_64"))
         assert Path(rootfs).read_text() == "456"
 
+    def test_refresh_if_stale(self, get, build_response):
+        get.side_effect = [build_response(b"123"), build_response(b"456")]
+
+        rootfs = get_rootfs(Device.select("qemu-x86_64"))
+        rewind_timestamp(rootfs, six_and_a_half_hours)
+
+        # --update-cache: revalidated right away
+        rootfs = get_rootfs(Device.select("qemu-x86_64"), refresh=True)
+        assert Path(rootfs).read_text() == "456"
+        assert assets.REFRESHES == []
+
+    def test_wait_refreshes(self, mocker):
+        release = threading.Event()
+        thread = threading.Thread(target=release.wait)
+        thread.start()
+        mocker.patch.object(assets, "REFRESHES", [thread])
+        assets.wait_refreshes(timeout=0.01)
+        assert assets.REFRESHES == [thread]
+        release.set()
+        assets.wait_refreshes()
+        assert assets.REFRESHES == []
+
+    def test_update_after_swr_if_etag_changed(self, get, build_response):
+        get.side_effect = [build_response(b"123"), build_response(b"456")]
+
+        rootfs = get_rootfs(Device.select("qemu-x86_64"))
+        rewind_timestamp(rootfs, eight_hours)
+
+        rootfs = get_rootfs(Device.select("qemu-x86_64"))
+        assert Path(rootfs).read_text() == "456"
+        assert assets.REFRESHES == []
+
     def test_uses_cache_after_6h_with_same_etag(self, response):
         rootfs = get_rootfs(Device.select("qemu-x86_64"))
-        rewind_timestamp(rootfs, seven_hours)
+        rewind_timestamp(rootfs, six_and_a_half_hours)
         response.iter_content.assert_called()
 
         response.reset_mock()
         get_rootfs(Device.select("qemu-x86_64"))
+        wait_refreshes()
         response.iter_content.assert_not_called()
 
     def test_uses_cached_version_when_download_fails(self, get, response):
         get.side_effect = [response, RuntimeError("BOOM")]
         r1 = get_rootfs(Device.select("qemu-x86_64"))
-        rewind_timestamp(r1, seven_hours)
+        rewind_timestamp(r1, six_and_a_half_hours)
         r2 = get_rootfs(Device.select("qemu-x86_64"))
         assert r1 == r2
 
+    def test_keeps_file_name(self):
+        rootfs = get_rootfs(
+            Device.select("qemu-arm64"), "https://example.com/rootfs.ext4.zst?a=b"
+        )
+        assert Path(rootfs).name == "rootfs.ext4.zst"
+        assert Path(rootfs).parent.name == "https___example.com_rootfs.ext4.zst?a=b"
+
     def test_pass_without_cache_when_download_fails(self, get, response):
         get.side_effect = RuntimeError("BOOM")
         assert (
@@ -90,6 +177,528 @@ class TestGetRootfs:
         )
 
 
+def test_prefetch(mocker):
+    progress = mocker.MagicMock()
+
+    def job(value):
+        def download(p):
+            p.progress(50)
+            p.finish()
+            return value
+
+        return download
+
+    prefetch = Prefetch({"a": job("A"), "b": job("B")}, progress)
+    prefetch.wait()
+    assert "a" in prefetch and "c" not in prefetch
+    assert prefetch.result("a") == "A"
+    assert prefetch.result("b") == "B"
+    progress.progress.assert_called()
+    progress.finish.assert_called_once()
+
+
+def test_prefetch_workers():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def job(p):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+        return "ok"
+
+    prefetch = Prefetch({str(i): job for i in range(8)}, workers=2)
+    prefetch.wait()
+    assert max(peak) <= 2
+    assert len(peak) == 8
+
+
+def test_prefetch_error(mocker):
+    def fail(p):
+        raise Exception("failure")
+
+    prefetch = Prefetch({"a": fail})
+    with pytest.raises(Exception, match="failure"):
+        prefetch.wait()
+
+
+def test_prefetch_cancel(monkeypatch, tmp_path):
+    started = threading.Event()
+    release = threading.Event()
+
+    def job(p):
+        started.set()
+        release.wait(10)
+        return str(assets.assets_dir())
+
+    prefetch = Prefetch({"a": job, "b": job}, workers=1)
+    assert started.wait(10)
+    # The jobs keep the cache of the process that started them
+    root = assets.assets_dir()
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    assert assets.assets_dir() == tmp_path / "tuxrun" / "assets"
+
+    threading.Timer(0.1, release.set).start()
+    prefetch.cancel()
+    futures = prefetch.__futures__.values()
+    assert all(f.done() for f in futures)
+    # Only one job was started
+    assert sorted(f.cancelled() for f in futures) == [False, True]
+    assert [f.result() for f in futures if not f.cancelled()] == [str(root)]
+
+
+def test_content_addressed(get, build_response):
+    get.side_effect = [
+        build_response(b"123", "etag"),
+        build_response(b"123", "etag"),
+        build_response(b"456", "etag"),
+    ]
+    a = Path(__download_and_cache__("https://example.com/a/rootfs.ext4"))
+    b = Path(__download_and_cache__("https://example.com/b/rootfs.ext4"))
+    c = Path(__download_and_cache__("https://example.com/c/rootfs.ext4"))
+    assert a.name == b.name == c.name == "rootfs.ext4"
+    assert a.stat().st_ino == b.stat().st_ino
+    assert a.stat().st_ino != c.stat().st_ino
+    assert a.read_text() == "123"
+
+    digest = sha256(b"123").hexdigest()
+    assert (a.parent.parent / "objects" / digest).exists()
+    index = asset_index("https://example.com/a/rootfs.ext4")
+    assert index.pop("last_used") <= time.time()
+    assert index.pop("checked") <= time.time()
+    assert index == {
+        "url": "https://example.com/a/rootfs.ext4",
+        "etag": "etag",
+        "last_modified": None,
+        "sha256": digest,
+        "size": 3,
+        "downloads": 1,
+    }
+    assert asset_digests(
+        {
+            "rootfs": "https://example.com/a/rootfs.ext4",
+            "modules": ["https://example.com/c/rootfs.ext4", "/"],
+            "overlays": [["https://example.com/b/rootfs.ext4", "/"]],
+            "kernel": "https://example.com/bzImage",
+        }
+    ) == {
+        "https://example.com/a/rootfs.ext4": digest,
+        "https://example.com/b/rootfs.ext4": digest,
+        "https://example.com/c/rootfs.ext4": sha256(b"456").hexdigest(),
+    }
+
+
+def test_previous_cache_layout(get, response):
+    response.iter_content.return_value = [b"new"]
+    response.headers = {"ETag": "etag"}
+    url = "https://storage.tuxboot.com/buildroot/x86_64/rootfs.ext4.zst"
+    (cache, _) = asset_paths(url)
+    cache.parent.parent.mkdir(parents=True)
+    cache.parent.write_text("old")
+    cache.parent.with_name(cache.parent.name + ".etag").write_text("etag")
+
+    assert Path(__download_and_cache__(url)).read_text() == "new"
+    assert cache.parent.is_dir()
+    assert not cache.parent.with_name(cache.parent.name + ".etag").exists()
+
+
+def test_resume_download(get, mocker):
+    url = "https://example.com/rootfs.ext4"
+
+    def fail():
+        yield b"12"
+        raise requests.ConnectionError("connection reset")
+
+    r1 = mocker.MagicMock(status_code=200, headers={"ETag": "etag"})
+    r1.iter_content.return_value = fail()
+    r2 = mocker.MagicMock(
+        status_code=206, headers={"ETag": "etag", "Content-Range": "bytes 2-3/4"}
+    )
+    r2.iter_content.return_value = [b"34"]
+    get.side_effect = [r1, r2]
+
+    path = Path(__download_and_cache__(url, sha256sum=sha256(b"1234").hexdigest()))
+    assert path.read_text() == "1234"
+    assert get.call_args[1]["headers"] == {"Range": "bytes=2-", "If-Range": "etag"}
+    assert sorted(p.name for p in path.parent.iterdir()) == [
+        ".rootfs.ext4.lock",
+        ".rootfs.ext4.use",
+        "rootfs.ext4",
+        "rootfs.ext4.json",
+    ]
+    assert asset_index(url)["sha256"] == sha256(b"1234").hexdigest()
+
+
+def test_download_failure_while_decompressing(get, mocker):
+    url = "https://example.com/rootfs.ext4.xz"
+
+    def fail():
+        yield lzma.compress(b"rootfs")[:10]
+        raise requests.ConnectionError("connection reset")
+
+    response = mocker.MagicMock(status_code=200, headers={"ETag": "etag"})
+    response.iter_content.return_value = fail()
+    get.side_effect = [response, requests.ConnectionError("connection refused")]
+    with pytest.raises(requests.ConnectionError):
+        __download_and_cache__(url, decompress=True)
+    assert list((assets.assets_dir() / "decompressed").iterdir()) == []
+
+
+def test_download_invalid_digest(get, response):
+    response.iter_content.return_value = [b"123"]
+    response.headers = {"ETag": "etag", "Content-Length": "3"}
+    url = "https://example.com/rootfs.ext4"
+    with pytest.raises(InvalidArgument):
+        __download_and_cache__(url, sha256sum=sha256(b"456").hexdigest())
+    assert asset_index(url) == {}
+    assert sorted(p.name for p in asset_paths(url)[0].parent.iterdir()) == [
+        ".rootfs.ext4.lock",
+        ".rootfs.ext4.use",
+    ]
+
+
+def test_single_flight(get, mocker):
+    url = "https://example.com/rootfs.ext4"
+    (cache, _) = asset_paths(url)
+    started = threading.Event()
+    release = threading.Event()
+
+    def iter_content(chunk_size):
+        started.set()
+        release.wait(10)
+        yield b"123"
+
+    response = mocker.MagicMock(headers={"ETag": "etag"})
+    response.iter_content.side_effect = iter_content
+    get.return_value = response
+
+    prefetch = Prefetch(
+        {
+            "a": partial(__download_and_cache__, url),
+            "b": partial(__download_and_cache__, url),
+        }
+    )
+    assert started.wait(10)
+    assert (cache.parent / ".rootfs.ext4.lock").read_text() == str(os.getpid())
+    release.set()
+    prefetch.wait()
+    assert prefetch.result("a") == prefetch.result("b") == str(cache)
+    assert get.call_count == 1
+    assert (cache.parent / ".rootfs.ext4.lock").read_text() == ""
+
+
+def test_cache_gc(get, build_response):
+    get.side_effect = [
+        build_response(b"1" * 10),
+        build_response(b"2" * 20),
+        build_response(b"1" * 10),
+    ]
+    a = Path(__download_and_cache__("https://example.com/a"))
+    b = Path(__download_and_cache__("https://example.com/b"))
+    c = Path(__download_and_cache__("https://example.com/c"))
+    __download_and_cache__("https://example.com/a")
+    assert cache_size() == 30
+    assert cache_stats() == {
+        "entries": 3,
+        "size": 30,
+        "hits": 1,
+        "downloads": 3,
+        "hit_rate": 0.25,
+        "bytes_saved": 10,
+        "bytes_downloaded": 40,
+    }
+
+    # In use by this process
+    assert cache_gc(0) == (0, 0)
+
+    release_assets()
+    # b is the least recently used
+    assert cache_gc(15) == (1, 20)
+    assert not b.exists()
+    assert a.read_text() == c.read_text() == "1" * 10
+    assert cache_size() == 10
+    # c shares its content with a
+    assert cache_gc(0) == (2, 10)
+    assert not a.exists() and not c.exists()
+    assert not list((a.parent.parent / "objects").iterdir())
+
+
+def test_decompressed(get, response):
+    data = b"\0" * (2 * 1024 * 1024) + b"rootfs" + b"\0" * 42
+    response.iter_content.return_value = [lzma.compress(data)]
+    response.headers = {"ETag": "etag"}
+    path = get_rootfs(Device.select("qemu-arm64"), "https://example.com/rootfs.ext4.xz")
+
+    decompressed = Path(get_decompressed(path))
+    assert decompressed.name == "rootfs.ext4"
+    for name in ["rootfs.ext4.gz", "rootfs.ext4.zst"]:
+        assert assets.__decompressed_path__("", name).name == "rootfs.ext4"
+    assert assets.__decompressed_path__("", "modules.tgz").name == "modules.tar"
+    assert (
+        decompressed.parent.name
+        == asset_index("https://example.com/rootfs.ext4.xz")["sha256"]
+    )
+    assert decompressed.read_bytes() == data
+    assert get_decompressed(path) == str(decompressed)
+    assert cache_size() >= len(lzma.compress(data))
+
+    # Not cached or not compressed
+    assert get_decompressed("/path/to/rootfs.ext4.xz") == "/path/to/rootfs.ext4.xz"
+    assert get_decompressed(str(decompressed)) == str(decompressed)
+
+    release_assets()
+    cache_gc(0)
+    assert not decompressed.parent.exists()
+    assert cache_size() == 0
+
+
+def test_decompressed_modified(get, response, capsys):
+    response.iter_content.return_value = [lzma.compress(b"old")]
+    response.headers = {"ETag": "etag"}
+    path = get_rootfs(Device.select("qemu-arm64"), "https://example.com/rootfs.ext4.xz")
+    digest = asset_index("https://example.com/rootfs.ext4.xz")["sha256"]
+
+    # Replaced by a revalidation before the index is updated
+    tmp = Path(path).with_name("new")
+    tmp.write_bytes(lzma.compress(b"new"))
+    os.replace(tmp, path)
+    assert get_decompressed(path) == path
+    assert "file modified" in capsys.readouterr().err
+    assert not assets.__decompressed_path__(digest, path).exists()
+
+
+def test_decompressed_while_downloading(get, response):
+    data = b"\0" * (2 * 1024 * 1024) + b"rootfs"
+    compressed = lzma.compress(data)
+    response.iter_content.return_value = [compressed[:100], compressed[100:]]
+    response.headers = {"ETag": "etag"}
+    url = "https://example.com/rootfs.ext4.xz"
+    path = Path(get_rootfs(Device.select("qemu-arm64"), url, decompress=True))
+
+    assert path.read_bytes() == data
+    assert path.parent.name == asset_index(url)["sha256"]
+    stats = assets.DECOMPRESSED[str(path)]
+    assert stats["streamed"] is True
+    assert stats["compressed"] == len(compressed)
+    assert stats["size"] == len(data)
+
+    # Already decompressed
+    del assets.DECOMPRESSED[str(path)]
+    assert get_rootfs(Device.select("qemu-arm64"), url, decompress=True) == str(path)
+    assert str(path) not in assets.DECOMPRESSED
+
+
+def test_test_definitions(response):
+    zstandard = pytest.importorskip("zstandard")
+    response.iter_content.return_value = [zstandard.compress(b"tar")]
+    response.headers = {"ETag": "etag"}
+    path = get_test_definitions()
+    assert path.startswith("file://")
+    tar = Path(path[7:])
+    assert tar.name == "2024.12.tar"
+    assert tar.parent.parent.name == "decompressed"
+    assert tar.read_bytes() == b"tar"
+    # Shared by the next jobs
+    assert get_test_definitions() == path
+
+
+def test_conditional_request(get, mocker):
+    url = "https://example.com/rootfs.ext4"
+    lm = "Wed, 21 Oct 2015 07:28:00 GMT"
+    r1 = mocker.MagicMock(status_code=200, headers={"Last-Modified": lm})
+    r1.iter_content.return_value = [b"123"]
+    r2 = mocker.MagicMock(status_code=304, headers={"Cache-Control": "max-age=60"})
+    get.side_effect = [r1, r2]
+
+    # No ETag: cached with Last-Modified
+    path = __download_and_cache__(url)
+    assert asset_index(url)["last_modified"] == lm
+    rewind_timestamp(path, eight_hours)
+
+    assert __download_and_cache__(url) == path
+    assert get.call_args[1]["headers"] == {"If-Modified-Since": lm}
+    r2.iter_content.assert_not_called()
+    index = asset_index(url)
+    assert index["ttl"] == 60
+    assert index["hits"] == 1
+    assert time.time() - index["checked"] < 60
+
+
+def test_cache_control(mocker):
+    def response(value):
+        return mocker.MagicMock(headers={"Cache-Control": value})
+
+    assert assets.__cache_control__(response("public")) == {}
+    assert assets.__cache_control__(
+        response("max-age=3600, stale-while-revalidate=60")
+    ) == {"ttl": 3600, "swr": 60}
+    assert assets.__cache_control__(response("no-cache")) == {"ttl": 0}
+
+
+def test_offline(get, response, monkeypatch):
+    response.iter_content.return_value = [b"123"]
+    url = "https://example.com/rootfs.ext4"
+    path = __download_and_cache__(url)
+    rewind_timestamp(path, eight_hours)
+
+    monkeypatch.setattr(assets, "OFFLINE", True)
+    assert __download_and_cache__(url) == path
+    assert get.call_count == 1
+    assert assets.REFRESHES == []
+    with pytest.raises(InvalidArgument, match="is not in the cache"):
+        __download_and_cache__("https://example.com/bzImage")
+    assert get.call_count == 1
+
+
+def test_manifest(get, build_response, monkeypatch, tmp_path):
+    get.side_effect = [
+        build_response(b"123"),
+        build_response(b"456"),
+        build_response(b"789"),
+    ]
+    url = "https://example.com/rootfs.ext4"
+    path = __download_and_cache__(url)
+    manifest = tmp_path / "assets.json"
+    write_manifest(manifest)
+    assert load_manifest(manifest) == {
+        url: {"sha256": sha256(b"123").hexdigest(), "size": 3, "path": path}
+    }
+
+    # Pinned: the server is not asked even when expired
+    monkeypatch.setattr(assets, "MANIFEST", load_manifest(manifest))
+    rewind_timestamp(path, eight_hours)
+    assert __download_and_cache__(url) == path
+    assert get.call_count == 1
+
+    # Same content for another url: linked from the objects store, offline
+    monkeypatch.setattr(assets, "OFFLINE", True)
+    other = "https://example.com/other/rootfs.ext4"
+    assets.MANIFEST[other] = {"sha256": sha256(b"123").hexdigest()}
+    assert Path(__download_and_cache__(other)).read_text() == "123"
+    assert asset_index(other)["hits"] == 1
+    assert get.call_count == 1
+
+    # The cached file changed: the pinned content is linked back
+    monkeypatch.setattr(assets, "OFFLINE", False)
+    monkeypatch.setattr(assets, "MANIFEST", {})
+    rewind_timestamp(path, eight_hours)
+    __download_and_cache__(url)
+    wait_refreshes()
+    assert Path(path).read_text() == "456"
+    monkeypatch.setattr(assets, "MANIFEST", load_manifest(manifest))
+    assert Path(__download_and_cache__(url)).read_text() == "123"
+    assert get.call_count == 2
+
+    # Not in the objects store: downloaded again, only if it matches
+    assets.MANIFEST[url] = {"sha256": sha256(b"abc").hexdigest()}
+    with pytest.raises(InvalidArgument, match="Invalid sha256"):
+        __download_and_cache__(url)
+    assert get.call_count == 3
+    assert Path(path).read_text() == "123"
+
+    manifest.write_text("{}")
+    with pytest.raises(InvalidArgument, match="Invalid asset manifest"):
+        load_manifest(manifest)
+    assert load_manifest(tmp_path / "missing.json") == {}
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    data = os.urandom(3 * 1024 * 1024)
+    accept_ranges = False
+    # Index of the request closed half way
+    truncate = 0
+
+    def do_GET(self):
+        with self.server.lock:
+            index = len(self.server.ranges)
+            self.server.ranges.append(self.headers.get("Range"))
+        (start, end) = (0, len(self.data))
+        if self.headers.get("Range"):
+            (first, last) = self.headers["Range"][6:].split("-")
+            (start, end) = (int(first), int(last or end - 1) + 1)
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{end - 1}/{len(self.data)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("ETag", '"etag"')
+        if self.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if index == self.truncate:
+            end = start + (end - start) // 2
+        self.wfile.write(self.data[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def range_server(get):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.lock = threading.Lock()
+    server.ranges = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    get.side_effect = lambda url, **kwargs: requests.Session().request(
+        "GET", url, **kwargs
+    )
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_engine(range_server, capsys):
+    url = f"http://127.0.0.1:{range_server.server_address[1]}/rootfs.ext4"
+    path = Path(__download_and_cache__(url))
+
+    assert path.read_bytes() == RangeHandler.data
+    assert asset_index(url)["sha256"] == sha256(RangeHandler.data).hexdigest()
+    assert range_server.ranges == [None, f"bytes={len(RangeHandler.data) // 2}-"]
+    assert "Resuming download" in capsys.readouterr().err
+    stats = assets.DOWNLOADS.pop(url)
+    assert stats["received"] == len(RangeHandler.data)
+    assert stats["attempts"] == 2
+    assert stats["throughput"] > 0
+    assert stats["latency"] <= stats["seconds"]
+    assert assets.DOWNLOAD_BUFFER_MIN <= stats["buffer"] <= assets.DOWNLOAD_BUFFER_MAX
+
+
+def test_download_ranges(range_server, monkeypatch, capsys):
+    monkeypatch.setattr(RangeHandler, "accept_ranges", True)
+    monkeypatch.setattr(RangeHandler, "truncate", 1)
+    monkeypatch.setattr(assets, "DOWNLOAD_PARALLEL_SIZE", 1024 * 1024)
+    url = f"http://127.0.0.1:{range_server.server_address[1]}/rootfs.ext4"
+    path = Path(__download_and_cache__(url))
+
+    assert path.read_bytes() == RangeHandler.data
+    assert asset_index(url)["sha256"] == sha256(RangeHandler.data).hexdigest()
+    # The first range is read from the first response, one range is resumed
+    step = len(RangeHandler.data) // 4
+    assert range_server.ranges[0] is None
+    assert len(range_server.ranges) == 5
+    assert set(range_server.ranges) > {
+        f"bytes={start}-{start + step - 1}"
+        for start in range(step, len(RangeHandler.data), step)
+    }
+    assert "Resuming range" in capsys.readouterr().err
+    stats = assets.DOWNLOADS.pop(url)
+    assert stats["connections"] == 4
+    assert stats["attempts"] == 2
+    assert stats["received"] == len(RangeHandler.data)
+
+    # Verified as a whole
+    monkeypatch.setattr(RangeHandler, "truncate", None)
+    url = url.replace("rootfs", "other")
+    with pytest.raises(InvalidArgument, match="Invalid sha256"):
+        __download_and_cache__(url, sha256sum=sha256(b"").hexdigest())
+
+
 if __name__ == "__main__":
     rootfs = get_rootfs(Device.select("qemu-x86_64"))
     print(rootfs)
@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from tuxrun.decoder import decode
+from tuxrun.yaml import yaml_load
+
+BASE = (Path(__file__) / "..").resolve()
+
+
+def test_decode_json():
+    assert decode(
+        '{"lvl": "info", "msg": "Hello, world", "dt": "2021-04-08T18:42:25.139513"}'
+    ) == {"lvl": "info", "msg": "Hello, world", "dt": "2021-04-08T18:42:25.139513"}
+
+
+def test_decode_non_specific_tag(mocker):
+    load = mocker.patch("tuxrun.decoder.yaml_load")
+    assert decode('{"msg": {"size": ! "12927667", "starttc": ! "0"}}') == {
+        "msg": {"size": 12927667, "starttc": 0}
+    }
+    load.assert_not_called()
+
+
+def test_decode_yaml_fallback():
+    assert decode("{hello: world}") == {"hello": "world"}
+    assert decode('{"a": ! "012"}') == {"a": 10}
+    assert decode('{"msg": "a: ! "}') == {"msg": "a: ! "}
+    assert decode('{"msg": "a\\": ! \\"1\\""}') == {"msg": 'a": ! "1"'}
+    assert decode("hello world") == "hello world"
+    assert decode("") is None
+    with pytest.raises(yaml.YAMLError):
+        decode("{")
+
+
+@pytest.mark.parametrize("name", ["fail-1", "fail-5", "pass-1", "pass-2"])
+def test_decode_matches_yaml(name):
+    logs = (BASE / "logs" / (name + ".yaml")).read_text(encoding="utf-8")
+    for line in logs.strip("\n").split("\n"):
+        assert decode(line[2:]) == yaml_load(line[2:])
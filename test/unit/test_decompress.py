@@ -0,0 +1,105 @@
+import gzip
+import io
+import lzma
+import shutil
+
+import pytest
+
+from tuxrun import decompress
+from tuxrun.decompress import Decompressor
+
+DATA = b"\0" * (3 * 1024 * 1024) + b"rootfs" + b"\0" * 42
+
+zstandard = pytest.importorskip("zstandard")
+
+COMPRESS = {
+    "gz": gzip.compress,
+    "xz": lzma.compress,
+    "zstd": lambda d: zstandard.ZstdCompressor().compress(d),
+}
+
+
+@pytest.fixture(params=["python", "tool"])
+def tools(request, monkeypatch):
+    if request.param == "tool":
+        monkeypatch.setattr(
+            decompress,
+            "TOOLS",
+            {
+                "gz": [["gzip", "-dc"]],
+                "xz": [["xz", "-T0", "-dc"]],
+                "zstd": [["zstd", "-dc"]],
+            },
+        )
+    return request.param
+
+
+@pytest.mark.parametrize("ext", ["gz", "xz", "zstd"])
+def test_decompressor(ext, tools, tmp_path):
+    if tools == "tool" and not decompress.tool(ext):
+        pytest.skip(f"no tool for {ext}")
+    data = COMPRESS[ext](DATA)
+    decompressor = Decompressor(ext, tmp_path / "rootfs.ext4")
+    stream = io.BytesIO(data)
+    for chunk in iter(lambda: stream.read(10), b""):
+        decompressor.write(chunk)
+    stats = decompressor.close()
+    assert (tmp_path / "rootfs.ext4").read_bytes() == DATA
+    assert stats["codec"] == (
+        "python" if tools == "python" else " ".join(decompress.tool(ext))
+    )
+    assert stats["compressed"] == len(data)
+    assert stats["size"] == len(DATA)
+    # Only the block with data is written
+    assert (tmp_path / "rootfs.ext4").stat().st_blocks * 512 < len(DATA)
+
+
+def test_decompressor_truncated(tools, tmp_path):
+    if tools == "tool" and not shutil.which("xz"):
+        pytest.skip("no xz")
+    decompressor = Decompressor("xz", tmp_path / "rootfs.ext4")
+    decompressor.write(lzma.compress(DATA)[:-10])
+    with pytest.raises(OSError):
+        decompressor.close()
+    assert not (tmp_path / "rootfs.ext4").exists()
+
+
+def test_supported():
+    assert Decompressor.supported("xz")
+    assert not Decompressor.supported(None)
+    assert not Decompressor.supported("bz2")
+    with pytest.raises(ValueError):
+        Decompressor("bz2", "/nonexistent")
+
+
+@pytest.mark.parametrize("ext", ["gz", "xz", "zstd"])
+def test_decompressor_bounded_output(ext, monkeypatch, mocker, tmp_path):
+    monkeypatch.setattr(decompress, "CHUNK", 4096)
+    output = mocker.spy(Decompressor, "__output__")
+    decompressor = Decompressor(ext, tmp_path / "rootfs.ext4")
+    decompressor.write(COMPRESS[ext](DATA))
+    decompressor.close()
+    assert (tmp_path / "rootfs.ext4").read_bytes() == DATA
+    assert max(len(c.args[1]) for c in output.call_args_list) <= 4096
+
+
+def test_decompressor_truncated_zstd(tmp_path):
+    decompressor = Decompressor("zstd", tmp_path / "rootfs.ext4")
+    decompressor.write(COMPRESS["zstd"](DATA)[:-10])
+    with pytest.raises(OSError, match="Truncated"):
+        decompressor.close()
+    assert not (tmp_path / "rootfs.ext4").exists()
+
+    decompressor = Decompressor("zstd", tmp_path / "rootfs.ext4")
+    with pytest.raises(ValueError):
+        decompressor.write(b"not zstd" * 10)
+    decompressor.abort()
+
+
+def test_decompressor_tool_failure(monkeypatch, tmp_path):
+    monkeypatch.setattr(decompress, "TOOLS", {"xz": [["false"]]})
+    decompressor = Decompressor("xz", tmp_path / "rootfs.ext4")
+    decompressor.write(b"data")
+    with pytest.raises(OSError):
+        decompressor.close()
+    assert not (tmp_path / "rootfs.ext4").exists()
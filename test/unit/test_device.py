@@ -4,6 +4,7 @@ from pathlib import Path
 
 import pytest
 
+import tuxrun.tests
 from tuxrun.__main__ import main
 from tuxrun.devices import Device
 from tuxrun.devices.fvp import FVPLAVA, FVPMorelloAndroid
@@ -2094,8 +2095,12 @@ def artefacts(tmp_path):
 )
 def test_definition(monkeypatch, mocker, tmpdir, artefacts, args, filename):
     monkeypatch.setattr("tuxrun.__main__.sys.argv", ["tuxrun"] + args)
-    mocker.patch("tuxrun.__main__.Runtime.select", side_effect=Exception)
-    mocker.patch("tuxrun.assets.__download_and_cache__", side_effect=lambda a, b: a)
+    # The runtime is prepared before rendering: stop right after the rendering
+    mocker.patch("tuxrun.__main__.Runtime.select")
+    mocker.patch("tuxrun.__main__.templates.dispatchers", side_effect=Exception)
+    mocker.patch(
+        "tuxrun.assets.__download_and_cache__", side_effect=lambda a, b, **kwargs: a
+    )
     mocker.patch(
         "tuxrun.__main__.get_test_definitions", return_value="file://testdef.tar.zst"
     )
@@ -2122,6 +2127,16 @@ def test_definition(monkeypatch, mocker, tmpdir, artefacts, args, filename):
     )
 
 
+def test_decompressed_test_definitions():
+    kunit = tuxrun.tests.Test.select("kunit")(None)
+    device = Device.select("qemu-arm64")()
+    kwargs = {"device": device, "parameters": {}}
+    data = kunit.render(test_definitions="file://testdef.tar.zst", **kwargs)
+    assert "      compression: zstd\n" in data
+    data = kunit.render(test_definitions="file://testdef.tar", **kwargs)
+    assert "compression" not in data
+
+
 def test_fvp_aemva_extra_assets(tmpdir):
     device = Device.select("fvp-aemva")()
 
@@ -0,0 +1,86 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from tuxrun.logindex import LogIndex, index_path, main
+from tuxrun.writer import Writer
+
+BASE = (Path(__file__) / "..").resolve()
+
+
+@pytest.fixture
+def logs(tmp_path):
+    yaml_file = tmp_path / "logs.yaml"
+    with Writer(None, None, None, yaml_file) as writer:
+        for line in (
+            (BASE / "logs" / "fail-1.yaml").read_text(encoding="utf-8").split("\n")
+        ):
+            if line:
+                writer.write(line[2:])
+    return yaml_file
+
+
+def test_writer_index(logs):
+    data = json.loads(index_path(logs).read_text(encoding="utf-8"))
+    assert data["lines"] == 1954
+    assert data["size"] == logs.stat().st_size
+    assert len(data["offsets"]) == len(data["dt"]) == (1954 + 63) // 64
+    assert len(data["results"]) == 67
+
+
+def test_writer_index_compressed(tmp_path):
+    with Writer(None, None, None, tmp_path / "logs.yaml.gz") as writer:
+        writer.write('{"lvl": "info", "msg": "Hello", "dt": "2021-04-08T18:42:25"}')
+    assert not index_path(tmp_path / "logs.yaml.gz").exists()
+
+
+def test_read(logs):
+    lines = logs.read_text(encoding="utf-8").split("\n")
+    index = LogIndex.load(logs)
+    assert list(index.read(0, 3)) == [line[2:] for line in lines[0:3]]
+    assert list(index.read(130, 200)) == [line[2:] for line in lines[130:200]]
+    assert list(index.read(1950)) == [line[2:] for line in lines[1950:1954]]
+    assert list(index.read(2000)) == []
+
+
+def test_find(logs):
+    lines = logs.read_text(encoding="utf-8").split("\n")
+    index = LogIndex.load(logs)
+    assert index.find("") == 0
+    dt = json.loads(lines[1000][2:])["dt"]
+    assert lines[index.find(dt)] == lines[1000]
+    assert index.find("9999") == 1954
+
+
+def test_case(logs):
+    index = LogIndex.load(logs)
+    (start, end) = index.case("lava", "validate")
+    lines = list(index.read(start, end))
+    assert start == 0
+    assert '"case": "validate"' in lines[-1]
+    (start, end) = index.case("lava", "job")
+    assert '"case": "job"' in list(index.read(start, end))[-1]
+    with pytest.raises(KeyError):
+        index.case("lava", "unknown")
+
+
+def test_build(logs):
+    data = index_path(logs).read_text(encoding="utf-8")
+    index_path(logs).unlink()
+    LogIndex.load(logs)
+    assert index_path(logs).read_text(encoding="utf-8") == data
+
+
+def test_main(logs, capsys):
+    assert main([str(logs), "--lines", "10:12"]) == 0
+    lines = logs.read_text(encoding="utf-8").split("\n")
+    assert capsys.readouterr().out == "\n".join(lines[10:12]) + "\n"
+
+    assert main([str(logs), "--case", "lava/validate", "--rebuild"]) == 0
+    assert capsys.readouterr().out.endswith(
+        '"msg": {"case": "validate", "definition": "lava", "result": "pass"}}\n'
+    )
+
+    with pytest.raises(SystemExit):
+        main([str(logs), "--case", "lava/unknown"])
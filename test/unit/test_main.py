@@ -1,5 +1,6 @@
 import json
 import os
+import re
 
 import pytest
 import yaml
@@ -290,6 +291,10 @@ FVP_MORELLO_ARGS = [
             "kselftest",
         ],
         ["--device", "qemu-arm64", "--tests", "ltp-smoke", "ltp-smoke"],
+        ["--device", "qemu-arm64", "--log-queue-size", "0"],
+        ["--device", "qemu-arm64", "--log-queue-size", "-1"],
+        ["--device", "qemu-arm64", "--log-collapse", "-1"],
+        ["--device", "qemu-arm64", "--log-collapse", "two"],
     ],
 )
 def test_command_line_errors(argv, capsys, monkeypatch, mocker, artefacts):
@@ -332,7 +337,7 @@ def test_command_line_parameters(monkeypatch, mocker, artefacts):
     run = mocker.patch("tuxrun.__main__.run", return_value=0)
     exitcode = main()
     assert exitcode == 0
-    assert len(run.call_args.args) == 4
+    assert len(run.call_args.args) == 5
     print(run.call_args.parameters)
     assert run.call_args[0][0].parameters == {"USERDATA": "http://userdata.tar.xz"}
 
@@ -372,6 +377,22 @@ def test_ignores_empty_line_from_lava_run_logfile(tuxrun_args, lava_run, tmp_pat
     assert type(logdata[1]) is dict
 
 
+def test_log_queue_size(tuxrun_args, lava_run, capsys, tmp_path):
+    metadata = tmp_path / "metadata.json"
+    tuxrun_args += ["--log-queue-size", "2", "--metadata", str(metadata)]
+    lava_run.stderr = [
+        '{"lvl": "info", "msg": "Hello, world", "dt": "2021-04-08T18:42:25.139513"}\n',
+        '{"lvl": "info", "msg": "Hello, tuxrun", "dt": "2021-04-08T18:42:26.139513"}\n',
+    ]
+    assert main() == 0
+    stdout, _ = capsys.readouterr()
+    assert "Hello, world" in stdout
+    assert "Hello, tuxrun" in stdout
+    data = json.loads(metadata.read_text(encoding="utf-8"))
+    assert data["pipeline"]["lines"] == 2
+    assert data["pipeline"]["queue"]["size"] == 2
+
+
 def test_exit_status_is_0_on_success(tuxrun_args, lava_run):
     assert main() == 0
 
@@ -414,6 +435,42 @@ def test_save_output(monkeypatch, tmp_path, run):
     )
 
 
+def test_save_output_compression(monkeypatch, tmp_path, run):
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "tuxrun",
+            "--device",
+            "qemu-armv5",
+            "--save-outputs",
+            "--save-outputs-compression",
+            "gz",
+        ],
+    )
+    main()
+    run.assert_called()
+    options = run.call_args[0][0]
+    output = tmp_path / "home" / ".cache" / "tuxrun" / "tests" / "1"
+    assert options.log_file == output / "logs"
+    assert options.log_file_html == output / "logs.html.gz"
+    assert options.log_file_text == output / "logs.txt.gz"
+    assert options.log_file_yaml == output / "logs.yaml.gz"
+    assert options.results_ndjson == output / "results.ndjson"
+
+
+def test_zst_output_requires_zstandard(monkeypatch, mocker, capsys, run):
+    mocker.patch("tuxrun.sinks.zstandard", None)
+    monkeypatch.setattr(
+        "sys.argv",
+        ["tuxrun", "--device", "qemu-armv5", "--log-file-yaml", "logs.yaml.zst"],
+    )
+    with pytest.raises(SystemExit):
+        main()
+    _, stderr = capsys.readouterr()
+    assert "python3-zstandard is required" in stderr
+    run.assert_not_called()
+
+
 def test_tuxbuild(get, monkeypatch, mocker, run):
     data = json.dumps(
         {
@@ -728,6 +785,120 @@ def test_update_cache(mocker, monkeypatch, capsys):
     )
 
 
+def test_update_cache_devices(mocker, monkeypatch, capsys):
+    get_rootfs = mocker.patch("tuxrun.argparse.get_rootfs", return_value="rootfs")
+    get_test_definitions = mocker.patch(
+        "tuxrun.argparse.get_test_definitions", return_value="testdef"
+    )
+    monkeypatch.setattr(
+        "sys.argv", ["tuxrun", "--update-cache", "qemu-arm64*", "qemu-x86_64"]
+    )
+    with pytest.raises(SystemExit):
+        main()
+    stdout, _ = capsys.readouterr()
+    assert (
+        stdout
+        == """Updating local cache:
+* Rootfs:
+  * qemu-arm64
+  * qemu-arm64be
+  * qemu-x86_64
+* Test definitions
+"""
+    )
+    assert sorted(c.args[0].name for c in get_rootfs.call_args_list) == [
+        "qemu-arm64",
+        "qemu-arm64be",
+        "qemu-x86_64",
+    ]
+    assert all(c.kwargs["decompress"] for c in get_rootfs.call_args_list)
+    assert all(c.kwargs["refresh"] for c in get_rootfs.call_args_list)
+    get_test_definitions.assert_called_once()
+    assert get_test_definitions.call_args.kwargs["refresh"]
+
+    monkeypatch.setattr("sys.argv", ["tuxrun", "--update-cache", "foo*"])
+    with pytest.raises(SystemExit):
+        main()
+    _, stderr = capsys.readouterr()
+    assert "no device matching foo*" in stderr
+
+
+def test_cache_proxy(monkeypatch, mocker, tmpdir):
+    monkeypatch.setattr(
+        "sys.argv", ["tuxrun", "--device", "qemu-arm64", "--cache-proxy"]
+    )
+    runtime = mocker.patch("tuxrun.__main__.Runtime.select").return_value.return_value
+    runtime.host.return_value = "host.containers.internal"
+    mocker.patch("tuxrun.__main__.Writer", side_effect=SystemExit)
+    mocker.patch(
+        "tuxrun.assets.__download_and_cache__", side_effect=lambda a, b, **kwargs: a
+    )
+    mocker.patch("tempfile.mkdtemp", return_value=tmpdir)
+    mocker.patch("shutil.rmtree")
+    with pytest.raises(SystemExit):
+        main()
+    dispatcher = (tmpdir / "dispatcher.yaml").read_text(encoding="utf-8")
+    assert re.search(
+        r'^http_url_format_string: "http://host.containers.internal:\d+/[0-9a-f]+/fetch\?url=%s"$',
+        dispatcher,
+        re.MULTILINE,
+    )
+
+
+def test_post_run(monkeypatch, mocker, tmpdir):
+    monkeypatch.setattr("sys.argv", ["tuxrun", "--device", "qemu-arm64"])
+    runtime = mocker.patch("tuxrun.__main__.Runtime.select").return_value.return_value
+    runtime.run.side_effect = KeyboardInterrupt
+    mocker.patch(
+        "tuxrun.assets.__download_and_cache__", side_effect=lambda a, b, **kwargs: a
+    )
+    mocker.patch("tempfile.mkdtemp", return_value=tmpdir)
+    mocker.patch("shutil.rmtree")
+    close = mocker.spy(tuxrun.__main__.Results, "close")
+    with pytest.raises(KeyboardInterrupt):
+        main()
+    runtime.post_run.assert_called_once_with()
+    close.assert_called_once()
+
+    # Failing before the runtime is started
+    runtime.reset_mock()
+    mocker.patch("tuxrun.__main__.Writer", side_effect=SystemExit)
+    with pytest.raises(SystemExit):
+        main()
+    runtime.run.assert_not_called()
+    runtime.post_run.assert_called_once_with()
+
+
+def test_offline(monkeypatch, mocker, capsys, get):
+    monkeypatch.setattr("sys.argv", ["tuxrun", "--device", "qemu-arm64", "--offline"])
+    mocker.patch("tuxrun.__main__.Runtime.select")
+    with pytest.raises(SystemExit) as exc:
+        main()
+    assert exc.value.code == 2
+    _, stderr = capsys.readouterr()
+    assert "is not in the cache, unable to download it with --offline" in stderr
+    get.assert_not_called()
+
+
+def test_asset_manifest(monkeypatch, mocker, capsys, tmp_path, run):
+    mocker.patch("tuxrun.__main__.Prefetch")
+    manifest = tmp_path / "assets.json"
+    manifest.write_text("[]")
+    monkeypatch.setattr(
+        "sys.argv",
+        ["tuxrun", "--device", "qemu-arm64", "--asset-manifest", str(manifest)],
+    )
+    with pytest.raises(SystemExit):
+        main()
+    _, stderr = capsys.readouterr()
+    assert f"Invalid asset manifest '{manifest}'" in stderr
+    run.assert_not_called()
+
+    manifest.unlink()
+    main()
+    assert json.loads(manifest.read_text()) == {"version": 1, "assets": {}}
+
+
 def test_save_results_json(tuxrun_args, lava_run, mocker, tmp_path):
     json = tmp_path / "results.json"
     tuxrun_args += [f"--results={json}"]
@@ -830,8 +1001,12 @@ def test_boot_args(monkeypatch, mocker, tmpdir, args, cnt):
         "tuxrun.__main__.sys.argv",
         ["tuxrun", "--device", "qemu-arm64", "--boot-args"] + [args],
     )
-    mocker.patch("tuxrun.__main__.Runtime.select", side_effect=SystemExit)
-    mocker.patch("tuxrun.assets.__download_and_cache__", side_effect=lambda a, b: a)
+    # The runtime is prepared before rendering: stop right after the rendering
+    mocker.patch("tuxrun.__main__.Runtime.select")
+    mocker.patch("tuxrun.__main__.templates.dispatchers", side_effect=SystemExit)
+    mocker.patch(
+        "tuxrun.assets.__download_and_cache__", side_effect=lambda a, b, **kwargs: a
+    )
     mocker.patch(
         "tuxrun.__main__.get_test_definitions", return_value="file://testdef.tar.zst"
     )
@@ -844,3 +1019,59 @@ def test_boot_args(monkeypatch, mocker, tmpdir, args, cnt):
         # Invalid case
         with pytest.raises(Exception):
             main()
+
+
+def test_log_file_html_pages(monkeypatch, capsys, run):
+    monkeypatch.setattr(
+        "sys.argv", ["tuxrun", "--device", "qemu-armv5", "--log-file-html-pages", "0"]
+    )
+    with pytest.raises(SystemExit):
+        main()
+    monkeypatch.setattr(
+        "sys.argv",
+        ["tuxrun", "--device", "qemu-armv5", "--log-file-html-pages", "suite"],
+    )
+    with pytest.raises(SystemExit):
+        main()
+    _, stderr = capsys.readouterr()
+    assert "--log-file-html-pages requires an HTML log file" in stderr
+
+
+def test_prefetch_assets(monkeypatch, mocker, tmp_path, run):
+    mocker.patch(
+        "tuxrun.assets.__download_and_cache__",
+        side_effect=lambda url, progress, **kwargs: str(
+            touch(tmp_path, url.split("/")[-1])
+        ),
+    )
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "tuxrun",
+            "--device",
+            "qemu-arm64",
+            "--kernel",
+            "https://example.com/Image",
+            "--modules",
+            "https://example.com/modules.tar.xz",
+            "--overlay",
+            "https://example.com/overlay.tar.xz",
+            "--tests",
+            "kselftest-cgroup",
+            "--parameters",
+            "KSELFTEST=https://example.com/kselftest.tar.xz",
+            "SKIPFILE=https://example.com/skipfile.yaml",
+        ],
+    )
+    main()
+    (options, _, _, artefacts, prefetch) = run.call_args[0]
+    prefetch.wait()
+    tuxrun.__main__.use_prefetched(options, prefetch)
+    assert options.kernel == f"file://{tmp_path}/Image"
+    assert options.rootfs == f"file://{tmp_path}/rootfs.ext4.zst"
+    assert options.modules[0] == f"file://{tmp_path}/modules.tar.xz"
+    assert options.overlays[0][0] == f"file://{tmp_path}/overlay.tar.xz"
+    assert options.parameters["KSELFTEST"] == f"file://{tmp_path}/kselftest.tar.xz"
+    assert options.parameters["SKIPFILE"] == "https://example.com/skipfile.yaml"
+    # Results still reference the original urls
+    assert artefacts["kernel"] == "https://example.com/Image"
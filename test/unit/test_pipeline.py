@@ -0,0 +1,114 @@
+import threading
+
+import pytest
+
+from tuxrun.pipeline import Pipeline, Record
+
+
+def test_record():
+    record = Record(
+        '{"lvl": "info", "msg": "Hello, world", "dt": "2021-04-08T18:42:25.139513"}\n'
+    )
+    assert record.line.endswith("}")
+    assert record.data["msg"] == "Hello, world"
+    assert record.lvl == "info"
+    assert record.result is None
+
+
+def test_record_invalid():
+    for line in ["{", "hello world", "{}", "", "[1, 2]"]:
+        record = Record(line)
+        assert record.data is None
+        assert record.lvl is None
+        assert record.result is None
+
+
+def test_record_result():
+    record = Record(
+        '{"lvl": "results", "msg": {"definition": "1_ltp-smoke", "case": "access01", "result": "pass"}}'
+    )
+    assert record.result == ("ltp-smoke", "access01", {"result": "pass"})
+    # The decoded data is left untouched for the other consumers
+    assert record.data["msg"]["definition"] == "1_ltp-smoke"
+
+    record = Record('{"lvl": "results", "msg": {"case": "tux", "result": "pass"}}')
+    assert record.result is None
+    record = Record('{"lvl": "results", "msg": "hello"}')
+    assert record.result is None
+
+
+def test_pipeline(mocker):
+    first = mocker.MagicMock()
+    second = mocker.MagicMock()
+    pipeline = Pipeline()
+    pipeline.register(first)
+    pipeline.register(second)
+
+    record = pipeline.feed('{"lvl": "info", "msg": "Hello", "dt": "now"}')
+    first.assert_called_once_with(record)
+    second.assert_called_once_with(record)
+    assert record.data == {"lvl": "info", "msg": "Hello", "dt": "now"}
+
+
+def test_pipeline_decodes_once(mocker):
+    load = mocker.patch("tuxrun.pipeline.decode", return_value={"lvl": "info"})
+    pipeline = Pipeline()
+    pipeline.register(mocker.MagicMock())
+    pipeline.register(mocker.MagicMock())
+    pipeline.feed('{"lvl": "info"}')
+    assert load.call_count == 1
+
+
+def test_pipeline_run(mocker):
+    consumer = mocker.MagicMock()
+    pipeline = Pipeline()
+    pipeline.register(consumer)
+    pipeline.run(['{"lvl": "info"}', '{"lvl": "debug"}'])
+    assert consumer.call_count == 2
+    assert pipeline.stats == {"lines": 2}
+
+
+def test_pipeline_run_threaded(mocker):
+    lines = [f'{{"lvl": "info", "msg": "{i}"}}' for i in range(100)]
+    msgs = []
+    pipeline = Pipeline()
+    pipeline.register(lambda record: msgs.append(record.data["msg"]))
+    pipeline.run(iter(lines), queue_size=10)
+    assert msgs == [str(i) for i in range(100)]
+    assert pipeline.stats["lines"] == 100
+    assert pipeline.stats["queue"]["size"] == 10
+    assert 0 < pipeline.stats["queue"]["depth"] <= 10
+    assert pipeline.stats["queue"]["blocked"] >= 0
+
+
+def test_pipeline_run_threaded_error(mocker):
+    def lines():
+        yield '{"lvl": "info"}'
+        raise OSError("broken pipe")
+
+    consumer = mocker.MagicMock()
+    pipeline = Pipeline()
+    pipeline.register(consumer)
+    with pytest.raises(OSError):
+        pipeline.run(lines(), queue_size=10)
+    consumer.assert_called_once()
+
+
+def test_pipeline_run_consumer_error():
+    read = []
+
+    def lines():
+        for i in range(100):
+            read.append(i)
+            yield f'{{"lvl": "info", "msg": "{i}"}}'
+
+    def consumer(record):
+        raise RuntimeError("consumer failed")
+
+    pipeline = Pipeline()
+    pipeline.register(consumer)
+    with pytest.raises(RuntimeError, match="consumer failed"):
+        pipeline.run(lines(), queue_size=2)
+    # The reader is stopped and leaves the rest of the stream alone
+    assert not any(t.name == "pipeline-reader" for t in threading.enumerate())
+    assert len(read) < 100
@@ -0,0 +1,129 @@
+import urllib.error
+import urllib.request
+from urllib.parse import quote_plus
+
+import pytest
+import requests
+
+from tuxrun import assets
+from tuxrun.exceptions import InvalidArgument
+from tuxrun.proxy import CacheProxy
+from tuxrun.runtimes import DockerRuntime, NullRuntime
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+@pytest.fixture
+def proxy(mocker, tmp_path):
+    (tmp_path / "rootfs.ext4").write_bytes(b"rootfs")
+
+    def download(url):
+        if url.endswith("rootfs.ext4"):
+            return str(tmp_path / "rootfs.ext4")
+        if url.endswith("bzImage"):
+            raise InvalidArgument(f"'{url}' is not in the cache")
+        if url.endswith("Image.gz"):
+            raise requests.ConnectionError("connection refused")
+        return url
+
+    mocker.patch("tuxrun.assets.__download_and_cache__", side_effect=download)
+    with CacheProxy(NullRuntime()) as proxy:
+        yield proxy
+
+
+def test_proxy(proxy):
+    fmt = proxy.url_format_string
+    assert fmt.startswith("http://127.0.0.1:")
+    assert fmt.endswith("/fetch?url=%s")
+
+    url = fmt % quote_plus("https://example.com/rootfs.ext4")
+    with urllib.request.urlopen(url) as response:
+        assert response.read() == b"rootfs"
+        assert response.headers["Content-Length"] == "6"
+
+
+def test_proxy_head(proxy, mocker):
+    download = assets.__download_and_cache__
+    head = mocker.patch("requests.Session.head")
+    head.return_value.status_code = 200
+    head.return_value.headers = {"Content-Length": "42"}
+
+    # From the cache
+    url = "https://example.com/rootfs.ext4"
+    cache = assets.asset_paths(url)[0]
+    cache.parent.mkdir(parents=True)
+    cache.write_bytes(b"rootfs")
+    request = urllib.request.Request(
+        proxy.url_format_string % quote_plus(url), method="HEAD"
+    )
+    with urllib.request.urlopen(request) as response:
+        assert response.headers["Content-Length"] == "6"
+    head.assert_not_called()
+
+    # From the server
+    url = "https://example.com/Image"
+    request = urllib.request.Request(
+        proxy.url_format_string % quote_plus(url), method="HEAD"
+    )
+    with urllib.request.urlopen(request) as response:
+        assert response.headers["Content-Length"] == "42"
+    head.assert_called_once_with(url, timeout=60, allow_redirects=True)
+    download.assert_not_called()
+
+    head.side_effect = requests.ConnectionError("connection refused")
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(request)
+    assert exc.value.code == 502
+
+    assets.OFFLINE = True
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(request)
+    assert exc.value.code == 404
+
+
+def test_proxy_not_cached(proxy):
+    url = proxy.url_format_string % quote_plus("https://example.com/Image")
+    opener = urllib.request.build_opener(NoRedirect)
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        opener.open(url)
+    assert exc.value.code == 302
+    assert exc.value.headers["Location"] == "https://example.com/Image"
+
+    # --offline
+    url = proxy.url_format_string % quote_plus("https://example.com/bzImage")
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(url)
+    assert exc.value.code == 404
+
+    # Download failure
+    url = proxy.url_format_string % quote_plus("https://example.com/Image.gz")
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(url)
+    assert exc.value.code == 502
+
+
+def test_proxy_forbidden(proxy):
+    url = proxy.url_format_string.replace("/fetch", "x/fetch")
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(url % "https://example.com/rootfs.ext4")
+    assert exc.value.code == 403
+
+    url = proxy.url_format_string % quote_plus("file:///etc/passwd")
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(url)
+    assert exc.value.code == 400
+
+
+def test_proxy_docker():
+    runtime = DockerRuntime()
+    runtime.name("name")
+    runtime.image("image")
+    cmd = runtime.cmd([])
+    with CacheProxy(runtime) as proxy:
+        assert proxy.url_format_string.startswith("http://host.docker.internal:")
+    # host() has no side effect
+    assert runtime.cmd([]) == cmd
+    assert cmd[5:7] == ["--add-host", "host.docker.internal:host-gateway"]
@@ -4,7 +4,8 @@ from pathlib import Path
 
 import pytest
 
-from tuxrun.results import Results
+from tuxrun.pipeline import Record
+from tuxrun.results import Results, ResultsStream, main
 from tuxrun.tests import Test
 
 BASE = (Path(__file__) / "..").resolve()
@@ -57,6 +58,94 @@ def test_data():
     assert results.data["mytestsuite"]["test1"]["result"] == "pass"
 
 
+def test_digests():
+    line = '{"lvl": "results", "msg": {"definition": "lava", "case": "file-download", "result": "pass", "extra": {"label": "kernel"}}}'
+    results = Results([], {"kernel": "https://example.com/Image"})
+    results.parse(line)
+    assert results.metadata["artefacts"] == {
+        "kernel": {"url": "https://example.com/Image", "sha256sum": None}
+    }
+    results = Results(
+        [],
+        {"kernel": "https://example.com/Image"},
+        {"https://example.com/Image": "1234"},
+    )
+    results.parse(line)
+    assert results.metadata["artefacts"] == {
+        "kernel": {"url": "https://example.com/Image", "sha256sum": "1234"}
+    }
+
+
+def test_download_with_and_without_label():
+    labelled = '{"lvl": "results", "msg": {"definition": "lava", "case": "http-download", "result": "pass", "extra": {"label": "kernel"}}}'
+    unlabelled = '{"lvl": "results", "msg": {"definition": "lava", "case": "http-download", "result": "fail"}}'
+    artefacts = {"kernel": "https://example.com/Image"}
+    for lines in [[labelled, unlabelled], [unlabelled, labelled]]:
+        results = Results([], artefacts)
+        for line in lines:
+            results.parse(line)
+        assert results.data["lava"]["http-download"] == {
+            "kernel": {
+                "result": "pass",
+                "extra": {"label": "kernel"},
+                "url": "https://example.com/Image",
+            },
+            "unlabelled": {"result": "fail"},
+        }
+        assert list(results.metadata["artefacts"]) == ["kernel"]
+        results.close()
+
+
+def test_close():
+    results = Results([], {})
+    results.parse(gen_test("test1", "pass"))
+    results.parse(
+        '{"lvl": "results", "msg": {"definition": "suite", "case": "test2", "result": "pass", "extra": {"index": 2}}}'
+    )
+    spill = results.__spill__.__file__
+    results.close()
+    assert spill.closed
+    results.close()
+
+
+def test_decompression(tmp_path):
+    stats = {"rootfs": {"codec": "xz -T0 -dc", "size": 42, "throughput": 21}}
+    results = Results([], {}, decompression=stats)
+    assert "decompression" not in Results([], {}).metadata
+    assert results.metadata["decompression"] == stats
+
+    stream = ResultsStream(tmp_path / "results.ndjson", [], {}, decompression=stats)
+    stream.close()
+    assert Results.fold(tmp_path / "results.ndjson").metadata["decompression"] == stats
+
+
+def test_downloads(tmp_path):
+    downloads = {}
+    results = Results([], {}, downloads=downloads)
+    # Downloads done by the cache proxy during the run
+    stats = {"https://example.com/Image": {"received": 42, "throughput": 21}}
+    downloads.update(stats)
+    assert results.metadata["downloads"] == stats
+    assert "downloads" not in Results([], {}).metadata
+
+    stream = ResultsStream(tmp_path / "results.ndjson", [], {}, downloads=stats)
+    stream.close()
+    assert Results.fold(tmp_path / "results.ndjson").metadata["downloads"] == stats
+
+
+def test_compact_data():
+    results = Results([], {})
+    for i in range(3):
+        results.parse(
+            f'{{"lvl": "results", "msg": {{"definition": "suite", "case": "test{i}", "result": "pass", "extra": {{"index": {i}}}}}}}'
+        )
+    cases = results.__data__["suite"]
+    assert cases["test0"].keys is cases["test2"].keys
+    assert cases["test0"].values[0] is cases["test2"].values[0]
+    assert results.__spill__.__file__ is not None
+    assert results.data["suite"]["test2"] == {"result": "pass", "extra": {"index": 2}}
+
+
 @pytest.mark.parametrize(
     "name,testsuite",
     [
@@ -108,3 +197,56 @@ def test_results_parsing(name, testsuite):
         )
     data = (BASE / "results" / (name + "-metadata.json")).read_text(encoding="utf-8")
     assert results.metadata == json.loads(data)
+
+
+@pytest.mark.parametrize("name,testsuite", [("fail-1", "ltp-containers")])
+def test_results_stream(name, testsuite, tmp_path):
+    logs = (BASE / "logs" / (name + ".yaml")).read_text(encoding="utf-8").strip("\n")
+    tests = [Test.select(testsuite)]
+    artefacts = {
+        "kernel": "https://example.com/bzImage",
+        "modules": "https://example.com/modules.tar.xz",
+        "rootfs": "https://example.com/rootfs.ext4.xz",
+        "overlays": [["https://example.com/ltp.tar.xz", "/"]],
+    }
+    stream = ResultsStream(tmp_path / "results.ndjson", tests, artefacts)
+    results = Results(tests, artefacts, stream=stream)
+    for line in logs.split("\n"):
+        results.consume(Record(line[2:]))
+    stream.close()
+
+    folded = Results.fold(tmp_path / "results.ndjson")
+    assert folded.data == results.data
+    assert folded.metadata == results.metadata
+    assert folded.ret() == results.ret()
+
+    # Simulate a crash in the middle of a line
+    content = (tmp_path / "results.ndjson").read_text(encoding="utf-8")
+    (tmp_path / "results.ndjson").write_text(content[:-10], encoding="utf-8")
+    folded = Results.fold(tmp_path / "results.ndjson")
+    assert len(folded.data["lava"]) == len(results.data["lava"]) - 1
+
+    assert (
+        main(
+            [
+                str(tmp_path / "results.ndjson"),
+                "--results",
+                str(tmp_path / "results.json"),
+                "--metadata",
+                str(tmp_path / "metadata.json"),
+            ]
+        )
+        == 1
+    )
+    assert json.loads((tmp_path / "results.json").read_text(encoding="utf-8")) == (
+        folded.data
+    )
+    assert "artefacts" in json.loads(
+        (tmp_path / "metadata.json").read_text(encoding="utf-8")
+    )
+
+
+def test_results_stream_empty(tmp_path):
+    (tmp_path / "results.ndjson").touch()
+    with pytest.raises(ValueError):
+        Results.fold(tmp_path / "results.ndjson")
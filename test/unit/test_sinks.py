@@ -0,0 +1,109 @@
+import gzip
+import io
+
+import pytest
+
+from tuxrun.exceptions import InvalidArgument
+from tuxrun.sinks import Sink
+
+
+class Stream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return super().write(data)
+
+
+def test_sink_batches_writes():
+    stream = Stream()
+    sink = Sink(stream, size=1024, interval=3600)
+    for i in range(100):
+        sink.write(f"line {i}\n")
+    assert stream.writes == 0
+
+    sink.flush()
+    assert stream.writes == 1
+    assert stream.getvalue() == "".join(f"line {i}\n" for i in range(100))
+
+
+def test_sink_flush_on_size():
+    stream = Stream()
+    sink = Sink(stream, size=10, interval=3600)
+    sink.write("12345")
+    assert stream.writes == 0
+    sink.write("67890")
+    assert stream.writes == 1
+    assert stream.getvalue() == "1234567890"
+
+
+def test_sink_flush_on_interval(mocker):
+    monotonic = mocker.patch("tuxrun.sinks.time.monotonic", return_value=0)
+    stream = Stream()
+    sink = Sink(stream, size=1024, interval=1)
+    sink.write("hello\n")
+    assert stream.writes == 0
+    monotonic.return_value = 2
+    sink.write("world\n")
+    assert stream.getvalue() == "hello\nworld\n"
+
+
+def test_sink_flush_expired(mocker):
+    monotonic = mocker.patch("tuxrun.sinks.time.monotonic", return_value=0)
+    stream = Stream()
+    sink = Sink(stream, size=1024, interval=1)
+    sink.write("hello\n")
+    sink.flush_expired()
+    assert stream.writes == 0
+    monotonic.return_value = 2
+    sink.flush_expired()
+    assert stream.getvalue() == "hello\n"
+
+
+def test_sink_close(tmp_path):
+    sink = Sink.open(tmp_path / "logs")
+    sink.write("hello\n")
+    sink.close()
+    assert sink.stream.closed
+    assert (tmp_path / "logs").read_text(encoding="utf-8") == "hello\n"
+
+
+def test_sink_stdout(capsys, mocker):
+    sink = Sink.open("-")
+    sink.write("hello\n")
+    sink.close()
+    assert capsys.readouterr().out == "hello\n"
+
+    mocker.patch("sys.stdout.isatty", return_value=True)
+    sink = Sink.stdout()
+    sink.write("hello\n")
+    assert capsys.readouterr().out == "hello\n"
+
+
+def test_sink_gz(tmp_path):
+    sink = Sink.open(tmp_path / "logs.txt.gz")
+    sink.write("hello\n")
+    sink.close()
+    with gzip.open(tmp_path / "logs.txt.gz", "rt", encoding="utf-8") as f:
+        assert f.read() == "hello\n"
+
+
+def test_sink_zst(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    sink = Sink.open(tmp_path / "logs.yaml.zst")
+    for i in range(1000):
+        sink.write(f"- line {i}\n")
+    sink.close()
+    with zstandard.open(tmp_path / "logs.yaml.zst", "rt", encoding="utf-8") as f:
+        assert f.read() == "".join(f"- line {i}\n" for i in range(1000))
+
+
+def test_sink_zst_missing(tmp_path, mocker):
+    mocker.patch("tuxrun.sinks.zstandard", None)
+    assert not Sink.supported(tmp_path / "logs.yaml.zst")
+    assert Sink.supported(tmp_path / "logs.yaml.gz")
+    assert Sink.supported(tmp_path / "logs.yaml")
+    with pytest.raises(InvalidArgument):
+        Sink.open(tmp_path / "logs.yaml.zst")
@@ -4,6 +4,7 @@ from pathlib import Path
 import pytest
 
 from tuxrun.utils import (
+    AggregateProgressIndicator,
     NoProgressIndicator,
     ProgressIndicator,
     TTYProgressIndicator,
@@ -24,6 +25,22 @@ def test_progress_class(mocker):
     assert isinstance(ProgressIndicator.get("test"), NoProgressIndicator)
 
 
+def test_aggregate_progress(mocker):
+    parent = mocker.MagicMock()
+    progress = AggregateProgressIndicator(parent)
+    (a, b) = (progress.child(), progress.child())
+    progress.finish()
+    parent.finish.assert_not_called()
+    a.progress(20)
+    parent.progress.assert_called_with(20)
+    b.progress(60)
+    parent.progress.assert_called_with(40)
+    a.finish()
+    parent.progress.assert_called_with(80)
+    progress.finish()
+    parent.finish.assert_called_once()
+
+
 def test_notnone():
     assert notnone(None, "fallback") == "fallback"
     assert notnone("", "fallback") == ""
@@ -1,4 +1,9 @@
-from tuxrun.writer import Writer
+import itertools
+import random
+import re
+import time
+
+from tuxrun.writer import Collapser, Writer
 
 
 def test_write_log_file(tmp_path):
@@ -177,3 +182,131 @@ hello world
         encoding="utf-8"
     ) == "\x1b[0;90m2021-04-08T18:42:25\x1b[0m <\x1b[0;33mtesting\x1b[0m> \x1b[0;33mHello, world\x1b[0m\n"
     assert (tmpdir / "logs.yaml").read_text(encoding="utf-8") == f"- {data}\n"
+
+
+def test_writer_flush_when_idle(tmp_path, monkeypatch):
+    monkeypatch.setattr("tuxrun.writer.INTERVAL", 0.01)
+    yaml_file = tmp_path / "logs.yaml"
+    with Writer(None, None, None, yaml_file) as writer:
+        writer.yaml_file.interval = 3600
+        writer.write('{"lvl": "target", "msg": "Hello, world", "dt": "now"}')
+        writer.write(
+            '{"lvl": "results", "msg": {"definition": "lava", "case": "job", "result": "pass"}, "dt": "now"}'
+        )
+        # Not flushed at test boundaries
+        assert yaml_file.read_text(encoding="utf-8") == ""
+
+        writer.yaml_file.interval = 0
+        deadline = time.monotonic() + 5
+        while not yaml_file.read_text(encoding="utf-8"):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert len(yaml_file.read_text(encoding="utf-8").split("\n")) == 3
+    assert not writer.__flusher__.is_alive()
+
+
+def test_writer_html_pages(tmp_path):
+    html_file = tmp_path / "logs.html"
+    with Writer(None, html_file, None, None, 2) as writer:
+        for i in range(5):
+            writer.write(f'{{"lvl": "target", "msg": "line {i}", "dt": "now"}}')
+        writer.write(
+            '{"lvl": "results", "msg": {"definition": "lava", "case": "job", "result": "fail"}, "dt": "now"}'
+        )
+    pages = sorted(p.name for p in tmp_path.glob("logs.*.html"))
+    assert pages == ["logs.0001.html", "logs.0002.html", "logs.0003.html"]
+    page = (tmp_path / "logs.0002.html").read_text(encoding="utf-8")
+    assert '<span id="L2">' in page and '<span id="L3">' in page
+    assert '<a href="logs.0001.html">previous</a>' in page
+    assert '<a href="logs.0003.html">next</a>' in page
+    assert page.endswith("</html>")
+    index = html_file.read_text(encoding="utf-8")
+    assert '<a href="logs.0003.html">logs.0003.html</a> L4' in index
+    assert '<a href="logs.0003.html#L4">lava/job</a>' in index
+
+
+def test_writer_html_pages_suite(tmp_path):
+    html_file = tmp_path / "logs.html"
+    with Writer(None, html_file, None, None, "suite") as writer:
+        writer.write('{"lvl": "target", "msg": "boot", "dt": "now"}')
+        for suite in ["0_ltp-mm", "1_ltp-math"]:
+            writer.write(
+                f'{{"lvl": "target", "msg": "<LAVA_SIGNAL_STARTRUN {suite} 1_1.1.3.1>", "dt": "now"}}'
+            )
+            writer.write('{"lvl": "target", "msg": "test", "dt": "now"}')
+    index = html_file.read_text(encoding="utf-8")
+    assert '<a href="logs.0002.html">logs.0002.html</a> L1 ltp-mm' in index
+    assert '<a href="logs.0003.html">logs.0003.html</a> L3 ltp-math' in index
+
+
+def test_writer_collapse(tmp_path):
+    text_file = tmp_path / "logs.txt"
+    yaml_file = tmp_path / "logs.yaml"
+    lines = ["a", "b", "b", "c", "d", "c", "d", "c", "d", "c", "e", "c", "e"]
+    lines += ["f"] * 1000 + ["g", "g"]
+    with Writer(None, None, text_file, yaml_file, None, 2) as writer:
+        for line in lines:
+            writer.write(f'{{"lvl": "target", "msg": "{line}", "dt": "now"}}')
+        writer.write(
+            '{"lvl": "results", "msg": {"definition": "lava", "case": "job", "result": "pass"}, "dt": "now"}'
+        )
+    assert text_file.read_text(encoding="utf-8").split("\n") == [
+        "a",
+        "b",
+        "b",
+        "c",
+        "d",
+        "[previous 2 lines repeated 2 times]",
+        "c",
+        "e",
+        "[previous 2 lines repeated 1 time]",
+        "f",
+        "[previous line repeated 999 times]",
+        "g",
+        "g",
+        "",
+    ]
+    assert len(yaml_file.read_text(encoding="utf-8").split("\n")) == len(lines) + 2
+
+
+def expand(out):
+    lines = []
+    for data in out:
+        m = re.fullmatch(
+            r"\[previous (?:line|(\d+) lines) repeated (\d+) times?\]", data["msg"]
+        )
+        if m:
+            start = len(lines) - int(m[1] or 1)
+            lines += lines[start:] * int(m[2])
+        else:
+            lines.append(data["msg"])
+    return lines
+
+
+def test_collapser():
+    for window in range(1, 4):
+        lines_list = [
+            list(p) for n in range(1, 9) for p in itertools.product("abc", repeat=n)
+        ]
+        rng = random.Random(window)
+        lines_list += [rng.choices("abc", k=40) for _ in range(200)]
+        for lines in lines_list:
+            collapser = Collapser(window)
+            out = []
+            for line in lines:
+                out.extend(collapser.add(line, {"msg": line, "dt": "now"}))
+            out.extend(collapser.finish())
+            assert expand(out) == lines, (window, lines)
+
+
+def test_writer_collapse_html(tmp_path):
+    html_file = tmp_path / "logs.html"
+    with Writer(None, html_file, None, None, None, 1) as writer:
+        for _ in range(3):
+            writer.write('{"lvl": "target", "msg": "<4>rcu stall", "dt": "now"}')
+    content = html_file.read_text(encoding="utf-8")
+    assert content.count("rcu stall") == 1
+    assert (
+        '<span id="L1"><span class="timestamp">now</span> <span class="warn">[previous line repeated 2 times]</span></span>'
+        in content
+    )
@@ -23,6 +23,7 @@ Requires: python3-yaml
 Requires: python3-ruamel-yaml
 Requires: python3-jinja2
 Requires: python3-requests
+Suggests: python3-zstandard
 
 BuildArch: noarch
 
@@ -15,18 +15,33 @@ import signal
 import subprocess
 import sys
 import tempfile
+from functools import partial
 from os.path import commonprefix
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, Optional
 from urllib.parse import urlparse
 
-from tuxrun import templates
+from tuxrun import assets, templates
 from tuxrun.argparse import filter_artefacts, filter_options, pathurlnone, setup_parser
-from tuxrun.assets import get_rootfs, get_test_definitions
+from tuxrun.assets import (
+    DECOMPRESSED,
+    DOWNLOADS,
+    Prefetch,
+    asset_digests,
+    cache_gc,
+    get_asset,
+    get_rootfs,
+    get_test_definitions,
+    load_manifest,
+    write_manifest,
+)
 from tuxrun.devices import Device
 from tuxrun.exceptions import InvalidArgument
-from tuxrun.results import Results
+from tuxrun.pipeline import Pipeline
+from tuxrun.proxy import CacheProxy
+from tuxrun.results import Results, ResultsStream
 from tuxrun.runtimes import Runtime
+from tuxrun.sinks import Sink
 from tuxrun.templates import wrappers
 from tuxrun.tests import Test
 from tuxrun.utils import ProgressIndicator, get_new_output_dir, mask_secrets, notify
@@ -42,6 +57,92 @@ LOG = logging.getLogger("tuxrun")
 ###########
 # Helpers #
 ###########
+ASSETS = [
+    "ap_romfw",
+    "bios",
+    "bl1",
+    "dtb",
+    "fip",
+    "kernel",
+    "mcp_fw",
+    "mcp_romfw",
+    "rootfs",
+    "scp_fw",
+    "scp_romfw",
+    "uefi",
+]
+
+
+def is_http(url) -> bool:
+    return isinstance(url, str) and urlparse(url).scheme in ["http", "https"]
+
+
+def prefetch_jobs(options) -> Dict[str, Callable]:
+    """
+    Every asset to download before starting the job
+    """
+    jobs: Dict[str, Callable] = {}
+    decompress = options.device.flag_decompress_assets
+    if options.device.flag_cache_rootfs:
+        jobs["rootfs"] = lambda progress: get_rootfs(
+            options.device, options.rootfs, progress, decompress=decompress
+        )
+    if any(t.need_test_definition for t in options.tests):
+        jobs["test-definitions"] = get_test_definitions
+    if not options.device.flag_cache_assets:
+        return jobs
+
+    for name in ASSETS:
+        if name not in jobs and is_http(getattr(options, name)):
+            jobs[name] = partial(get_asset, getattr(options, name))
+    if options.modules and is_http(options.modules[0]):
+        jobs["modules"] = partial(get_asset, options.modules[0], decompress=decompress)
+    for index, item in enumerate(options.overlays):
+        if is_http(item[0]):
+            jobs[f"overlay-{index:02}"] = partial(
+                get_asset, item[0], decompress=decompress
+            )
+    for key in {k for t in options.tests for k in t.overlay_parameters}:
+        if is_http(options.parameters.get(key)):
+            jobs[f"parameter-{key}"] = partial(get_asset, options.parameters[key])
+    return jobs
+
+
+def use_prefetched(options, prefetch: Prefetch) -> None:
+    """
+    Replace the urls by the downloaded assets
+    """
+    for name in ASSETS:
+        if name in prefetch:
+            setattr(options, name, pathurlnone(prefetch.result(name)))
+    if "modules" in prefetch:
+        options.modules = [prefetch.result("modules"), options.modules[1]]
+    for index, item in enumerate(options.overlays):
+        if f"overlay-{index:02}" in prefetch:
+            options.overlays[index] = [prefetch.result(f"overlay-{index:02}"), item[1]]
+    for key in options.parameters:
+        if f"parameter-{key}" in prefetch:
+            options.parameters[key] = prefetch.result(f"parameter-{key}")
+
+
+def decompression_stats(options) -> Dict[str, Dict]:
+    """
+    Statistics of the assets decompressed by this run
+    """
+    paths = [("rootfs", options.rootfs)]
+    if options.modules:
+        paths.append(("modules", options.modules[0]))
+    for index, item in enumerate(options.overlays):
+        paths.append((f"overlay-{index:02}", item[0]))
+    return {
+        name: DECOMPRESSED[path[7:]]
+        for name, path in paths
+        if isinstance(path, str)
+        and path.startswith("file://")
+        and path[7:] in DECOMPRESSED
+    }
+
+
 def overlay_qemu(qemu_binary, tmpdir, runtime):
     """
     Overlay an external QEMU into the container, taking care to also
@@ -148,7 +249,10 @@ def run_hooks(hooks, cwd):
     return 0
 
 
-def run_hacking_sesson(definition, case, test):
+def run_hacking_sesson(record):
+    if record.result is None:
+        return
+    (definition, case, test) = record.result
     if definition == "hacking-session" and case == "tmate" and "reference" in test:
         if sys.stdout.isatty():
             subprocess.Popen(
@@ -165,211 +269,267 @@ def run_hacking_sesson(definition, case, test):
 ##############
 # Entrypoint #
 ##############
-def run(options, tmpdir: Path, cache_dir: Optional[Path], artefacts: dict) -> int:
-    # Render the job definition and device dictionary
-    extra_assets = []
-    overlays = []
-
-    if options.modules:
-        overlays.append(("modules", options.modules[0], options.modules[1]))
-        extra_assets.append(options.modules[0])
-
-    # When using --shared without any arguments, point to cache_dir
-    if options.shared is not None:
-        if not options.shared:
-            assert cache_dir
-            options.shared = [str(cache_dir), "/mnt/tuxrun"]
-        extra_assets.append(("file://" + options.shared[0], False))
-
-    for index, item in enumerate(options.overlays):
-        overlays.append((f"overlay-{index:02}", item[0], item[1]))
-        extra_assets.append(item[0])
-
-    # Add test definitions only when needed
-    test_definitions = None
-    if any(t.need_test_definition for t in options.tests):
-        test_definitions = get_test_definitions(
-            ProgressIndicator.get("Downloading test definitions")
-        )
-        extra_assets.append(test_definitions)
-
-    # Add extra assets from parameters
-    for k, v in options.parameters.items():
-        if v.startswith("file://"):
-            extra_assets.append(v)
-
-    commands = " ".join([shlex.quote(s) for s in options.commands])
-
-    def_arguments = {
-        "bios": options.bios,
-        "bl1": options.bl1,
-        "commands": commands,
-        "device": options.device,
-        "qemu_image": options.qemu_image,
-        "dtb": options.dtb,
-        "kernel": options.kernel,
-        "ap_romfw": options.ap_romfw,
-        "mcp_fw": options.mcp_fw,
-        "mcp_romfw": options.mcp_romfw,
-        "fip": options.fip,
-        "enable_kvm": options.enable_kvm,
-        "enable_trustzone": options.enable_trustzone,
-        "enable_network": options.enable_network,
-        "overlays": overlays,
-        "prompt": options.prompt,
-        "rootfs": options.rootfs,
-        "rootfs_partition": options.partition,
-        "shared": options.shared,
-        "scp_fw": options.scp_fw,
-        "scp_romfw": options.scp_romfw,
-        "ssh_host": options.ssh_host,
-        "ssh_prompt": options.ssh_prompt,
-        "ssh_port": options.ssh_port,
-        "ssh_user": options.ssh_user,
-        "tests": options.tests,
-        "test_definitions": test_definitions,
-        "tests_timeout": sum(t.timeout for t in options.tests),
-        "timeouts": options.timeouts,
-        "tmpdir": tmpdir,
-        "tux_boot_args": (
-            " ".join(shlex.split(options.boot_args)) if options.boot_args else None
-        ),
-        "tux_prompt": options.prompt,
-        "parameters": options.parameters,
-        "uefi": options.uefi,
-        "boot_args": options.boot_args,
-        "secrets": options.secrets,
-    }
-    definition = options.device.definition(**def_arguments)
-    LOG.debug("job definition")
-    LOG.debug(definition)
-
-    job_definition = yaml_load(definition)
-    job_timeout = (job_definition["timeouts"]["job"]["minutes"] + 1) * 60
-    context = job_definition.get("context", {})
-    if options.fvp_ubl_license:
-        context["fvp_ubl_license"] = options.fvp_ubl_license
-
-    device_dict = options.device.device_dict(context)
-    LOG.debug("device dictionary")
-    LOG.debug(device_dict)
-
-    (tmpdir / "definition.yaml").write_text(definition, encoding="utf-8")
-    (tmpdir / "device.yaml").write_text(device_dict, encoding="utf-8")
-
-    # Render the dispatcher.yaml
-    (tmpdir / "dispatcher").mkdir()
-    dispatcher = (
-        templates.dispatchers()
-        .get_template("dispatcher.yaml.jinja2")
-        .render(prefix=tmpdir.name)
+def run(
+    options,
+    tmpdir: Path,
+    cache_dir: Optional[Path],
+    artefacts: dict,
+    prefetch: Prefetch,
+) -> int:
+    tux_boot_args = (
+        " ".join(shlex.split(options.boot_args)) if options.boot_args else None
     )
-    LOG.debug("dispatcher config")
-    LOG.debug(dispatcher)
-    (tmpdir / "dispatcher.yaml").write_text(dispatcher, encoding="utf-8")
-
-    # Add extra assets from device
-    extra_assets.extend(options.device.extra_assets(**def_arguments))
 
-    # Use a container runtime
+    # Prepare the container runtime while the assets are downloaded
     runtime = Runtime.select(options.runtime)()
     runtime.name(tmpdir.name)
     runtime.image(options.image)
-
     runtime.bind(tmpdir)
-    for path in [
-        options.ap_romfw,
-        options.bios,
-        options.bl1,
-        options.dtb,
-        options.fip,
-        options.kernel,
-        options.mcp_fw,
-        options.mcp_romfw,
-        options.rootfs,
-        options.scp_fw,
-        options.scp_romfw,
-        options.ssh_identity_file,
-        options.uefi,
-    ] + extra_assets:
-        ro = True
-        if isinstance(path, tuple):
-            (path, ro) = path
-        if not path:
-            continue
-        if urlparse(path).scheme == "file":
-            runtime.bind(path[7:], ro=ro)
-
-    if options.qemu_binary:
-        overlay_qemu(options.qemu_binary, tmpdir, runtime)
-
-    # Forward the signal to the runtime
-    def handler(*_):
-        LOG.debug("Signal received")
-        runtime.kill()
-
-    signal.signal(signal.SIGHUP, handler)
-    signal.signal(signal.SIGINT, handler)
-    signal.signal(signal.SIGQUIT, handler)
-    signal.signal(signal.SIGTERM, handler)
-    signal.signal(signal.SIGUSR1, handler)
-    signal.signal(signal.SIGUSR2, handler)
-
-    # Set the overall timeout
-    signal.signal(signal.SIGALRM, handler)
-    LOG.debug("Job timeout %ds", job_timeout)
-    signal.alarm(job_timeout)
-
-    # start the pre_run command
-    if options.device.flag_use_pre_run_cmd or options.qemu_image:
-        LOG.debug("Pre run command")
-        runtime.bind(tmpdir / "dispatcher" / "tmp", "/var/lib/lava/dispatcher/tmp")
-        (tmpdir / "dispatcher" / "tmp").mkdir()
-        runtime.pre_run(tmpdir)
-
-    # Build the lava-run arguments list
-    args = [
-        "lava-run",
-        "--device",
-        str(tmpdir / "device.yaml"),
-        "--dispatcher",
-        str(tmpdir / "dispatcher.yaml"),
-        "--job-id",
-        "1",
-        "--output-dir",
-        "output",
-        str(tmpdir / "definition.yaml"),
-    ]
 
-    results = Results(options.tests, artefacts)
-    hacking_session = bool("hacking-session" in t.name for t in options.tests)
-    # Start the writer (stdout or log-file)
-    with Writer(
-        options.log_file,
-        options.log_file_html,
-        options.log_file_text,
-        options.log_file_yaml,
-    ) as writer:
-        # Start the runtime
-        with runtime.run(args):
-            for line in runtime.lines():
-                writer.write(line)
-                res = results.parse(line)
-                # Start an xterm if an hacking session url is available
-                if hacking_session and res:
-                    run_hacking_sesson(*res)
-
-    runtime.post_run()
-    if options.results:
-        if str(options.results) == "-":
-            sys.stdout.write(json.dumps(results.data) + "\n")
-        else:
-            options.results.write_text(json.dumps(results.data))
-    if options.metadata:
-        if str(options.metadata) == "-":
-            sys.stdout.write(json.dumps(results.metadata) + "\n")
-        else:
-            options.metadata.write_text(json.dumps(results.metadata))
+    results: Optional[Results] = None
+    # The runtime is cleaned up whatever happens once it was prepared
+    try:
+        # start the pre_run command
+        if options.device.flag_use_pre_run_cmd or options.qemu_image:
+            LOG.debug("Pre run command")
+            runtime.bind(tmpdir / "dispatcher" / "tmp", "/var/lib/lava/dispatcher/tmp")
+            (tmpdir / "dispatcher" / "tmp").mkdir(parents=True)
+            runtime.pre_run(tmpdir)
+
+        prefetch.wait()
+        use_prefetched(options, prefetch)
+
+        # Render the job definition and device dictionary
+        extra_assets = []
+        overlays = []
+
+        if options.modules:
+            overlays.append(("modules", options.modules[0], options.modules[1]))
+            extra_assets.append(options.modules[0])
+
+        # When using --shared without any arguments, point to cache_dir
+        if options.shared is not None:
+            if not options.shared:
+                assert cache_dir
+                options.shared = [str(cache_dir), "/mnt/tuxrun"]
+            extra_assets.append(("file://" + options.shared[0], False))
+
+        for index, item in enumerate(options.overlays):
+            overlays.append((f"overlay-{index:02}", item[0], item[1]))
+            extra_assets.append(item[0])
+
+        # Add test definitions only when needed
+        test_definitions = None
+        if "test-definitions" in prefetch:
+            test_definitions = prefetch.result("test-definitions")
+            extra_assets.append(test_definitions)
+
+        # Add extra assets from parameters
+        for k, v in options.parameters.items():
+            if v.startswith("file://"):
+                extra_assets.append(v)
+
+        commands = " ".join([shlex.quote(s) for s in options.commands])
+
+        def_arguments = {
+            "bios": options.bios,
+            "bl1": options.bl1,
+            "commands": commands,
+            "device": options.device,
+            "qemu_image": options.qemu_image,
+            "dtb": options.dtb,
+            "kernel": options.kernel,
+            "ap_romfw": options.ap_romfw,
+            "mcp_fw": options.mcp_fw,
+            "mcp_romfw": options.mcp_romfw,
+            "fip": options.fip,
+            "enable_kvm": options.enable_kvm,
+            "enable_trustzone": options.enable_trustzone,
+            "enable_network": options.enable_network,
+            "overlays": overlays,
+            "prompt": options.prompt,
+            "rootfs": options.rootfs,
+            "rootfs_partition": options.partition,
+            "shared": options.shared,
+            "scp_fw": options.scp_fw,
+            "scp_romfw": options.scp_romfw,
+            "ssh_host": options.ssh_host,
+            "ssh_prompt": options.ssh_prompt,
+            "ssh_port": options.ssh_port,
+            "ssh_user": options.ssh_user,
+            "tests": options.tests,
+            "test_definitions": test_definitions,
+            "tests_timeout": sum(t.timeout for t in options.tests),
+            "timeouts": options.timeouts,
+            "tmpdir": tmpdir,
+            "tux_boot_args": tux_boot_args,
+            "tux_prompt": options.prompt,
+            "parameters": options.parameters,
+            "uefi": options.uefi,
+            "boot_args": options.boot_args,
+            "secrets": options.secrets,
+        }
+        definition = options.device.definition(**def_arguments)
+        LOG.debug("job definition")
+        LOG.debug(definition)
+
+        job_definition = yaml_load(definition)
+        job_timeout = (job_definition["timeouts"]["job"]["minutes"] + 1) * 60
+        context = job_definition.get("context", {})
+        if options.fvp_ubl_license:
+            context["fvp_ubl_license"] = options.fvp_ubl_license
+
+        device_dict = options.device.device_dict(context)
+        LOG.debug("device dictionary")
+        LOG.debug(device_dict)
+
+        (tmpdir / "definition.yaml").write_text(definition, encoding="utf-8")
+        (tmpdir / "device.yaml").write_text(device_dict, encoding="utf-8")
+
+        # Serve the LAVA downloads from the assets cache
+        proxy = None
+        if options.cache_proxy:
+            proxy = CacheProxy(runtime)
+
+        # Render the dispatcher.yaml
+        (tmpdir / "dispatcher").mkdir(exist_ok=True)
+        dispatcher = (
+            templates.dispatchers()
+            .get_template("dispatcher.yaml.jinja2")
+            .render(
+                prefix=tmpdir.name,
+                http_url_format_string=proxy.url_format_string if proxy else None,
+            )
+        )
+        LOG.debug("dispatcher config")
+        LOG.debug(dispatcher)
+        (tmpdir / "dispatcher.yaml").write_text(dispatcher, encoding="utf-8")
+
+        # Add extra assets from device
+        extra_assets.extend(options.device.extra_assets(**def_arguments))
+
+        bound = set()
+        for path in [
+            options.ap_romfw,
+            options.bios,
+            options.bl1,
+            options.dtb,
+            options.fip,
+            options.kernel,
+            options.mcp_fw,
+            options.mcp_romfw,
+            options.rootfs,
+            options.scp_fw,
+            options.scp_romfw,
+            options.ssh_identity_file,
+            options.uefi,
+        ] + extra_assets:
+            ro = True
+            if isinstance(path, tuple):
+                (path, ro) = path
+            if not path:
+                continue
+            # The same cached asset might be used more than once
+            if urlparse(path).scheme == "file" and path[7:] not in bound:
+                bound.add(path[7:])
+                runtime.bind(path[7:], ro=ro)
+
+        if options.qemu_binary:
+            overlay_qemu(options.qemu_binary, tmpdir, runtime)
+
+        # Forward the signal to the runtime
+        def handler(*_):
+            LOG.debug("Signal received")
+            runtime.kill()
+
+        signal.signal(signal.SIGHUP, handler)
+        signal.signal(signal.SIGINT, handler)
+        signal.signal(signal.SIGQUIT, handler)
+        signal.signal(signal.SIGTERM, handler)
+        signal.signal(signal.SIGUSR1, handler)
+        signal.signal(signal.SIGUSR2, handler)
+
+        # Set the overall timeout
+        signal.signal(signal.SIGALRM, handler)
+        LOG.debug("Job timeout %ds", job_timeout)
+        signal.alarm(job_timeout)
+
+        # Build the lava-run arguments list
+        args = [
+            "lava-run",
+            "--device",
+            str(tmpdir / "device.yaml"),
+            "--dispatcher",
+            str(tmpdir / "dispatcher.yaml"),
+            "--job-id",
+            "1",
+            "--output-dir",
+            "output",
+            str(tmpdir / "definition.yaml"),
+        ]
+
+        digests = asset_digests(artefacts)
+        decompression = decompression_stats(options)
+        stream = None
+        if options.results_ndjson:
+            stream = ResultsStream(
+                options.results_ndjson,
+                options.tests,
+                artefacts,
+                digests,
+                decompression,
+                DOWNLOADS,
+            )
+        results = Results(
+            options.tests, artefacts, digests, decompression, DOWNLOADS, stream
+        )
+        # Start the writer (stdout or log-file)
+        with Writer(
+            options.log_file,
+            options.log_file_html,
+            options.log_file_text,
+            options.log_file_yaml,
+            options.log_file_html_pages,
+            options.log_collapse,
+        ) as writer:
+            # Every line is decoded once and dispatched to each consumer
+            pipeline = Pipeline()
+            pipeline.register(writer.consume)
+            pipeline.register(results.consume)
+            # Start an xterm if an hacking session url is available
+            if any("hacking-session" in t.name for t in options.tests):
+                pipeline.register(run_hacking_sesson)
+
+            # Start the runtime
+            try:
+                with proxy or contextlib.nullcontext(), runtime.run(args):
+                    pipeline.run(runtime.lines(), options.log_queue_size)
+            finally:
+                if stream is not None:
+                    stream.close()
+    except BaseException:
+        if results is not None:
+            results.close()
+        raise
+    finally:
+        runtime.post_run()
+
+    try:
+        if "queue" in pipeline.stats:
+            results.metadata["pipeline"] = pipeline.stats
+        if options.results:
+            if str(options.results) == "-":
+                sys.stdout.write(json.dumps(results.data) + "\n")
+            else:
+                options.results.write_text(json.dumps(results.data))
+        if options.metadata:
+            if str(options.metadata) == "-":
+                sys.stdout.write(json.dumps(results.metadata) + "\n")
+            else:
+                options.metadata.write_text(json.dumps(results.metadata))
+        ret = results.ret()
+    finally:
+        results.close()
 
     if options.lava_definition and cache_dir:
         (cache_dir / "definition.yaml").write_text(
@@ -381,9 +541,7 @@ def run(options, tmpdir: Path, cache_dir: Optional[Path], artefacts: dict) -> in
     # Run results-hooks only if everything was successful
     if cache_dir:
         print(f"TuxRun outputs saved to {cache_dir}")
-    return max([runtime.ret(), results.ret()]) or run_hooks(
-        options.results_hooks, cache_dir
-    )
+    return max([runtime.ret(), ret]) or run_hooks(options.results_hooks, cache_dir)
 
 
 def main() -> int:
@@ -442,21 +600,37 @@ def main() -> int:
             ]
         ):
             cache_dir = get_new_output_dir(options.cache_dir)
+            ext = ""
+            if options.save_outputs_compression:
+                ext = "." + options.save_outputs_compression
             if options.log_file is None:
                 options.log_file = cache_dir / "logs"
             if options.log_file_html is None:
-                options.log_file_html = cache_dir / "logs.html"
+                options.log_file_html = cache_dir / f"logs.html{ext}"
             if options.log_file_text is None:
-                options.log_file_text = cache_dir / "logs.txt"
+                options.log_file_text = cache_dir / f"logs.txt{ext}"
             if options.log_file_yaml is None:
-                options.log_file_yaml = cache_dir / "logs.yaml"
+                options.log_file_yaml = cache_dir / f"logs.yaml{ext}"
             if options.metadata is None:
                 options.metadata = cache_dir / "metadata.json"
             if options.results is None:
                 options.results = cache_dir / "results.json"
+            if options.results_ndjson is None:
+                options.results_ndjson = cache_dir / "results.ndjson"
     elif options.log_file is None:
         options.log_file = "-"
 
+    for path in [
+        options.log_file,
+        options.log_file_html,
+        options.log_file_text,
+        options.log_file_yaml,
+    ]:
+        if path is not None and not Sink.supported(path):
+            parser.error(f"python3-zstandard is required to write '{path}'")
+    if options.log_file_html_pages and str(options.log_file_html) in ["-", "None"]:
+        parser.error("argument --log-file-html-pages requires an HTML log file")
+
     if not options.device:
         parser.error("argument --device is required")
 
@@ -487,27 +661,40 @@ def main() -> int:
 
     artefacts = filter_artefacts(options)
 
-    # Download only after the device has been found
-    if options.device.flag_cache_rootfs:
-        options.rootfs = pathurlnone(
-            get_rootfs(
-                options.device,
-                options.rootfs,
-                ProgressIndicator.get("Downloading root filesystem"),
-            )
-        )
+    assets.OFFLINE = options.offline
+    if options.asset_manifest:
+        try:
+            assets.MANIFEST.update(load_manifest(options.asset_manifest))
+        except InvalidArgument as exc:
+            parser.error(str(exc))
+
+    # Download only after the device has been found. The downloads run in
+    # the background while the runtime is prepared.
+    prefetch = Prefetch(
+        prefetch_jobs(options), ProgressIndicator.get("Downloading assets")
+    )
 
     # Create the temp directory
     tmpdir = Path(tempfile.mkdtemp(prefix="tuxrun-"))
     LOG.debug(f"temporary directory: '{tmpdir}'")
     try:
-        return run(options, tmpdir, cache_dir, artefacts)
+        return run(options, tmpdir, cache_dir, artefacts, prefetch)
+    except InvalidArgument as exc:
+        # Missing asset with --offline or not matching the manifest
+        parser.error(str(exc))
     except Exception as exc:
         LOG.error("Raised an exception %s", exc)
         raise
     finally:
         with contextlib.suppress(FileNotFoundError, PermissionError):
             shutil.rmtree(tmpdir)
+        # Nothing may write into the cache while the manifest and the garbage
+        # collector read it
+        prefetch.cancel()
+        if options.asset_manifest:
+            write_manifest(options.asset_manifest)
+        if options.cache_size is not None:
+            cache_gc(options.cache_size)
 
 
 def start():
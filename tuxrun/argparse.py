@@ -6,16 +6,29 @@
 # SPDX-License-Identifier: MIT
 
 import argparse
+import fnmatch
+import re
 import sys
+from functools import partial
 from pathlib import Path
 
 from tuxrun import __version__
-from tuxrun.assets import get_rootfs, get_test_definitions
+from tuxrun.assets import (
+    Prefetch,
+    cache_gc,
+    cache_stats,
+    get_rootfs,
+    get_test_definitions,
+    wait_refreshes,
+)
 from tuxrun.devices import Device
 from tuxrun.tests import Test
 from tuxrun.tuxmake import TuxBuildBuild, TuxMakeBuild
 from tuxrun.utils import ProgressIndicator, pathurlnone
 
+# Concurrent downloads for --update-cache
+UPDATE_CACHE_WORKERS = 4
+
 
 ###########
 # Helpers #
@@ -31,14 +44,23 @@ def filter_options(options):
         "qemu_image",
         "qemu_binary",
         "cache_dir",
+        "cache_proxy",
+        "cache_size",
+        "offline",
+        "asset_manifest",
         "save_outputs",
+        "save_outputs_compression",
+        "log_collapse",
         "log_file",
         "log_file_html",
+        "log_file_html_pages",
         "log_file_text",
         "log_file_yaml",
+        "log_queue_size",
         "metadata",
         "results",
         "results_hooks",
+        "results_ndjson",
         "shell",
         "debug",
         "lava_definition",
@@ -74,6 +96,44 @@ def tuxbuild_url(s):
         raise argparse.ArgumentTypeError(str(e))
 
 
+def positive_int(s):
+    try:
+        n = int(s)
+    except ValueError:
+        n = 0
+    if n <= 0:
+        raise argparse.ArgumentTypeError("should be a positive integer")
+    return n
+
+
+def html_pages(s):
+    if s == "suite":
+        return s
+    try:
+        return positive_int(s)
+    except argparse.ArgumentTypeError:
+        raise argparse.ArgumentTypeError("should be a positive integer or 'suite'")
+
+
+def size(s):
+    m = re.match(r"^(\d+)\s*([KMGT]?)(i?B)?$", s.strip(), re.IGNORECASE)
+    if m is None:
+        raise argparse.ArgumentTypeError("should be a size like 500M or 20G")
+    if not m[2]:
+        return int(m[1])
+    return int(m[1]) * 1024 ** ("KMGT".index(m[2].upper()) + 1)
+
+
+def human_size(n):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if n < 1024:
+            break
+        n /= 1024
+    else:
+        unit = "TiB"
+    return f"{n:.1f} {unit}" if unit != "B" else f"{n} B"
+
+
 def tuxmake_directory(s):
     try:
         return TuxMakeBuild(s)
@@ -172,20 +232,71 @@ class UpdateCacheAction(argparse.Action):
     def __init__(
         self, option_strings, help, dest=argparse.SUPPRESS, default=argparse.SUPPRESS
     ):
-        super().__init__(option_strings, dest=dest, default=default, nargs=0, help=help)
+        super().__init__(
+            option_strings,
+            dest=dest,
+            default=default,
+            nargs="*",
+            metavar="DEVICE",
+            help=help,
+        )
 
     def __call__(self, parser, namespace, values, option_string=None):
+        devices = [
+            d
+            for d in Device.list()
+            if d.flag_cache_rootfs
+            and (not values or any(fnmatch.fnmatch(d.name, v) for v in values))
+        ]
+        if values and not devices:
+            parser.error(f"no device matching {' '.join(values)}")
+
+        jobs = {}
         print("Updating local cache:")
         print("* Rootfs:")
-        for device in [d for d in Device.list() if d.flag_cache_rootfs]:
+        for device in devices:
             print(f"  * {device.name}")
-            get_rootfs(
-                device, progress=ProgressIndicator.get("Downloading root filesystem")
+            # Revalidate the stale entries right away
+            jobs[device.name] = partial(
+                get_rootfs,
+                device,
+                "",
+                decompress=device.flag_decompress_assets,
+                refresh=True,
             )
         print("* Test definitions")
-        get_test_definitions(
-            progress=ProgressIndicator.get("Downloading test definitions")
+        jobs["test-definitions"] = partial(get_test_definitions, refresh=True)
+
+        prefetch = Prefetch(
+            jobs, ProgressIndicator.get("Downloading assets"), UPDATE_CACHE_WORKERS
         )
+        prefetch.wait()
+        wait_refreshes()
+        parser.exit()
+
+
+class CacheGcAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        (evicted, freed) = cache_gc(values)
+        print(f"Evicted {evicted} entries, freed {human_size(freed)}")
+        parser.exit()
+
+
+class CacheStatsAction(argparse.Action):
+    def __init__(
+        self, option_strings, help, dest=argparse.SUPPRESS, default=argparse.SUPPRESS
+    ):
+        super().__init__(option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        stats = cache_stats()
+        print(f"Entries:          {stats['entries']}")
+        print(f"Size:             {human_size(stats['size'])}")
+        print(f"Hits:             {stats['hits']}")
+        print(f"Downloads:        {stats['downloads']}")
+        print(f"Hit rate:         {100 * stats['hit_rate']:.1f}%")
+        print(f"Bytes saved:      {human_size(stats['bytes_saved'])}")
+        print(f"Bytes downloaded: {human_size(stats['bytes_downloaded'])}")
         parser.exit()
 
 
@@ -209,7 +320,46 @@ def setup_parser() -> argparse.ArgumentParser:
 
     group = parser.add_argument_group("cache")
     group.add_argument(
-        "--update-cache", action=UpdateCacheAction, help="Update assets cache"
+        "--update-cache",
+        action=UpdateCacheAction,
+        help="Update assets cache, for all the devices or the ones matching the given globs",
+    )
+    group.add_argument(
+        "--cache-size",
+        default=None,
+        metavar="SIZE",
+        type=size,
+        help="Evict the least recently used assets when the cache is larger than SIZE",
+    )
+    group.add_argument(
+        "--cache-gc",
+        dest=argparse.SUPPRESS,
+        metavar="SIZE",
+        action=CacheGcAction,
+        type=size,
+        help="Evict the least recently used assets until the cache is smaller than SIZE",
+    )
+    group.add_argument(
+        "--cache-stats", action=CacheStatsAction, help="Print assets cache statistics"
+    )
+    group.add_argument(
+        "--cache-proxy",
+        default=False,
+        action="store_true",
+        help="Serve the LAVA http downloads from the assets cache",
+    )
+    group.add_argument(
+        "--offline",
+        default=False,
+        action="store_true",
+        help="Only use the cached assets, failing when one is missing",
+    )
+    group.add_argument(
+        "--asset-manifest",
+        default=None,
+        metavar="FILE",
+        type=Path,
+        help="Use the assets pinned in FILE (JSON) and pin the new ones",
     )
 
     group = parser.add_argument_group("artefacts")
@@ -432,15 +582,51 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Automatically save every outputs",
     )
+    group.add_argument(
+        "--save-outputs-compression",
+        default=None,
+        choices=["gz", "zst"],
+        help="Compress the html, text and yaml logs saved by --save-outputs",
+    )
     group.add_argument("--log-file", default=None, type=Path, help="Store logs to file")
     group.add_argument(
-        "--log-file-html", default=None, type=Path, help="Store logs to file as HTML"
+        "--log-file-html",
+        default=None,
+        type=Path,
+        help="Store logs to file as HTML, compressed when ending with .gz or .zst",
+    )
+    group.add_argument(
+        "--log-file-html-pages",
+        default=None,
+        metavar="LINES|suite",
+        type=html_pages,
+        help="Split the HTML logs into pages of LINES lines or one page per test suite. The HTML log file becomes an index of the pages and results",
+    )
+    group.add_argument(
+        "--log-file-text",
+        default=None,
+        type=Path,
+        help="Store logs to file as text, compressed when ending with .gz or .zst",
     )
     group.add_argument(
-        "--log-file-text", default=None, type=Path, help="Store logs to file as text"
+        "--log-file-yaml",
+        default=None,
+        type=Path,
+        help="Store logs to file as YAML, compressed when ending with .gz or .zst",
+    )
+    group.add_argument(
+        "--log-collapse",
+        default=0,
+        metavar="LINES",
+        type=positive_int,
+        help="Collapse the lines repeated by blocks of up to LINES lines in the text and HTML logs",
     )
     group.add_argument(
-        "--log-file-yaml", default=None, type=Path, help="Store logs to file as YAML"
+        "--log-queue-size",
+        default=0,
+        metavar="LINES",
+        type=positive_int,
+        help="Read the logs in a background thread, buffering up to LINES lines while the outputs are written",
     )
     group.add_argument(
         "--metadata", default=None, type=Path, help="Save test metadata to file (JSON)"
@@ -456,6 +642,12 @@ def setup_parser() -> argparse.ArgumentParser:
     group.add_argument(
         "--results", default=None, type=Path, help="Save test results to file (JSON)"
     )
+    group.add_argument(
+        "--results-ndjson",
+        default=None,
+        type=Path,
+        help="Append each test result to file as soon as it is known (NDJSON)",
+    )
     group.add_argument(
         "--lava-definition",
         default=False,
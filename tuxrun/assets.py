@@ -4,92 +4,1121 @@
 #
 # SPDX-License-Identifier: MIT
 
+import contextlib
+import contextvars
+import fcntl
+import hashlib
+import io
+import json
+import logging
 import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
 import time
+from concurrent import futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 from urllib.parse import urlparse
 
 import requests
+from requests.packages import urllib3  # type: ignore
 
+from tuxrun.decompress import Decompressor
+from tuxrun.exceptions import InvalidArgument
 from tuxrun.requests import requests_get
-from tuxrun.utils import NoProgressIndicator, ProgressIndicator, pathurlnone
+from tuxrun.utils import (
+    AggregateProgressIndicator,
+    NoProgressIndicator,
+    ProgressIndicator,
+    compression,
+    pathurlnone,
+)
 from tuxrun.xdg import get_cache_dir
 
+LOG = logging.getLogger("tuxrun")
+
+# Root of the assets cache, resolved once by Prefetch so that its threads
+# keep using the same cache, see assets_dir
+ASSETS_DIR: contextvars.ContextVar[Path] = contextvars.ContextVar("ASSETS_DIR")
+
+# Cached files used by this process, see __use__
+__IN_USE__: Dict[Path, IO] = {}
+__IN_USE_LOCK__ = threading.Lock()
+
+# Size of the blocks read when decompressing
+DECOMPRESS_CHUNK = 1024 * 1024
+
+# Statistics of the decompressions done by this process, by decompressed file
+DECOMPRESSED: Dict[str, Dict] = {}
+
+# Time during which a cached file is used without checking the server, unless
+# the server gives a max-age
+CACHE_TTL = 6 * 60 * 60
+# Once expired, a cached file is still used during this time while it is
+# revalidated in background, unless the server gives stale-while-revalidate
+STALE_WHILE_REVALIDATE = 60 * 60
+
+# Background revalidations, see wait_refreshes. tuxrun does not wait for them
+# when exiting: an interrupted revalidation only leaves a partial download,
+# resumed by the next one.
+REFRESHES: List[threading.Thread] = []
+REFRESH_TIMEOUT = 60
+
+# Attempts to complete a download, resuming the transfer with Range requests
+DOWNLOAD_ATTEMPTS = 3
+
+# The download buffer grows while the reads are faster than
+# DOWNLOAD_READ_FAST and shrinks when slower than DOWNLOAD_READ_SLOW, keeping
+# the per-chunk overhead low on fast links and the progress alive on slow ones
+DOWNLOAD_BUFFER_MIN = 64 * 1024
+DOWNLOAD_BUFFER_MAX = 8 * 1024 * 1024
+DOWNLOAD_READ_FAST = 0.02
+DOWNLOAD_READ_SLOW = 0.5
+
+# Files of at least DOWNLOAD_PARALLEL_SIZE bytes are downloaded with
+# DOWNLOAD_CONNECTIONS concurrent range requests, when the server allows it
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_PARALLEL_SIZE = 64 * 1024 * 1024
+
+# Statistics of the downloads done by this process, by url
+DOWNLOADS: Dict[str, Dict] = {}
+
+# Only use the cached assets, see --offline
+OFFLINE = False
+
+# Assets pinned by the manifest: {url: {"sha256": ...}}, see load_manifest
+MANIFEST: Dict[str, Dict] = {}
+
+# Urls of the cached assets used by this process, see write_manifest
+USED_URLS: Set[str] = set()
+
 TEST_DEFINITIONS = "https://storage.tuxboot.com/test-definitions/2024.12.tar.zst"
 
 
 def get_rootfs(
-    device, rootfs: str = "", progress: ProgressIndicator = NoProgressIndicator()
+    device,
+    rootfs: str = "",
+    progress: ProgressIndicator = NoProgressIndicator(),
+    decompress: bool = False,
+    refresh: bool = False,
+) -> str:
+    path = __download_and_cache__(
+        rootfs or device.rootfs, progress, decompress=decompress, refresh=refresh
+    )
+    if decompress:
+        return get_decompressed(path, progress)
+    return path
+
+
+def get_test_definitions(
+    progress: ProgressIndicator = NoProgressIndicator(), refresh: bool = False
+):
+    # Decompressed once for every test and every job: LAVA then only has to
+    # extract the tar archive
+    path = __download_and_cache__(
+        TEST_DEFINITIONS, progress, decompress=True, refresh=refresh
+    )
+    return pathurlnone(get_decompressed(path, progress))
+
+
+def get_asset(
+    url: str,
+    progress: ProgressIndicator = NoProgressIndicator(),
+    decompress: bool = False,
+) -> str:
+    path = __download_and_cache__(url, progress, decompress=decompress)
+    if decompress:
+        path = get_decompressed(path, progress)
+    return pathurlnone(path)
+
+
+def get_decompressed(
+    path: str, progress: ProgressIndicator = NoProgressIndicator()
 ) -> str:
-    return __download_and_cache__(rootfs or device.rootfs, progress)
+    """
+    Decompressed copy of a cached asset, shared by every job and keyed by the
+    sha256 of the compressed file. The path is returned unchanged when the
+    asset is not in the cache or cannot be decompressed.
+    """
+    ext = compression(path)[1]
+    digest = asset_index_data(Path(f"{path}.json")).get("sha256")
+    if not Decompressor.supported(ext) or not digest or not Path(path).exists():
+        return path
+
+    dst = __decompressed_path__(digest, path)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    with __lock__(dst.parent / ".lock", dst.name):
+        if dst.exists():
+            return str(dst)
+        try:
+            decompressor = Decompressor(ext, dst.parent / f".{dst.name}.tmp")
+        except (OSError, ValueError) as exc:
+            print(f"Unable to decompress '{path}': {exc}", file=sys.stderr)
+            return path
+        # The file can be replaced by a background revalidation in the
+        # meantime: check that the decompressed content matches the digest
+        sha256 = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                for chunk in iter(lambda: f.read(DECOMPRESS_CHUNK), b""):
+                    sha256.update(chunk)
+                    decompressor.write(chunk)
+                    progress.progress(100 * decompressor.consumed / size)
+        except (OSError, ValueError) as exc:
+            print(f"Unable to decompress '{path}': {exc}", file=sys.stderr)
+            decompressor.abort()
+            return path
+        progress.finish()
+        if sha256.hexdigest() != digest:
+            print(f"Unable to decompress '{path}': file modified", file=sys.stderr)
+            decompressor.abort()
+            return path
+        return __store_decompressed__(decompressor, dst, streamed=False) or path
+
+
+def __decompressed_path__(digest: str, path: str) -> Path:
+    name = re.sub(r"\.tgz$", ".tar", os.path.basename(path))
+    name = re.sub(r"\.(gz|xz|zst)$", "", name)
+    return assets_dir() / "decompressed" / digest / name
+
+
+def __store_decompressed__(decompressor, dst: Path, streamed: bool) -> str:
+    try:
+        stats = decompressor.close()
+    except (OSError, ValueError) as exc:
+        print(f"Unable to decompress '{dst.name}': {exc}", file=sys.stderr)
+        return ""
+    stats["streamed"] = streamed
+    DECOMPRESSED[str(dst)] = stats
+    os.replace(decompressor.dst, dst)
+    return str(dst)
+
+
+class Prefetch:
+    """
+    Download the assets concurrently in background threads. Each job is
+    called with its own progress indicator while the overall progress is
+    reported to the given indicator. At most `workers` jobs run at the same
+    time, when given.
+    """
+
+    def __init__(
+        self,
+        jobs: Dict[str, Callable[[ProgressIndicator], str]],
+        progress: ProgressIndicator = NoProgressIndicator(),
+        workers: Optional[int] = None,
+    ):
+        self.__progress__ = AggregateProgressIndicator(progress)
+        self.__workers__ = threading.BoundedSemaphore(workers or max(len(jobs), 1))
+        self.__futures__: Dict[str, Future] = {}
+        root = assets_dir()
+        for name, job in jobs.items():
+            future: Future = Future()
+            self.__futures__[name] = future
+            context = contextvars.copy_context()
+            context.run(ASSETS_DIR.set, root)
+            threading.Thread(
+                target=context.run,
+                args=(self.__run__, future, job, self.__progress__.child()),
+                name=f"prefetch-{name}",
+                daemon=True,
+            ).start()
+
+    def __run__(self, future, job, progress):
+        with self.__workers__:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(job(progress))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    def __contains__(self, name):
+        return name in self.__futures__
+
+    def result(self, name: str) -> str:
+        return self.__futures__[name].result()
+
+    def wait(self) -> None:
+        try:
+            for future in self.__futures__.values():
+                future.result()
+        finally:
+            self.__progress__.finish()
+
+    def cancel(self) -> None:
+        """
+        Cancel the jobs not started yet and wait for the running ones, which
+        are then done with the cache
+        """
+        for future in self.__futures__.values():
+            future.cancel()
+        try:
+            futures.wait(self.__futures__.values())
+        finally:
+            self.__progress__.finish()
+
+
+def assets_dir() -> Path:
+    try:
+        return ASSETS_DIR.get()
+    except LookupError:
+        return get_cache_dir().resolve() / "assets"
+
+
+def asset_paths(url: str):
+    """
+    Return the path of the cached asset and of its index entry
+    """
+    key = re.sub(r"[:/]", "_", url)
+    # Keep the original file name: the templates and LAVA rely on it
+    cache_dir = assets_dir() / key
+    cache = cache_dir / (os.path.basename(urlparse(url).path) or "index")
+    return (cache, cache_dir / (cache.name + ".json"))
+
+
+def __migrate__(cache_dir: Path) -> None:
+    """
+    Older versions cached the asset as a file at the place of its directory,
+    with the ETag in <key>.etag: drop them
+    """
+    if cache_dir.is_file():
+        for path in [cache_dir, cache_dir.with_name(cache_dir.name + ".etag")]:
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+
+
+def asset_index(url: str) -> Dict:
+    return asset_index_data(asset_paths(url)[1])
+
+
+def asset_index_data(index: Path) -> Dict:
+    try:
+        return json.loads(index.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def asset_digests(artefacts: Dict) -> Dict[str, str]:
+    """
+    sha256 of the cached artefacts, by url
+    """
+    urls = []
+    for value in artefacts.values():
+        if isinstance(value, str):
+            urls.append(value)
+        elif value and isinstance(value[0], str):
+            urls.append(value[0])
+        elif value:
+            urls.extend(v[0] for v in value if v)
+    digests = {}
+    for url in urls:
+        digest = asset_index(url).get("sha256")
+        if digest:
+            digests[url] = digest
+    return digests
+
+
+def load_manifest(path: Path) -> Dict[str, Dict]:
+    """
+    Read the assets pinned by a manifest. A missing manifest is empty.
+    """
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as exc:
+        raise InvalidArgument(f"Invalid asset manifest '{path}': {exc}")
+    manifest = data.get("assets") if isinstance(data, dict) else None
+    if not isinstance(manifest, dict) or not all(
+        isinstance(v, dict) and v.get("sha256") for v in manifest.values()
+    ):
+        raise InvalidArgument(f"Invalid asset manifest '{path}'")
+    return manifest
+
+
+def write_manifest(path: Path) -> None:
+    """
+    Pin the assets used by this process, keeping the other entries
+    """
+    manifest = dict(MANIFEST)
+    for url in USED_URLS:
+        (cache, index) = asset_paths(url)
+        data = asset_index_data(index)
+        if data.get("sha256") and cache.exists():
+            manifest[url] = {
+                "sha256": data["sha256"],
+                "size": data.get("size"),
+                "path": str(cache),
+            }
+    if manifest == MANIFEST and path.exists():
+        return
+    (fd, tmp) = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"version": 1, "assets": manifest}, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+def __store__(path: Path, digest: str, cache: Path) -> None:
+    """
+    Move the downloaded file to the objects store and link it to the cache
+    """
+    obj = cache.parent.parent / "objects" / digest
+    if obj.exists():
+        # Same content already downloaded from another url
+        path.unlink()
+        os.utime(obj)
+    else:
+        os.replace(path, obj)
+    __link__(obj, cache)
+
+
+def __link__(obj: Path, cache: Path) -> None:
+    tmp = cache.parent / f".{cache.name}.tmp"
+    with contextlib.suppress(FileNotFoundError):
+        tmp.unlink()
+    try:
+        os.link(obj, tmp)
+    except OSError:
+        shutil.copyfile(obj, tmp)
+    os.replace(tmp, cache)
+
+
+def __part_etag__(part: Path) -> str:
+    """
+    ETag of the partial download, if any
+    """
+    if not part.exists():
+        return ""
+    try:
+        meta = json.loads(part.with_name(part.name + ".json").read_text("utf-8"))
+        return meta["etag"]
+    except (OSError, ValueError, KeyError):
+        return ""
+
+
+def __total_size__(response) -> int:
+    if response.status_code == 206:
+        # Content-Range: bytes <start>-<end>/<total>
+        size = str(response.headers.get("Content-Range", "")).rpartition("/")[2]
+    else:
+        size = str(response.headers.get("Content-Length", ""))
+    return int(size) if size.isdigit() else 0
+
+
+def __update_index__(index: Path, hit: bool, **values) -> None:
+    """
+    Update the index entry and the access statistics used by the garbage
+    collector
+    """
+    try:
+        data = json.loads(index.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        if hit:
+            return
+        data = {}
+    data.update(values)
+    key = "hits" if hit else "downloads"
+    data[key] = data.get(key, 0) + 1
+    data["last_used"] = time.time()
+    __write_index__(index, data)
+
+
+def __write_index__(index: Path, data: Dict) -> None:
+    # Atomic update: the index is read without any lock
+    (fd, tmp) = tempfile.mkstemp(dir=index.parent, prefix=f".{index.name}.")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(json.dumps(data))
+    os.replace(tmp, index)
+
+
+def __use__(cache: Path) -> None:
+    """
+    Shared lock on the entry, kept until tuxrun exits
+    """
+    with __IN_USE_LOCK__:
+        if cache in __IN_USE__:
+            return
+        f = (cache.parent / f".{cache.name}.use").open("a")
+        fcntl.flock(f, fcntl.LOCK_SH)
+        __IN_USE__[cache] = f
+
+
+def cache_size() -> int:
+    """
+    Size of the cache in bytes: the content, the partial downloads and the
+    decompressed files
+    """
+    assets = assets_dir()
+    size = sum(o.stat().st_size for o in (assets / "objects").glob("*"))
+    size += sum(p.stat().st_size for p in assets.glob("*/.*.part"))
+    # The decompressed files are sparse
+    return size + sum(
+        d.stat().st_blocks * 512 for d in assets.glob("decompressed/*/[!.]*")
+    )
+
+
+def __remove_decompressed__(digest: str) -> int:
+    path = assets_dir() / "decompressed" / digest
+    if not path.exists():
+        return 0
+    freed = sum(f.stat().st_blocks * 512 for f in path.iterdir())
+    shutil.rmtree(path, ignore_errors=True)
+    return freed
+
+
+def __evict__(index: Path) -> Optional[int]:
+    """
+    Remove the cached file of the given index entry, unless it is in use.
+    Return the number of bytes freed or None when the entry is in use.
+    """
+    name = index.name[: -len(".json")]
+    objects = index.parent.parent / "objects"
+    with (index.parent / f".{name}.use").open("a") as use:
+        try:
+            fcntl.flock(use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            LOG.debug("Keeping %s: in use", index.parent.name)
+            return None
+        freed = 0
+        digest = asset_index_data(index).get("sha256")
+        for f in [index.parent / f".{name}.part", index.parent / name, index]:
+            with contextlib.suppress(FileNotFoundError):
+                st = f.stat()
+                f.unlink()
+                if f.name.endswith(".part"):
+                    freed += st.st_size
+        with contextlib.suppress(FileNotFoundError):
+            (index.parent / f".{name}.part.json").unlink()
+        # Remove the content once no url refers to it
+        if digest:
+            with contextlib.suppress(FileNotFoundError):
+                st = (objects / digest).stat()
+                if st.st_nlink == 1:
+                    (objects / digest).unlink()
+                    freed += st.st_size + __remove_decompressed__(digest)
+        return freed
+
+
+def cache_gc(limit: int) -> Tuple[int, int]:
+    """
+    Evict the least recently used entries until the cache is smaller than
+    limit bytes. Entries in use by a running tuxrun are kept. Return the
+    number of evicted entries and the number of bytes freed.
+    """
+    assets = assets_dir()
+    objects = assets / "objects"
+    if not objects.exists():
+        return (0, 0)
+
+    freed = 0
+    # Objects left behind by an interrupted store
+    for obj in objects.iterdir():
+        st = obj.stat()
+        if st.st_nlink == 1 and time.time() - st.st_mtime > 60 * 60:
+            obj.unlink()
+            freed += st.st_size + __remove_decompressed__(obj.name)
+
+    size = cache_size()
+    evicted = 0
+    indexes = sorted(
+        assets.glob("*/[!.]*.json"),
+        key=lambda i: asset_index_data(i).get("last_used", 0),
+    )
+    for index in indexes:
+        if size <= limit:
+            break
+        n = __evict__(index)
+        if n is not None:
+            evicted += 1
+            size -= n
+            freed += n
+    return (evicted, freed)
+
+
+def cache_stats() -> Dict:
+    hits = downloads = saved = downloaded = entries = 0
+    for index in assets_dir().glob("*/[!.]*.json"):
+        data = asset_index_data(index)
+        entries += 1
+        hits += data.get("hits", 0)
+        downloads += data.get("downloads", 0)
+        saved += data.get("hits", 0) * data.get("size", 0)
+        downloaded += data.get("downloads", 0) * data.get("size", 0)
+    return {
+        "entries": entries,
+        "size": cache_size(),
+        "hits": hits,
+        "downloads": downloads,
+        "hit_rate": hits / (hits + downloads) if hits + downloads else 0.0,
+        "bytes_saved": saved,
+        "bytes_downloaded": downloaded,
+    }
+
+
+class __Stream__:
+    """
+    Decompress an asset while it is downloaded. Errors are not fatal: the
+    asset is then decompressed once downloaded.
+    """
+
+    def __init__(self, ext: str, cache: Path):
+        self.ext = ext
+        self.cache = cache
+        self.decompressor: Optional[Decompressor] = None
+        self.restart()
+
+    def restart(self):
+        self.abort()
+        decompressed = assets_dir() / "decompressed"
+        decompressed.mkdir(parents=True, exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=decompressed, prefix=".tmp-")
+        os.close(fd)
+        try:
+            self.decompressor = Decompressor(self.ext, Path(tmp))
+        except (OSError, ValueError):
+            os.unlink(tmp)
+
+    def write(self, chunk: Union[bytes, memoryview]):
+        if self.decompressor is None:
+            return
+        try:
+            self.decompressor.write(chunk)
+        except (OSError, ValueError) as exc:
+            print(f"Unable to decompress '{self.cache.name}': {exc}", file=sys.stderr)
+            self.abort()
+
+    def abort(self):
+        if self.decompressor is not None:
+            self.decompressor.abort()
+            self.decompressor = None
+
+    def store(self, digest: str):
+        if self.decompressor is None:
+            return
+        dst = __decompressed_path__(digest, str(self.cache))
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with __lock__(dst.parent / ".lock", dst.name):
+            if dst.exists():
+                self.abort()
+            else:
+                __store_decompressed__(self.decompressor, dst, streamed=True)
+
+
+def __freshness__(cache: Path, index: Path) -> str:
+    """
+    "fresh", "stale" (usable while revalidated in background) or "expired"
+    """
+    if not cache.exists():
+        return "expired"
+    data = asset_index_data(index)
+    age = time.time() - data.get("checked", os.stat(cache).st_mtime)
+    ttl = data.get("ttl", CACHE_TTL)
+    if age <= ttl:
+        return "fresh"
+    if age <= ttl + data.get("swr", STALE_WHILE_REVALIDATE):
+        return "stale"
+    return "expired"
+
+
+def __cache_control__(response) -> Dict:
+    """
+    TTL and stale-while-revalidate window from the Cache-Control header
+    """
+    policy = {}
+    header = __header__(response, "Cache-Control") or ""
+    for directive in header.lower().split(","):
+        (key, _, value) = directive.strip().partition("=")
+        if key == "max-age" and value.isdigit():
+            policy["ttl"] = int(value)
+        elif key == "stale-while-revalidate" and value.isdigit():
+            policy["swr"] = int(value)
+        elif key in ["no-cache", "no-store"]:
+            policy["ttl"] = 0
+    return policy
+
+
+def __header__(response, name: str) -> Optional[str]:
+    value = response.headers.get(name)
+    return None if value is None else str(value)
+
+
+def __validator__(response) -> str:
+    """
+    ETag or Last-Modified, used to resume the downloads with If-Range
+    """
+    return __header__(response, "ETag") or __header__(response, "Last-Modified") or ""
+
+
+def __refresh__(url: str, sha256sum: str, cache: Path, index: Path) -> None:
+    try:
+        with __lock__(cache.parent / f".{cache.name}.lock", url):
+            if __freshness__(cache, index) != "fresh":
+                # Decompressed on demand by the next run: the refresh can be
+                # interrupted at any time when tuxrun exits
+                __fetch__(url, NoProgressIndicator(), sha256sum, cache, index, False)
+    except Exception as exc:
+        print(f"Unable to refresh '{url}': {exc}", file=sys.stderr)
 
 
-def get_test_definitions(progress: ProgressIndicator = NoProgressIndicator()):
-    return pathurlnone(__download_and_cache__(TEST_DEFINITIONS, progress))
+@contextlib.contextmanager
+def __lock__(path: Path, url: str):
+    """
+    Exclusive lock on the given file. The lock is released by the kernel when
+    the owner dies, so a lock left by a dead process is never stale. The lock
+    file holds the pid of the owner for the diagnostics.
+    """
+    with path.open("a+", encoding="utf-8") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.seek(0)
+            owner = f.read().strip() or "?"
+            print(f"Waiting for process {owner} downloading '{url}'", file=sys.stderr)
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            f.truncate()
+            f.write(str(os.getpid()))
+            f.flush()
+            yield
+        finally:
+            f.truncate(0)
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def __download_and_cache__(
-    url: str, progress: ProgressIndicator = NoProgressIndicator()
+    url: str,
+    progress: ProgressIndicator = NoProgressIndicator(),
+    sha256sum: str = "",
+    decompress: bool = False,
+    refresh: bool = False,
 ):
+    """
+    Return the path of the cached asset. Stale entries are revalidated in
+    background unless refresh is set.
+    """
     parsed = urlparse(url)
     if parsed.scheme not in ["http", "https"]:
         return url
 
-    key = re.sub(r"[:/]", "_", url)
+    (cache, index) = asset_paths(url)
+    __migrate__(cache.parent)
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    objects = assets_dir() / "objects"
+    objects.mkdir(parents=True, exist_ok=True)
 
-    cache_dir = get_cache_dir().resolve() / "assets"
-    cache_dir.mkdir(parents=True, exist_ok=True)
-    cache = cache_dir / key
-    cache_etag_file = cache_dir / (key + ".etag")
+    # Protect the entry from the garbage collector while tuxrun is running
+    __use__(cache)
+    USED_URLS.add(url)
 
-    expired = False
-    if cache.exists():
-        timestamp = os.stat(cache).st_mtime
-        now = time.time()
-        timeout = 6 * 60 * 60  # 6 hours
+    # Pinned assets are used without asking the server
+    sha256sum = sha256sum or MANIFEST.get(url, {}).get("sha256", "")
+    if OFFLINE or sha256sum:
+        with __lock__(cache.parent / f".{cache.name}.lock", url):
+            if __pinned__(url, cache, index, sha256sum):
+                __update_index__(index, hit=True)
+                return str(cache)
+        if OFFLINE:
+            raise InvalidArgument(
+                f"'{url}' is not in the cache"
+                + (f" with sha256 {sha256sum}" if sha256sum else "")
+                + ", unable to download it with --offline"
+            )
+    # The cached file does not match the pinned digest: download it again
+    freshness = "expired" if sha256sum else __freshness__(cache, index)
+    if freshness == "fresh":
+        __update_index__(index, hit=True)
+        return str(cache)
+    if freshness == "stale" and not refresh:
+        # Use the cached file right away and revalidate it in background
+        __update_index__(index, hit=True)
+        thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(__refresh__, url, sha256sum, cache, index),
+            name=f"refresh-{cache.name}",
+            daemon=True,
+        )
+        REFRESHES.append(thread)
+        thread.start()
+        return str(cache)
 
-        expired = (now - timestamp) > timeout
-        if not expired:
+    # Only one process (or thread) downloads a given url at a time, the others
+    # wait for the download to finish and reuse the cached file.
+    with __lock__(cache.parent / f".{cache.name}.lock", url):
+        if not sha256sum and __freshness__(cache, index) == "fresh":
+            __update_index__(index, hit=True)
             return str(cache)
+        return __fetch__(url, progress, sha256sum, cache, index, decompress)
 
-    try:
-        response = requests_get(url, allow_redirects=True, stream=True)
+
+def wait_refreshes(timeout: float = REFRESH_TIMEOUT) -> None:
+    """
+    Give the background revalidations some time to finish before exiting
+    """
+    deadline = time.monotonic() + timeout
+    for thread in REFRESHES:
+        thread.join(max(deadline - time.monotonic(), 0))
+    REFRESHES[:] = [t for t in REFRESHES if t.is_alive()]
+
+
+def __pinned__(url: str, cache: Path, index: Path, sha256sum: str) -> bool:
+    """
+    Whether the cached file matches the digest, linking it from the objects
+    store when the same content was cached for another url
+    """
+    if cache.exists() and (
+        not sha256sum or asset_index_data(index).get("sha256") == sha256sum
+    ):
+        return True
+    obj = cache.parent.parent / "objects" / sha256sum
+    if not sha256sum or not obj.exists():
+        return False
+    __link__(obj, cache)
+    # Unknown validators: revalidated by the next unpinned use
+    __write_index__(
+        index,
+        {
+            "url": url,
+            "etag": None,
+            "last_modified": None,
+            "sha256": sha256sum,
+            "size": obj.stat().st_size,
+            "checked": 0,
+            "last_used": time.time(),
+        },
+    )
+    return True
+
+
+def __chunks__(response, stats: Dict) -> Iterator[memoryview]:
+    """
+    Read the body into a preallocated buffer. Each chunk is only valid until
+    the next one is read.
+    """
+    raw = getattr(response, "raw", None)
+    encoding = __header__(response, "Content-Encoding")
+    if not isinstance(raw, io.IOBase) or encoding not in [None, "identity"]:
+        # Let requests decode the content
+        stats["buffer"] = DOWNLOAD_BUFFER_MIN
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_BUFFER_MIN):
+            yield memoryview(chunk)
+        return
+
+    buffer = memoryview(bytearray(DOWNLOAD_BUFFER_MAX))
+    size = DOWNLOAD_BUFFER_MIN
+    while True:
+        start = time.monotonic()
+        try:
+            n = raw.readinto(buffer[:size])  # type: ignore
+        except urllib3.exceptions.HTTPError as exc:
+            raise requests.ConnectionError(exc)
+        elapsed = time.monotonic() - start
+        if not n:
+            return
+        stats["buffer"] = max(stats.get("buffer", 0), size)
+        yield buffer[:n]
+        if n == size and elapsed < DOWNLOAD_READ_FAST:
+            size = min(size * 2, DOWNLOAD_BUFFER_MAX)
+        elif elapsed > DOWNLOAD_READ_SLOW:
+            size = max(size // 2, DOWNLOAD_BUFFER_MIN)
+
+
+def __parallel__(response, size: int, etag: str) -> bool:
+    return (
+        DOWNLOAD_CONNECTIONS > 1
+        and size >= DOWNLOAD_PARALLEL_SIZE
+        and response.status_code == 200
+        and __header__(response, "Accept-Ranges") == "bytes"
+        and __header__(response, "Content-Encoding") in [None, "identity"]
+        and isinstance(getattr(response, "raw", None), io.IOBase)
+        # If-Range requires a strong validator
+        and bool(etag)
+        and not etag.startswith("W/")
+    )
+
+
+def __download_ranges__(
+    url: str,
+    response,
+    part: Path,
+    size: int,
+    etag: str,
+    progress: ProgressIndicator,
+    stream: Optional[__Stream__],
+    stats: Dict,
+):
+    """
+    Download the file with concurrent range requests written at their offset
+    in the preallocated part file. The first range is read from the current
+    response. The file is hashed, and decompressed, once complete.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        part.with_name(part.name + ".json").unlink()
+    step = -(-size // DOWNLOAD_CONNECTIONS)
+    ranges = [(start, min(start + step, size)) for start in range(0, size, step)]
+    received = [0] * len(ranges)
+    lock = threading.Lock()
+    failed = threading.Event()
+
+    def fetch(index: int, start: int, end: int, first) -> int:
+        offset = start
+        current = first
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                if current is None:
+                    current = requests_get(
+                        url,
+                        stream=True,
+                        headers={
+                            "Range": f"bytes={offset}-{end - 1}",
+                            "If-Range": etag,
+                        },
+                    )
+                    current.raise_for_status()
+                    content_range = __header__(current, "Content-Range") or ""
+                    if current.status_code != 206 or not content_range.startswith(
+                        f"bytes {offset}-"
+                    ):
+                        raise requests.RequestException("range not honoured")
+                for view in __chunks__(current, stats):
+                    if failed.is_set():
+                        raise requests.RequestException("aborted")
+                    view = view[: end - offset]
+                    while view:
+                        written = os.pwrite(fd, view, offset)
+                        view = view[written:]
+                        offset += written
+                    with lock:
+                        received[index] = offset - start
+                        progress.progress(100 * sum(received) / size)
+                    if offset >= end:
+                        break
+                if offset < end:
+                    raise requests.RequestException(
+                        f"received {offset - start} of {end - start} bytes"
+                    )
+                return attempt
+            except requests.RequestException as e:
+                if attempt == DOWNLOAD_ATTEMPTS or failed.is_set():
+                    failed.set()
+                    raise
+                print(f"Resuming range of '{url}': {e}", file=sys.stderr)
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                if current is not None:
+                    current.close()
+                current = None
+        raise AssertionError("unreachable")  # pragma: no cover
+
+    with part.open("wb") as out:
+        fd = out.fileno()
+        out.truncate(size)
+        # Reserve the space up front when the file system supports it
+        with contextlib.suppress(AttributeError, OSError):
+            os.posix_fallocate(fd, 0, size)
+        with ThreadPoolExecutor(len(ranges)) as pool:
+            futures = [
+                pool.submit(fetch, index, start, end, response if index == 0 else None)
+                for (index, (start, end)) in enumerate(ranges)
+            ]
+            attempts = [future.result() for future in futures]
+
+    stats["received"] += sum(received)
+    stats["attempts"] = max(attempts)
+    stats["connections"] = len(ranges)
+    # Verify the file as a whole
+    sha256 = hashlib.sha256()
+    with part.open("rb") as f:
+        for chunk in iter(lambda: f.read(DECOMPRESS_CHUNK), b""):
+            sha256.update(chunk)
+            if stream:
+                stream.write(chunk)
+    return sha256
+
+
+def __fetch__(
+    url: str,
+    progress: ProgressIndicator,
+    sha256sum: str,
+    cache: Path,
+    index: Path,
+    decompress: bool,
+) -> str:
+    # Partial download from a previous attempt, resumed when the ETag matches
+    part = cache.parent / f".{cache.name}.part"
+    part_etag = __part_etag__(part)
+
+    # Conditional request: the server only sends the file when it changed
+    cached = asset_index(url) if cache.exists() else {}
+    if sha256sum and cached.get("sha256") != sha256sum:
+        cached = {}
+    conditions = {}
+    if cached.get("etag"):
+        conditions["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        conditions["If-Modified-Since"] = cached["last_modified"]
+
+    def get():
+        headers = dict(conditions)
+        if part_etag and part.stat().st_size:
+            headers["Range"] = f"bytes={part.stat().st_size}-"
+            headers["If-Range"] = part_etag
+        response = requests_get(url, allow_redirects=True, stream=True, headers=headers)
+        if response.status_code == 416 and "Range" in headers:
+            # Range not satisfiable: start again
+            response.close()
+            part.unlink()
+            response = requests_get(
+                url, allow_redirects=True, stream=True, headers=conditions
+            )
         response.raise_for_status()
-        etag = str(response.headers["ETag"])
-    except KeyError:
-        print("Missing ETag, continuing without cache", file=sys.stderr)
-        return url
+        return response
+
+    start = time.monotonic()
+    try:
+        response = get()
     except Exception as e:
-        if cache.exists():
+        if cache.exists() and (cached or not sha256sum):
             print(e, "Continuing with cached version of the file", file=sys.stderr)
+            __update_index__(index, hit=True)
             return str(cache)
         # return url as LAVA will check if it exists and it will show up in the logfile.
         return url
 
-    if cache_etag_file.exists():
-        cache_etag = cache_etag_file.read_text()
-    else:
-        cache_etag = None
-    if cache_etag == etag and cache.exists():
+    stats = {"latency": round(time.monotonic() - start, 3), "received": 0}
+    etag = __validator__(response)
+    if cache.exists() and (
+        response.status_code == 304 or (etag and cached.get("etag") == etag)
+    ):
+        # Not modified
         response.close()
+        __update_index__(
+            index, hit=True, checked=time.time(), **__cache_control__(response)
+        )
         return str(cache)
-    else:
-        cache_etag_file.write_text(etag)
 
-    size = int(response.headers.get("Content-Length", "0"))
+    # Decompress while downloading
+    stream = None
+    ext = compression(str(cache))[1]
+    if decompress and Decompressor.supported(ext):
+        stream = __Stream__(ext, cache)
+
     try:
-        with cache.open("wb") as data:
-            n = 0
-            for chunk in response.iter_content(chunk_size=4096):
-                n += data.write(chunk)
-                if size:
-                    progress.progress(100 * n / size)
-    except requests.RequestException as e:
-        print(f"Unable to fetch url '{url}': {e}", file=sys.stderr)
-        raise
+        size = __total_size__(response)
+        parallel = __parallel__(response, size, etag)
+        if parallel:
+            try:
+                sha256 = __download_ranges__(
+                    url, response, part, size, etag, progress, stream, stats
+                )
+                n = size
+            except requests.RequestException as e:
+                print(
+                    f"Parallel download of '{url}' failed, downloading it again: {e}",
+                    file=sys.stderr,
+                )
+                parallel = False
+                with contextlib.suppress(FileNotFoundError):
+                    part.unlink()
+                part_etag = ""
+                if stream:
+                    stream.restart()
+                response = get()
+                etag = __validator__(response) or etag
 
-    if size:
-        progress.finish()
+        if not parallel:
+            for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+                sha256 = hashlib.sha256()
+                if response.status_code == 206 and part_etag == etag:
+                    # Resume: the digest has to include the data already downloaded
+                    mode = "ab"
+                    with part.open("rb") as f:
+                        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                            sha256.update(chunk)
+                            if stream and attempt == 1:
+                                stream.write(chunk)
+                    n = part.stat().st_size
+                else:
+                    mode = "wb"
+                    n = 0
+                    if stream and attempt > 1:
+                        stream.restart()
+                    part.with_name(part.name + ".json").write_text(
+                        json.dumps({"url": url, "etag": etag}), encoding="utf-8"
+                    )
+                    part_etag = etag
+                size = __total_size__(response)
+                stats["attempts"] = attempt
+                try:
+                    with part.open(mode) as data:
+                        for view in __chunks__(response, stats):
+                            data.write(view)
+                            sha256.update(view)
+                            if stream:
+                                stream.write(view)
+                            n += len(view)
+                            stats["received"] += len(view)
+                            if size:
+                                progress.progress(100 * n / size)
+                    if size and n != size:
+                        raise requests.RequestException(f"received {n} of {size} bytes")
+                    break
+                except requests.RequestException as e:
+                    if attempt == DOWNLOAD_ATTEMPTS:
+                        print(f"Unable to fetch url '{url}': {e}", file=sys.stderr)
+                        raise
+                    print(f"Resuming download of '{url}': {e}", file=sys.stderr)
+                    response.close()
+                    response = get()
+                    # The file changed on the server: restart from scratch
+                    etag = __validator__(response) or etag
+
+        if size:
+            progress.finish()
+
+        with contextlib.suppress(FileNotFoundError):
+            part.with_name(part.name + ".json").unlink()
+        if sha256sum and sha256.hexdigest() != sha256sum:
+            part.unlink()
+            raise InvalidArgument(
+                f"Invalid sha256 for '{url}': {sha256.hexdigest()} != {sha256sum}"
+            )
+
+        __store__(part, sha256.hexdigest(), cache)
+        # Only update the index when the asset is complete
+        __update_index__(
+            index,
+            url=url,
+            etag=__header__(response, "ETag"),
+            last_modified=__header__(response, "Last-Modified"),
+            sha256=sha256.hexdigest(),
+            size=n,
+            checked=time.time(),
+            hit=False,
+            **__cache_control__(response),
+        )
+        if stream:
+            stream.store(sha256.hexdigest())
+    except BaseException:
+        # Do not leave the partially decompressed file behind
+        if stream:
+            stream.abort()
+        raise
 
+    seconds = time.monotonic() - start
+    DOWNLOADS[url] = {
+        **stats,
+        "seconds": round(seconds, 3),
+        # Bytes per second
+        "throughput": int(stats["received"] / seconds) if seconds else 0,
+    }
     return str(cache.resolve())
@@ -0,0 +1,36 @@
+# vim: set ts=4
+#
+# Copyright 2021-present Linaro Limited
+#
+# SPDX-License-Identifier: MIT
+
+import json
+import re
+
+from tuxrun.yaml import yaml_load
+
+# LAVA marks some values with the yaml non-specific tag, like
+# {"starttc": ! "1756"}. The yaml loader resolves them as plain scalars, so
+# decimal integers are unquoted and anything else is left to the yaml loader.
+NON_SPECIFIC_INT = re.compile(r'(?<=[^\\]": )! "(-?(?:0|[1-9][0-9]*))"(?=[,}])')
+
+
+def decode(line: str):
+    """
+    Decode one line of the LAVA log.
+
+    Lines are flow mappings that are (almost always) valid JSON, so try the
+    json module first and only fallback to the much slower yaml loader.
+    Raises yaml.YAMLError when the line is not valid yaml.
+    """
+    if line.startswith("{") and line.endswith("}"):
+        try:
+            return json.loads(line)
+        except ValueError:
+            pass
+        if '": ! "' in line:
+            try:
+                return json.loads(NON_SPECIFIC_INT.sub(r"\1", line))
+            except ValueError:
+                pass
+    return yaml_load(line)
@@ -0,0 +1,216 @@
+# vim: set ts=4
+#
+# Copyright 2021-present Linaro Limited
+#
+# SPDX-License-Identifier: MIT
+
+import contextlib
+import lzma
+import os
+import shutil
+import subprocess
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+# Size of the blocks written to the decompressed file
+CHUNK = 1024 * 1024
+
+# Maximum size of a zstd frame header
+ZSTD_HEADER = 18
+
+# External tools, by order of preference. They decompress in their own
+# process (with several threads for xz) while tuxrun downloads and hashes.
+TOOLS = {
+    "gz": [["pigz", "-dc"], ["gzip", "-dc"]],
+    "xz": [["xz", "-T0", "-dc"]],
+    "zstd": [["zstd", "-dc"]],
+}
+
+
+def python_decompressor(ext: str):
+    if ext == "gz":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if ext == "xz":
+        return lzma.LZMADecompressor()
+    if ext == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor()
+    return None
+
+
+def tool(ext: str) -> Optional[list]:
+    for cmd in TOOLS.get(ext, []):
+        if shutil.which(cmd[0]):
+            return cmd
+    return None
+
+
+class __Output__:
+    """
+    File object handing the data written by zstandard to a callback
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, data: bytes) -> int:
+        self.callback(data)
+        return len(data)
+
+
+class Decompressor:
+    """
+    Decompress a stream into a sparse file, with an external tool when
+    available or in python otherwise.
+    """
+
+    def __init__(self, ext: str, dst: Path):
+        self.dst = dst
+        self.consumed = 0
+        self.size = 0
+        self.__start__ = time.monotonic()
+        self.__process__: Optional[subprocess.Popen] = None
+        self.__thread__: Optional[threading.Thread] = None
+        self.__obj__: Any = None
+        # Start of the zstd stream, holding the frame header
+        self.__head__ = b""
+
+        cmd = tool(ext)
+        if cmd is None:
+            self.__obj__ = python_decompressor(ext)
+            if self.__obj__ is None:
+                raise ValueError(f"Unable to decompress '{ext}'")
+            if ext == "zstd":
+                self.__obj__ = self.__obj__.stream_writer(
+                    __Output__(self.__output__), write_size=CHUNK
+                )
+            self.codec = "python"
+        self.__file__ = dst.open("wb")
+        if cmd is not None:
+            self.codec = " ".join(cmd)
+            self.__process__ = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            self.__thread__ = threading.Thread(target=self.__read__, daemon=True)
+            self.__thread__.start()
+
+    @classmethod
+    def supported(cls, ext: Optional[str]) -> bool:
+        if ext is None:
+            return False
+        return tool(ext) is not None or python_decompressor(ext) is not None
+
+    def __read__(self):
+        assert self.__process__ and self.__process__.stdout
+        for data in iter(lambda: self.__process__.stdout.read(CHUNK), b""):
+            self.__output__(data)
+
+    def __output__(self, data: bytes) -> None:
+        for start in range(0, len(data), CHUNK):
+            end = start + CHUNK
+            chunk = data[start:end]
+            # Keep the file sparse: file systems are mostly empty
+            if chunk.count(0) == len(chunk):
+                self.__file__.seek(len(chunk), os.SEEK_CUR)
+            else:
+                self.__file__.write(chunk)
+            self.size += len(chunk)
+
+    def write(self, data: Union[bytes, memoryview]) -> None:
+        self.consumed += len(data)
+        if self.__process__ is not None:
+            assert self.__process__.stdin
+            self.__process__.stdin.write(data)
+        else:
+            self.__decompress__(data)
+
+    def __decompress__(self, data: Union[bytes, memoryview]) -> None:
+        # The output is produced by CHUNK: the blocks of zeros of a file system
+        # compress so well that a single input chunk can expand to gigabytes
+        obj = self.__obj__
+        if isinstance(obj, lzma.LZMADecompressor):
+            self.__output__(obj.decompress(data, CHUNK))
+            while not obj.needs_input and not obj.eof:
+                self.__output__(obj.decompress(b"", CHUNK))
+        elif zstandard is not None and isinstance(
+            obj, zstandard.ZstdDecompressionWriter
+        ):
+            if len(self.__head__) < ZSTD_HEADER:
+                self.__head__ += bytes(data[:ZSTD_HEADER])
+            try:
+                obj.write(data)
+            except zstandard.ZstdError as exc:
+                raise ValueError(str(exc))
+        else:
+            while True:
+                out = obj.decompress(data, CHUNK)
+                self.__output__(out)
+                data = obj.unconsumed_tail
+                if not data and len(out) < CHUNK:
+                    break
+
+    def __truncated__(self) -> bool:
+        if self.__process__ is not None:
+            return False
+        if zstandard is not None and isinstance(
+            self.__obj__, zstandard.ZstdDecompressionWriter
+        ):
+            # The writer does not tell when the frame is complete: rely on
+            # the content size, when given in the frame header
+            try:
+                expected = zstandard.get_frame_parameters(self.__head__).content_size
+            except zstandard.ZstdError:
+                return True
+            return expected != zstandard.CONTENTSIZE_UNKNOWN and self.size < expected
+        return not getattr(self.__obj__, "eof", True)
+
+    def close(self) -> Dict:
+        """
+        Wait for the end of the decompression and return the statistics
+        """
+        try:
+            if self.__process__ is not None:
+                assert self.__process__.stdin and self.__thread__
+                self.__process__.stdin.close()
+                ret = self.__process__.wait()
+                self.__thread__.join()
+                if ret:
+                    raise OSError(f"'{self.codec}' failed with {ret}")
+            if self.__truncated__():
+                raise OSError("Truncated compressed data")
+            self.__file__.truncate()
+            self.__file__.close()
+        except BaseException:
+            self.abort()
+            raise
+        seconds = time.monotonic() - self.__start__
+        return {
+            "codec": self.codec,
+            "compressed": self.consumed,
+            "size": self.size,
+            "seconds": round(seconds, 3),
+            # Bytes per second
+            "throughput": int(self.size / seconds) if seconds else 0,
+        }
+
+    def abort(self) -> None:
+        if self.__process__ is not None:
+            assert self.__process__.stdin and self.__thread__
+            self.__process__.kill()
+            with contextlib.suppress(OSError):
+                self.__process__.stdin.close()
+            self.__process__.wait()
+            self.__thread__.join()
+        self.__file__.close()
+        with contextlib.suppress(FileNotFoundError):
+            self.dst.unlink()
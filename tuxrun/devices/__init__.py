@@ -19,6 +19,10 @@ class Device:
     name: str = ""
     flag_use_pre_run_cmd: bool = False
     flag_cache_rootfs: bool = False
+    # Download the http artefacts on the host and bind them in the container
+    flag_cache_assets: bool = True
+    # Give a decompressed copy of the cached rootfs, modules and overlays to LAVA
+    flag_decompress_assets: bool = False
 
     @classmethod
     def select(cls, name):
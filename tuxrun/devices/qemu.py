@@ -15,6 +15,7 @@ from tuxrun.utils import compression, notnone, slugify
 
 class QemuDevice(Device):
     flag_cache_rootfs = True
+    flag_decompress_assets = True
 
     arch: str = ""
     lava_arch: str = ""
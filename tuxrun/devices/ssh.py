@@ -13,6 +13,8 @@ from tuxrun.utils import notnone, slugify
 class SSHDevice(Device):
     name = "ssh-device"
     ssh_port = 22
+    # The overlays are downloaded by the remote device
+    flag_cache_assets = False
 
     def validate(
         self,
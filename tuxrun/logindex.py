@@ -0,0 +1,185 @@
+# vim: set ts=4
+#
+# Copyright 2021-present Linaro Limited
+#
+# SPDX-License-Identifier: MIT
+
+import argparse
+import bisect
+import json
+import sys
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from tuxrun.pipeline import Record
+
+VERSION = 1
+# Record the offset of one line every STEP lines
+STEP = 64
+
+
+def index_path(path) -> Path:
+    return Path(f"{path}.idx")
+
+
+class LogIndexer:
+    """
+    Build the index of logs.yaml while the lines are written: the byte offset
+    and timestamp of one line every STEP lines and the position of each
+    results line.
+    """
+
+    def __init__(self, step: int = STEP):
+        self.step = step
+        self.lines = 0
+        self.offset = 0
+        self.offsets: List[int] = []
+        self.dts: List[str] = []
+        self.results: List[Tuple[str, str, int]] = []
+
+    def add(self, record: Record, data: str) -> None:
+        if self.lines % self.step == 0:
+            self.offsets.append(self.offset)
+            self.dts.append(str(record.data.get("dt", "")) if record.data else "")
+        if record.result is not None:
+            self.results.append((record.result[0], record.result[1], self.lines))
+        self.lines += 1
+        self.offset += len(data.encode("utf-8"))
+
+    def save(self, path) -> None:
+        Path(path).write_text(
+            json.dumps(
+                {
+                    "version": VERSION,
+                    "step": self.step,
+                    "lines": self.lines,
+                    "size": self.offset,
+                    "offsets": self.offsets,
+                    "dt": self.dts,
+                    "results": self.results,
+                }
+            ),
+            encoding="utf-8",
+        )
+
+
+class LogIndex:
+    """
+    Random access to logs.yaml by line number, timestamp or test case.
+    """
+
+    def __init__(self, path, data: Dict):
+        self.path = Path(path)
+        self.step: int = data["step"]
+        self.lines: int = data["lines"]
+        self.offsets: List[int] = data["offsets"]
+        self.dts: List[str] = data["dt"]
+        self.results: List[Tuple[str, str, int]] = [tuple(r) for r in data["results"]]  # type: ignore
+
+    @classmethod
+    def load(cls, path) -> "LogIndex":
+        idx = index_path(path)
+        if idx.exists():
+            data = json.loads(idx.read_text(encoding="utf-8"))
+            if data.get("version") == VERSION:
+                return cls(path, data)
+        return cls.build(path)
+
+    @classmethod
+    def build(cls, path, step: int = STEP) -> "LogIndex":
+        """
+        Index an existing logs.yaml, for instance when tuxrun was killed
+        before saving the index.
+        """
+        indexer = LogIndexer(step)
+        with Path(path).open("r", encoding="utf-8") as f:
+            for line in f:
+                indexer.add(Record(line[2:]), line)
+        indexer.save(index_path(path))
+        return cls.load(path)
+
+    def read(self, start: int = 0, end: Optional[int] = None) -> Iterator[str]:
+        """
+        Lines from start to end (excluded), without the leading "- "
+        """
+        end = self.lines if end is None else min(end, self.lines)
+        if start >= end:
+            return
+        with self.path.open("rb") as f:
+            f.seek(self.offsets[start // self.step])
+            for _ in range(start % self.step):
+                f.readline()
+            for _ in range(end - start):
+                yield f.readline().decode("utf-8")[2:].rstrip("\n")
+
+    def find(self, dt: str) -> int:
+        """
+        Number of the first line logged at or after dt
+        """
+        chunk = max(bisect.bisect_left(self.dts, dt) - 1, 0)
+        lineno = chunk * self.step
+        for line in self.read(lineno, lineno + 2 * self.step):
+            record = Record(line)
+            if record.data and str(record.data.get("dt", "")) >= dt:
+                return lineno
+            lineno += 1
+        return min(lineno, self.lines)
+
+    def case(self, definition: str, case: str) -> Tuple[int, int]:
+        """
+        Lines of the given test case: from the previous results to the
+        results of this case (included)
+        """
+        start = 0
+        for d, c, lineno in self.results:
+            if d == definition and c == case:
+                return (start, lineno + 1)
+            start = lineno + 1
+        raise KeyError(f"{definition}/{case}")
+
+
+##############
+# Entrypoint #
+##############
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python3 -m tuxrun.logindex",
+        description="Extract part of a logs.yaml using its index",
+    )
+    parser.add_argument("logs", type=Path, help="logs.yaml")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--case", metavar="DEFINITION/CASE", help="test case logs")
+    group.add_argument("--lines", metavar="START:END", help="line range")
+    group.add_argument("--since", metavar="DT", help="logs after the given date")
+    parser.add_argument("--until", metavar="DT", help="logs before the given date")
+    parser.add_argument(
+        "--rebuild", default=False, action="store_true", help="rebuild the index"
+    )
+    options = parser.parse_args(argv)
+
+    if options.rebuild:
+        index = LogIndex.build(options.logs)
+    else:
+        index = LogIndex.load(options.logs)
+
+    if options.case:
+        (definition, _, case) = options.case.partition("/")
+        try:
+            (start, end) = index.case(definition, case)
+        except KeyError:
+            parser.error(f"unknown test case '{options.case}'")
+    elif options.lines:
+        (first, _, last) = options.lines.partition(":")
+        start = int(first or 0)
+        end = int(last) if last else index.lines
+    else:
+        start = index.find(options.since)
+        end = index.find(options.until) if options.until else index.lines
+
+    for line in index.read(start, end):
+        sys.stdout.write(f"- {line}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# vim: set ts=4
+#
+# Copyright 2021-present Linaro Limited
+#
+# SPDX-License-Identifier: MIT
+
+import contextlib
+import logging
+import queue
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import yaml
+
+from tuxrun.decoder import decode
+
+LOG = logging.getLogger("tuxrun")
+PATTERN = re.compile(r"^(\d+_)")
+UNSET = object()
+END = object()
+
+# Time given to the reader thread to stop when a consumer fails. It can be
+# blocked reading the stream until the next line.
+STOP_TIMEOUT = 5
+
+
+class Record:
+    """
+    One line of the LAVA log, decoded once and shared by every consumer.
+    """
+
+    __slots__ = ("line", "data", "_result")
+
+    def __init__(self, line: str):
+        self.line = line.rstrip("\n")
+        try:
+            data = decode(self.line)
+        except yaml.YAMLError:
+            data = None
+        self.data = data if data and isinstance(data, dict) else None
+        self._result = UNSET
+
+    @property
+    def lvl(self) -> Optional[str]:
+        return None if self.data is None else self.data.get("lvl")
+
+    @property
+    def result(self) -> Optional[Tuple[str, str, dict]]:
+        """
+        The (definition, case, test) tuple for LAVA results, None otherwise.
+        """
+        if self._result is UNSET:
+            self._result = None
+            msg = self.data.get("msg") if self.data and self.lvl == "results" else None
+            if isinstance(msg, dict) and {"case", "definition"}.issubset(msg.keys()):
+                test = msg.copy()
+                definition = re.sub(PATTERN, "", str(test.pop("definition")))
+                case = re.sub(PATTERN, "", str(test.pop("case")))
+                self._result = (definition, case, test)
+        return self._result  # type: ignore
+
+
+class Pipeline:
+    def __init__(self):
+        self.__consumers__: List[Callable[[Record], None]] = []
+        self.stats: Dict[str, Any] = {"lines": 0}
+
+    def register(self, consumer: Callable[[Record], None]) -> None:
+        self.__consumers__.append(consumer)
+
+    def feed(self, line: str) -> Record:
+        record = Record(line)
+        for consumer in self.__consumers__:
+            consumer(record)
+        return record
+
+    def run(self, lines: Iterable[str], queue_size: int = 0) -> None:
+        """
+        Feed every line to the consumers.
+
+        With a queue_size, a dedicated thread drains the lines into a bounded
+        queue so slow consumers (terminal, disk) do not block the producer
+        until the queue is full.
+        """
+        if not queue_size:
+            for line in lines:
+                self.stats["lines"] += 1
+                self.feed(line)
+            return
+
+        stats = self.stats["queue"] = {"size": queue_size, "depth": 0, "blocked": 0.0}
+        lines_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        errors: List[Exception] = []
+        stop = threading.Event()
+
+        def reader():
+            try:
+                for line in lines:
+                    try:
+                        lines_queue.put_nowait(line)
+                    except queue.Full:
+                        start = time.monotonic()
+                        lines_queue.put(line)
+                        stats["blocked"] += time.monotonic() - start
+                    stats["depth"] = max(stats["depth"], lines_queue.qsize())
+                    if stop.is_set():
+                        break
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                lines_queue.put(END)
+
+        thread = threading.Thread(target=reader, name="pipeline-reader", daemon=True)
+        thread.start()
+        try:
+            while True:
+                line = lines_queue.get()
+                if line is END:
+                    break
+                self.stats["lines"] += 1
+                self.feed(line)
+        except BaseException:
+            # Unblock the reader and stop it before the caller reads what is
+            # left of the stream
+            stop.set()
+            deadline = time.monotonic() + STOP_TIMEOUT
+            while thread.is_alive() and time.monotonic() < deadline:
+                with contextlib.suppress(queue.Empty):
+                    while True:
+                        lines_queue.get_nowait()
+                thread.join(0.01)
+            raise
+        thread.join()
+        LOG.debug(
+            "Pipeline: %d lines, max queue depth %d/%d, reader blocked %.3fs",
+            self.stats["lines"],
+            stats["depth"],
+            queue_size,
+            stats["blocked"],
+        )
+        if errors:
+            raise errors[0]
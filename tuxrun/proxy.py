@@ -0,0 +1,149 @@
+# vim: set ts=4
+#
+# Copyright 2021-present Linaro Limited
+#
+# SPDX-License-Identifier: MIT
+
+import logging
+import secrets
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from tuxrun import assets
+from tuxrun.exceptions import InvalidArgument
+from tuxrun.requests import requests_head
+
+LOG = logging.getLogger("tuxrun")
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: "Server"
+
+    def requested_url(self) -> Optional[str]:
+        """
+        Return the requested url or None when the request was answered
+        """
+        parsed = urlparse(self.path)
+        urls = parse_qs(parsed.query).get("url")
+        if parsed.path != f"/{self.server.token}/fetch" or not urls:
+            self.send_error(403)
+            return None
+        url = urls[0]
+        if urlparse(url).scheme not in ["http", "https"]:
+            self.send_error(400, "Only http and https urls are supported")
+            return None
+        return url
+
+    def resolve(self):
+        """
+        Download and cache the requested url. Return the cached file or None
+        when the request was answered.
+        """
+        url = self.requested_url()
+        if url is None:
+            return None
+
+        try:
+            path = assets.__download_and_cache__(url)
+        except InvalidArgument as exc:
+            # Not cached with --offline or not matching the manifest
+            self.send_error(404, str(exc))
+            return None
+        except requests.RequestException as exc:
+            self.send_error(502, str(exc))
+            return None
+        if path == url:
+            # Not cacheable: let the client download it
+            self.send_response(302)
+            self.send_header("Location", url)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        return Path(path)
+
+    def headers_for(self, path: Path):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(path.stat().st_size))
+        self.end_headers()
+
+    def do_HEAD(self):
+        # Answered without downloading the asset: from the cache when
+        # available, from the server otherwise
+        url = self.requested_url()
+        if url is None:
+            return
+        cache = assets.asset_paths(url)[0]
+        if cache.is_file():
+            self.headers_for(cache)
+            return
+        if assets.OFFLINE:
+            self.send_error(404, f"'{url}' is not in the cache")
+            return
+
+        try:
+            response = requests_head(url, allow_redirects=True)
+        except requests.RequestException as exc:
+            self.send_error(502, str(exc))
+            return
+        self.send_response(response.status_code)
+        self.send_header("Content-Type", "application/octet-stream")
+        if "Content-Length" in response.headers:
+            self.send_header("Content-Length", response.headers["Content-Length"])
+        self.end_headers()
+
+    def do_GET(self):
+        path = self.resolve()
+        if path is None:
+            return
+        with path.open("rb") as f:
+            self.headers_for(path)
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    def log_message(self, format, *args):
+        LOG.debug("proxy: " + format, *args)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, Handler)
+        # Only the jobs started by this tuxrun know the token
+        self.token = secrets.token_hex(16)
+
+
+class CacheProxy:
+    """
+    HTTP server giving access to the tuxrun assets cache. LAVA downloads are
+    rewritten through it with http_url_format_string. Every tuxrun has its
+    own proxy but the cache, and its locks, are shared by all of them.
+    """
+
+    def __init__(self, runtime):
+        listen = "0.0.0.0" if runtime.container else "127.0.0.1"
+        self.__server__ = Server((listen, 0))
+        self.__host__ = runtime.host()
+        self.__thread__ = threading.Thread(
+            target=self.__server__.serve_forever, name="proxy", daemon=True
+        )
+
+    def __enter__(self):
+        self.__thread__.start()
+        LOG.debug("proxy: listening on %s", self.url_format_string)
+        return self
+
+    def __exit__(self, *_):
+        self.__server__.shutdown()
+        self.__server__.server_close()
+
+    @property
+    def url_format_string(self) -> str:
+        port = self.__server__.server_address[1]
+        return f"http://{self.__host__}:{port}/{self.__server__.token}/fetch?url=%s"
@@ -33,3 +33,8 @@ def get_session(*, retries):
 def requests_get(*args, **kwargs):
     session = get_session(retries=8)
     return session.get(*args, timeout=timeout, **kwargs)
+
+
+def requests_head(*args, **kwargs):
+    session = get_session(retries=3)
+    return session.head(*args, timeout=timeout, **kwargs)
@@ -4,48 +4,178 @@
 #
 # SPDX-License-Identifier: MIT
 
+import argparse
+import json
 import logging
-import re
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
 
-import yaml
-
-from tuxrun.yaml import yaml_load
+from tuxrun.pipeline import Record
 
 LOG = logging.getLogger("tuxrun")
-PATTERN = re.compile(r"^(\d+_)")
+
+# Key of the result reported without a label for a case also reported with
+# labels, see Results.add
+UNLABELLED = "unlabelled"
+
+# Sync the results stream every FSYNC_COUNT results or FSYNC_INTERVAL seconds
+FSYNC_COUNT = 64
+FSYNC_INTERVAL = 5.0
+
+
+class ResultsStream:
+    """
+    Append every test result to a NDJSON file as soon as it is parsed, so that
+    the results survive a crash of tuxrun. The first line is a header with
+    the expected tests and the artefacts.
+    """
+
+    def __init__(
+        self,
+        path,
+        tests,
+        artefacts,
+        digests=None,
+        decompression=None,
+        downloads=None,
+    ):
+        self.__file__ = Path(path).open("w", encoding="utf-8")
+        self.__pending__ = 0
+        self.__last__ = time.monotonic()
+        self.write(
+            {
+                "version": 1,
+                "tests": [t.name for t in tests],
+                "artefacts": artefacts,
+                "digests": digests or {},
+                "decompression": decompression or {},
+                "downloads": downloads or {},
+            }
+        )
+        self.sync()
+
+    def write(self, entry):
+        self.__file__.write(json.dumps(entry) + "\n")
+        self.__pending__ += 1
+        if (
+            self.__pending__ >= FSYNC_COUNT
+            or time.monotonic() - self.__last__ >= FSYNC_INTERVAL
+        ):
+            self.sync()
+
+    def add(self, definition, case, test):
+        self.write({"definition": definition, "case": case, "test": test})
+
+    def sync(self):
+        self.__file__.flush()
+        os.fsync(self.__file__.fileno())
+        self.__pending__ = 0
+        self.__last__ = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.__file__.close()
+
+
+class Spilled:
+    __slots__ = ("offset", "length")
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
+
+class Spill:
+    """
+    Keep the extra payloads of the results in a temporary file
+    """
+
+    def __init__(self):
+        self.__file__ = None
+
+    def write(self, value) -> Spilled:
+        if self.__file__ is None:
+            self.__file__ = tempfile.TemporaryFile()
+        data = json.dumps(value).encode("utf-8")
+        offset = self.__file__.seek(0, os.SEEK_END)
+        self.__file__.write(data)
+        return Spilled(offset, len(data))
+
+    def read(self, spilled: Spilled):
+        self.__file__.seek(spilled.offset)
+        return json.loads(self.__file__.read(spilled.length))
+
+    def close(self) -> None:
+        if self.__file__ is not None:
+            self.__file__.close()
+            self.__file__ = None
+
+
+class Case:
+    """
+    Compact test result: the tuple of keys is shared between the results
+    with the same keys and the strings are interned.
+    """
+
+    __slots__ = ("keys", "values")
+
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
 
 
 class Results:
-    def __init__(self, tests, artefacts):
+    def __init__(
+        self,
+        tests,
+        artefacts,
+        digests=None,
+        decompression=None,
+        downloads=None,
+        stream=None,
+    ):
         self.__artefacts__ = artefacts.copy()
+        # sha256 of the artefacts downloaded by tuxrun, by url
+        self.__digests__ = digests or {}
+        # Statistics of the artefacts decompressed by tuxrun, by name
+        self.__decompression__ = decompression or {}
+        # Statistics of the downloads, by url. Not copied: the cache proxy
+        # downloads during the run.
+        self.__downloads__ = {} if downloads is None else downloads
+        # ResultsStream receiving every result once normalised
+        self.__stream__ = stream
         # Add overlays
         for index, overlay in enumerate(self.__artefacts__.get("overlays", [])):
             self.__artefacts__[f"overlay-{index:02}"] = overlay[0]
         self.__data__ = {}
+        self.__keys__ = {}
+        self.__spill__ = Spill()
         self.__metadata__ = {}
         self.__post_processed = False
         self.__tests__ = ["lava"] + [t.name for t in tests]
         self.__ret__ = 0
 
     def parse(self, line):
-        try:
-            data = yaml_load(line)
-        except yaml.YAMLError:
-            LOG.debug(line)
+        return self.consume(Record(line))
+
+    def consume(self, record: Record):
+        if record.data is None:
+            LOG.debug(record.line)
             return
-        if not data or not isinstance(data, dict):
-            LOG.debug(line)
+        if record.lvl != "results":
             return
-        if data.get("lvl") != "results":
+        if record.result is None:
+            LOG.debug(record.line)
             return
 
-        test = data.get("msg")
-        if not {"case", "definition"}.issubset(test.keys()):
-            LOG.debug(line)
-            return
+        return self.add(*record.result)
 
-        definition = re.sub(PATTERN, "", test.pop("definition"))
-        case = re.sub(PATTERN, "", test.pop("case"))
+    def add(self, definition, case, test):
+        definition = sys.intern(definition)
+        case = sys.intern(case)
         # download action can be duplicated
         if (
             definition == "lava"
@@ -54,9 +184,8 @@ class Results:
         ):
             label = test["extra"]["label"]
             label = label[len("rootfs.") :] if label.startswith("rootfs.") else label
-            self.__data__.setdefault(definition, {}).setdefault(case, {})[label] = test
             if label in self.__artefacts__:
-                self.__data__[definition][case][label]["url"] = (
+                test["url"] = (
                     self.__artefacts__[label]
                     if isinstance(self.__artefacts__[label], str)
                     else (
@@ -65,13 +194,82 @@ class Results:
                         else self.__artefacts__[label][0]
                     )
                 )
+            labels = self.__data__.setdefault(definition, {}).setdefault(case, {})
+            if isinstance(labels, Case):
+                # Already reported without a label
+                labels = self.__data__[definition][case] = {UNLABELLED: labels}
+            labels[sys.intern(label)] = self.__compact(test)
         else:
-            self.__data__.setdefault(definition, {})[case] = test
+            cases = self.__data__.setdefault(definition, {})
+            if isinstance(cases.get(case), dict):
+                # Already reported with labels
+                cases[case][UNLABELLED] = self.__compact(test)
+            else:
+                cases[case] = self.__compact(test)
         if test["result"] == "fail":
             self.__ret__ = 1
+        if self.__stream__ is not None:
+            self.__stream__.add(definition, case, test)
 
         return (definition, case, test)
 
+    def __compact(self, test) -> Case:
+        keys = tuple(test.keys())
+        keys = self.__keys__.setdefault(keys, keys)
+        values = tuple(
+            self.__spill__.write(v)
+            if k == "extra"
+            else (sys.intern(v) if isinstance(v, str) else v)
+            for k, v in test.items()
+        )
+        return Case(keys, values)
+
+    def __expand(self, value):
+        if isinstance(value, Case):
+            return {
+                k: self.__spill__.read(v) if isinstance(v, Spilled) else v
+                for k, v in zip(value.keys, value.values)
+            }
+        return {k: self.__expand(v) for k, v in value.items()}
+
+    def __get(self, definition, case):
+        value = self.__data__.get(definition, {}).get(case)
+        return {} if value is None else self.__expand(value)
+
+    @classmethod
+    def fold(cls, path):
+        """
+        Rebuild the results from a NDJSON results stream
+        """
+        results = None
+        try:
+            with Path(path).open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line might be truncated
+                        LOG.warning("Invalid results line: %s", line.rstrip("\n"))
+                        break
+                    if results is None:
+                        results = cls(
+                            [],
+                            entry["artefacts"],
+                            entry.get("digests"),
+                            entry.get("decompression"),
+                            entry.get("downloads"),
+                        )
+                        results.__tests__ = ["lava"] + entry["tests"]
+                    else:
+                        results.add(entry["definition"], entry["case"], entry["test"])
+        except BaseException:
+            if results is not None:
+                results.close()
+            raise
+        if results is None:
+            raise ValueError(f"{path} is empty")
+        return results
+
     def __post_process(self):
         if self.__post_processed:
             return
@@ -81,42 +279,46 @@ class Results:
             self.__ret__ = 2
 
         # Add qemu info
-        if self.__data__.get("lava", {}).get("execute-qemu", {}).get("extra"):
+        qemu = self.__get("lava", "execute-qemu")
+        if qemu.get("extra"):
             self.__metadata__ = {
-                "arch": self.__data__["lava"]["execute-qemu"]["extra"].get("job_arch"),
-                "host_arch": self.__data__["lava"]["execute-qemu"]["extra"].get(
-                    "host_arch"
-                ),
-                "qemu_version": self.__data__["lava"]["execute-qemu"]["extra"].get(
-                    "qemu_version"
-                ),
+                "arch": qemu["extra"].get("job_arch"),
+                "host_arch": qemu["extra"].get("host_arch"),
+                "qemu_version": qemu["extra"].get("qemu_version"),
             }
         # Add artefacts with url and checksum
         self.__metadata__["artefacts"] = {}
         for lava_key in ["file-download", "http-download"]:
-            for k, v in self.__data__.get("lava", {}).get(lava_key, {}).items():
+            for k, v in self.__get("lava", lava_key).items():
                 if "url" in v:
                     self.__metadata__["artefacts"][k] = {
                         "url": v["url"],
                         # FIXME: The latest version of lava_dispatcher 2024.09
                         #        does not add sha256sum for some downloads.
-                        "sha256sum": v["extra"].get("sha256sum"),
+                        "sha256sum": v["extra"].get("sha256sum")
+                        or self.__digests__.get(v["url"]),
                     }
 
+        if self.__decompression__:
+            self.__metadata__["decompression"] = self.__decompression__
+        if self.__downloads__:
+            self.__metadata__["downloads"] = dict(self.__downloads__)
+
         # Add test durations
         self.__metadata__["durations"] = {"tests": {}}
         for test in self.__tests__[1:]:
-            self.__metadata__["durations"]["tests"][test] = (
-                self.__data__.get("lava", {}).get(test, {}).get("duration", 0)
-            )
-        self.__metadata__["durations"]["tests"]["boot"] = (
-            self.__data__.get("lava", {}).get("login-action", {}).get("duration", 0)
-        )
+            self.__metadata__["durations"]["tests"][test] = self.__get(
+                "lava", test
+            ).get("duration", 0)
+        self.__metadata__["durations"]["tests"]["boot"] = self.__get(
+            "lava", "login-action"
+        ).get("duration", 0)
 
     @property
     def data(self):
         self.__post_process()
-        return self.__data__
+        # Only the compact results are kept in memory
+        return self.__expand(self.__data__)
 
     @property
     def metadata(self):
@@ -126,3 +328,52 @@ class Results:
     def ret(self):
         self.__post_process()
         return self.__ret__
+
+    def close(self) -> None:
+        """
+        Release the temporary file of the extra payloads. The results can not
+        be read anymore.
+        """
+        self.__spill__.close()
+
+
+##############
+# Entrypoint #
+##############
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python3 -m tuxrun.results",
+        description="Fold a results.ndjson into results and metadata",
+    )
+    parser.add_argument("ndjson", type=Path, help="results.ndjson")
+    parser.add_argument(
+        "--results", default="-", help="Save test results to file (JSON)"
+    )
+    parser.add_argument(
+        "--metadata", default=None, help="Save test metadata to file (JSON)"
+    )
+    options = parser.parse_args(argv)
+
+    try:
+        results = Results.fold(options.ndjson)
+    except (OSError, ValueError) as exc:
+        parser.error(str(exc))
+
+    try:
+        for path, data in [
+            (options.results, results.data),
+            (options.metadata, results.metadata),
+        ]:
+            if path is None:
+                continue
+            if path == "-":
+                sys.stdout.write(json.dumps(data) + "\n")
+            else:
+                Path(path).write_text(json.dumps(data), encoding="utf-8")
+        return results.ret()
+    finally:
+        results.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -48,6 +48,12 @@ class Runtime:
     def image(self, image):
         self.__image__ = image
 
+    def host(self):
+        """
+        Address of the host, seen from the runtime
+        """
+        return "127.0.0.1"
+
     def name(self, name):
         self.__name__ = name
 
@@ -107,6 +113,7 @@ class ContainerRuntime(Runtime):
 
     def __init__(self):
         super().__init__()
+        self.__options__ = []
         self.bind("/boot", ro=True)
         self.bind("/lib/modules", ro=True)
         # Bind /dev/kvm is available
@@ -119,7 +126,7 @@ class ContainerRuntime(Runtime):
             self.bind(guestfs, "/var/tmp/.guestfs-0")
 
     def cmd(self, args):
-        prefix = self.prefix.copy()
+        prefix = self.prefix + self.__options__
         srcs = set()
         dsts = set()
         for binding in self.__bindings__:
@@ -156,6 +163,11 @@ class DockerRuntime(ContainerRuntime):
     binary = "docker"
     prefix = ["docker", "run", "--rm", "--hostname", "tuxrun"]
 
+    def __init__(self):
+        super().__init__()
+        # Let the container reach the host, see host()
+        self.__options__.extend(["--add-host", "host.docker.internal:host-gateway"])
+
     def pre_run(self, tmpdir):
         # Render and bind the docker wrapper
         wrap = (
@@ -172,6 +184,9 @@ class DockerRuntime(ContainerRuntime):
         # Bind the docker socket
         self.bind("/var/run/docker.sock")
 
+    def host(self):
+        return "host.docker.internal"
+
 
 class PodmanRuntime(ContainerRuntime):
     binary = "podman"
@@ -223,6 +238,9 @@ class PodmanRuntime(ContainerRuntime):
             time.sleep(1)
         raise Exception(f"Unable to create podman socket at {socket}")
 
+    def host(self):
+        return "host.containers.internal"
+
     def post_run(self):
         if self.network:
             subprocess.run(["podman", "network", "rm", self.network])
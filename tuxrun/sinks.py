@@ -0,0 +1,118 @@
+# vim: set ts=4
+#
+# Copyright 2021-present Linaro Limited
+#
+# SPDX-License-Identifier: MIT
+
+import gzip
+import io
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List, TextIO
+
+from tuxrun.exceptions import InvalidArgument
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+# Flush thresholds
+SIZE = 256 * 1024
+INTERVAL = 1.0
+
+# Compression of the outputs, selected by the file extension
+COMPRESSIONS = {".gz": "gz", ".zst": "zst"}
+
+
+def compression(path) -> str:
+    return COMPRESSIONS.get(Path(str(path)).suffix, "")
+
+
+def gz_open(path: Path) -> TextIO:
+    return gzip.open(path, "wt", encoding="utf-8", compresslevel=6)  # type: ignore
+
+
+def zst_open(path: Path) -> TextIO:
+    if zstandard is None:
+        raise InvalidArgument(f"python3-zstandard is required to write '{path}'")
+    # Use every cpu for compression
+    compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+    return io.TextIOWrapper(compressor.stream_writer(path.open("wb")), encoding="utf-8")
+
+
+class Sink:
+    """
+    Accumulate the formatted output in memory and write it in batches, when
+    the buffer is large enough, after some time or when explicitly flushed.
+    The sinks left idle are flushed by the Writer, see flush_expired.
+    """
+
+    def __init__(self, stream: TextIO, size: int = SIZE, interval: float = INTERVAL):
+        self.stream = stream
+        self.size = size
+        self.interval = interval
+        self.__buffer__: List[str] = []
+        self.__length__ = 0
+        self.__last__ = time.monotonic()
+        self.__lock__ = threading.Lock()
+
+    @classmethod
+    def open(cls, path) -> "Sink":
+        if str(path) == "-":
+            return cls.stdout()
+        path = Path(path)
+        if compression(path) == "gz":
+            return cls(gz_open(path))
+        if compression(path) == "zst":
+            return cls(zst_open(path))
+        return cls(path.open("w", encoding="utf-8"))
+
+    @classmethod
+    def supported(cls, path) -> bool:
+        return compression(path) != "zst" or zstandard is not None
+
+    @classmethod
+    def stdout(cls) -> "Sink":
+        # Keep the terminal responsive: write every line when interactive
+        if sys.stdout.isatty():
+            return cls(sys.stdout, size=0)
+        return cls(sys.stdout)
+
+    def write(self, data: str) -> None:
+        with self.__lock__:
+            self.__buffer__.append(data)
+            self.__length__ += len(data)
+            if (
+                self.__length__ >= self.size
+                or time.monotonic() - self.__last__ >= self.interval
+            ):
+                self.__flush__()
+
+    def flush(self) -> None:
+        with self.__lock__:
+            self.__flush__()
+
+    def flush_expired(self) -> None:
+        """
+        Flush the buffer when older than the interval, even without new data
+        """
+        with self.__lock__:
+            if time.monotonic() - self.__last__ >= self.interval:
+                self.__flush__()
+
+    def __flush__(self) -> None:
+        buffer = self.__buffer__
+        self.__buffer__ = []
+        self.__length__ = 0
+        self.__last__ = time.monotonic()
+        if buffer:
+            self.stream.write("".join(buffer))
+            self.stream.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self.stream is not sys.stdout:
+            self.stream.close()
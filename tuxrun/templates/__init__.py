@@ -46,12 +46,14 @@ def dispatchers():
 
 @lru_cache(maxsize=None)
 def tests():
-    return jinja2.Environment(
+    env = jinja2.Environment(
         autoescape=False,
         trim_blocks=True,
         loader=jinja2.FileSystemLoader(str(BASE / "tests")),
         undefined=jinja2.StrictUndefined,
     )
+    env.globals["compression"] = compression
+    return env
 
 
 @lru_cache(maxsize=None)
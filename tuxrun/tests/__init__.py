@@ -22,6 +22,8 @@ class Test:
     name: str = ""
     timeout: int = 0
     need_test_definition: bool = False
+    # Parameters holding the url of an overlay
+    overlay_parameters: List[str] = []
 
     def __init__(self, timeout):
         if timeout:
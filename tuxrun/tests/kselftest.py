@@ -11,6 +11,7 @@ class KSelfTest(Test):
     devices = ["qemu-*", "fvp-aemva", "avh-imx93", "avh-rpi4b"]
     cmdfile: str = ""
     need_test_definition = True
+    overlay_parameters = ["CPUPOWER", "KSELFTEST"]
 
     def render(self, **kwargs):
         kwargs["name"] = self.name
@@ -12,6 +12,7 @@ class Perf(Test):
     name = "perf"
     timeout = 30
     need_test_definition = True
+    overlay_parameters = ["PERF"]
 
     def render(self, **kwargs):
         kwargs["name"] = self.name
@@ -8,6 +8,7 @@ import argparse
 import os
 import re
 import sys
+import threading
 from abc import ABC, abstractmethod
 from io import StringIO
 from pathlib import Path
@@ -59,6 +60,50 @@ class TTYProgressIndicator(ProgressIndicator):
         sys.stderr.write("\n")
 
 
+class AggregateProgressIndicator:
+    """
+    Report the average progress of concurrent tasks, each task updating its
+    own child indicator.
+    """
+
+    def __init__(self, parent: ProgressIndicator):
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.percents: list = []
+        self.reported = False
+
+    def child(self) -> ProgressIndicator:
+        with self.lock:
+            self.percents.append(None)
+            return ChildProgressIndicator(self, len(self.percents) - 1)
+
+    def update(self, index, percent):
+        with self.lock:
+            self.percents[index] = percent
+            # Only account for the tasks that are downloading
+            percents = [p for p in self.percents if p is not None]
+            self.parent.progress(sum(percents) / len(percents))
+            self.reported = True
+
+    def finish(self):
+        with self.lock:
+            if self.reported:
+                self.parent.finish()
+            self.reported = False
+
+
+class ChildProgressIndicator(ProgressIndicator):
+    def __init__(self, parent: AggregateProgressIndicator, index: int):
+        self.parent = parent
+        self.index = index
+
+    def progress(self, percent):
+        self.parent.update(self.index, percent)
+
+    def finish(self):
+        self.parent.update(self.index, 100)
+
+
 COMPRESSIONS = {
     ".tar.xz": ("tar", "xz"),
     ".tar.gz": ("tar", "gz"),
@@ -66,6 +111,7 @@ COMPRESSIONS = {
     ".gz": (None, "gz"),
     ".xz": (None, "xz"),
     ".zst": (None, "zstd"),
+    ".tar": ("tar", None),
     ".py": ("file", None),
     ".sh": ("file", None),
 }
@@ -7,12 +7,14 @@
 import html
 import logging
 import re
-import sys
+import threading
+from collections import deque
 from contextlib import ContextDecorator
+from pathlib import Path
 
-import yaml
-
-from tuxrun.yaml import yaml_load
+from tuxrun.logindex import LogIndexer, index_path
+from tuxrun.pipeline import PATTERN, Record
+from tuxrun.sinks import INTERVAL, Sink, compression
 
 COLORS = {
     "exception": "\033[1;31m",
@@ -55,13 +57,165 @@ HTML_FOOTER = """</pre>
 </body>
 </html>"""
 
+STARTRUN = re.compile(r"^<LAVA_SIGNAL_STARTRUN (\S+) ")
+
+
+class Collapser:
+    """
+    Collapse the lines repeated by blocks of up to `window` lines. The lines
+    that might belong to a repeated block are kept until the block is
+    complete or does not match anymore.
+    """
+
+    def __init__(self, window):
+        self.recent = deque(maxlen=window)
+        self.block = None
+        self.pos = 0
+        self.repeats = 0
+        self.pending = []
+        self.last = None
+
+    def emit(self, key, data):
+        self.recent.append(key)
+        return data
+
+    def add(self, key, data):
+        out = []
+        if self.block is not None:
+            if key == self.block[self.pos]:
+                self.pending.append((key, data))
+                self.pos += 1
+                if self.pos == len(self.block):
+                    self.repeats += 1
+                    self.last = data
+                    self.pending = []
+                    self.pos = 0
+                return out
+            out = self.finish()
+
+        for period in range(1, len(self.recent) + 1):
+            if self.recent[-period] == key:
+                self.block = list(self.recent)[-period:]
+                self.pos = 0
+                return out + self.add(key, data)
+        out.append(self.emit(key, data))
+        return out
+
+    def finish(self):
+        out = []
+        if self.repeats == 1 and len(self.block) == 1:
+            out.append(self.emit(self.block[0], self.last))
+        elif self.repeats:
+            # The next blocks are matched against the lines as repeated
+            self.recent.extend(self.block * min(self.repeats, self.recent.maxlen))
+            lines = len(self.block)
+            what = "line" if lines == 1 else f"{lines} lines"
+            times = "time" if self.repeats == 1 else "times"
+            out.append(
+                {
+                    "dt": self.last["dt"],
+                    "lvl": "collapsed",
+                    "msg": f"[previous {what} repeated {self.repeats} {times}]",
+                }
+            )
+        out.extend(self.emit(key, data) for (key, data) in self.pending)
+        self.block = None
+        self.pos = 0
+        self.repeats = 0
+        self.pending = []
+        return out
+
+
+class HtmlPages:
+    """
+    Split the html logs into pages of `size` lines, or one page per test
+    suite when `size` is "suite". An index page, linking to every page and
+    test result, is written when closing.
+    """
+
+    def __init__(self, path, size):
+        self.path = Path(path)
+        self.size = size
+        self.suite = ""
+        self.sink = None
+        self.lines = 0
+        self.pages = []
+        self.results = []
+
+    def name(self, index):
+        (base, sep, ext) = self.path.name.partition(".html")
+        if sep:
+            return f"{base}.{index:04d}{sep}{ext}"
+        return f"{self.path.name}.{index:04d}"
+
+    def nav(self, index, last):
+        links = [f'<a href="{self.path.name}">index</a>']
+        if index > 1:
+            links.append(f'<a href="{self.name(index - 1)}">previous</a>')
+        if not last:
+            links.append(f'<a href="{self.name(index + 1)}">next</a>')
+        return " | ".join(links) + "\n"
+
+    def rotate(self, lineno):
+        if self.sink is not None:
+            self.sink.write(self.nav(len(self.pages), False) + HTML_FOOTER)
+            self.sink.close()
+        self.pages.append((self.name(len(self.pages) + 1), self.suite, lineno))
+        self.sink = Sink.open(self.path.parent / self.pages[-1][0])
+        self.sink.write(HTML_HEADER + self.nav(len(self.pages), True))
+        self.lines = 0
+
+    def page(self, lineno, suite=None):
+        """
+        Return the page for the given line, starting a new one when needed
+        """
+        if suite is not None:
+            self.suite = suite
+        if (
+            self.sink is None
+            or (self.size == "suite" and suite is not None)
+            or (self.size != "suite" and self.lines >= self.size)
+        ):
+            self.rotate(lineno)
+        self.lines += 1
+        return self.sink
+
+    def result(self, definition, case, result, lineno):
+        page = self.pages[-1][0] if self.pages else ""
+        self.results.append((definition, case, result, page, lineno))
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.write(self.nav(len(self.pages), True) + HTML_FOOTER)
+            self.sink.close()
+
+        index = Sink.open(self.path)
+        index.write(HTML_HEADER + "Pages\n")
+        for name, suite, lineno in self.pages:
+            index.write(f'<a href="{name}">{name}</a> L{lineno} {html.escape(suite)}\n')
+        index.write("\nResults\n")
+        for definition, case, result, page, lineno in self.results:
+            cls = {"pass": "pass", "fail": "alert"}.get(result, "info")
+            name = html.escape(f"{definition}/{case}")
+            index.write(
+                f'<span class="{cls}">{html.escape(str(result)):<5}</span> '
+                f'<a href="{page}#L{lineno}">{name}</a>\n'
+            )
+        index.write(HTML_FOOTER)
+        index.close()
+
 
 class Writer(ContextDecorator):
-    def __init__(self, log_file, html_file, text_file, yaml_file):
+    def __init__(
+        self, log_file, html_file, text_file, yaml_file, html_pages=None, collapse=0
+    ):
         self.log_file = log_file
         self.html_file = html_file
         self.text_file = text_file
         self.yaml_file = yaml_file
+        self.yaml_index = None
+        self.html_pages = html_pages
+        self.collapser = Collapser(collapse) if collapse else None
 
         self.lineno = 0
         self.kernel_level_pattern = re.compile(r"^\<([0-7])\>")
@@ -77,46 +231,85 @@ class Writer(ContextDecorator):
         }
 
     def __enter__(self):
+        # Every output goes through a Sink that batches the writes. Lines that
+        # are not valid LAVA logs are printed on stdout, using the same sink
+        # as the logs (when printed on stdout) to keep the ordering.
+        self.stdout = Sink.stdout()
+
         def fopen(p):
             if str(p) == "-":
-                return sys.stdout
-            return p.open("w")
+                return self.stdout
+            return Sink.open(p)
 
         if self.log_file is not None:
             self.log_file = fopen(self.log_file)
-        if self.html_file is not None:
+        if self.html_file is not None and self.html_pages:
+            # Pages are opened when the first line is written
+            self.html_pages = HtmlPages(self.html_file, self.html_pages)
+            self.html_file = None
+        elif self.html_file is not None:
+            self.html_pages = None
             self.html_file = fopen(self.html_file)
             self.html_file.write(HTML_HEADER)
+        else:
+            self.html_pages = None
         if self.text_file is not None:
             self.text_file = fopen(self.text_file)
         if self.yaml_file is not None:
+            # Offsets are only meaningful for uncompressed files
+            if str(self.yaml_file) != "-" and not compression(self.yaml_file):
+                self.yaml_index = (LogIndexer(), index_path(self.yaml_file))
             self.yaml_file = fopen(self.yaml_file)
+
+        # The sinks are otherwise only flushed when a line is written, and
+        # LAVA can be silent for a long time (waiting for a prompt, ...)
+        self.__stop__ = threading.Event()
+        self.__flusher__ = threading.Thread(
+            target=self.__flush_expired__, name="flusher", daemon=True
+        )
+        self.__flusher__.start()
         return self
 
-    def __exit__(self, exc_type, exc, exc_tb):
-        def fclose(f):
-            if f is not None and f != sys.stdout:
-                f.close()
+    def __flush_expired__(self):
+        while not self.__stop__.wait(INTERVAL):
+            sinks = self.sinks()
+            if self.html_pages is not None and self.html_pages.sink is not None:
+                sinks.append(self.html_pages.sink)
+            for sink in sinks:
+                sink.flush_expired()
 
-        if self.html_file is not None:
+    def __exit__(self, exc_type, exc, exc_tb):
+        self.__stop__.set()
+        self.__flusher__.join()
+        if self.collapser is not None:
+            for data in self.collapser.finish():
+                self.human(data)
+        if self.html_pages is not None:
+            self.html_pages.close()
+            self.html_file = None
+        elif self.html_file is not None:
             self.html_file.write(HTML_FOOTER)
-        fclose(self.log_file)
-        fclose(self.text_file)
-        fclose(self.html_file)
-        fclose(self.yaml_file)
+        for sink in self.sinks():
+            sink.close()
+        if self.yaml_index is not None:
+            (indexer, path) = self.yaml_index
+            indexer.save(path)
+
+    def sinks(self):
+        sinks = [self.stdout]
+        for f in [self.log_file, self.html_file, self.text_file, self.yaml_file]:
+            if f is not None and f not in sinks:
+                sinks.append(f)
+        return sinks
 
     def write(self, line):
-        line = line.rstrip("\n")
-        try:
-            data = yaml_load(line)
-        except yaml.YAMLError:
-            sys.stdout.write(line + "\n")
-            return
-        if not data or not isinstance(data, dict):
-            sys.stdout.write(line + "\n")
-            return
-        if not {"dt", "lvl", "msg"}.issubset(data.keys()):
-            sys.stdout.write(line + "\n")
+        self.consume(Record(line))
+
+    def consume(self, record: Record):
+        data = record.data
+        line = record.line
+        if data is None or not {"dt", "lvl", "msg"}.issubset(data.keys()):
+            self.stdout.write(line + "\n")
             return
 
         if self.log_file is not None:
@@ -134,31 +327,61 @@ class Writer(ContextDecorator):
             )
 
         if self.yaml_file is not None:
-            self.yaml_file.write("- " + line + "\n")
+            entry = "- " + line + "\n"
+            self.yaml_file.write(entry)
+            if self.yaml_index is not None:
+                self.yaml_index[0].add(record, entry)
 
         if data["lvl"] in ["target", "feedback"]:
-            if self.text_file is not None:
-                if data["lvl"] == "feedback" and "ns" in data:
-                    self.text_file.write(f"<{data['ns']}> ")
+            if self.collapser is None:
+                self.human(data)
+            else:
+                key = (data["lvl"], data.get("ns"), data["msg"])
+                for item in self.collapser.add(key, data):
+                    self.human(item)
+
+        if data["lvl"] == "results":
+            if self.collapser is not None:
+                for item in self.collapser.finish():
+                    self.human(item)
+            if self.html_pages is not None and record.result is not None:
+                self.html_pages.result(
+                    record.result[0],
+                    record.result[1],
+                    data["msg"].get("result"),
+                    max(self.lineno - 1, 0),
+                )
+
+    def human(self, data):
+        # Human readable outputs: text and html
+        if self.text_file is not None:
+            if data["lvl"] == "feedback" and "ns" in data:
+                self.text_file.write(f"<{data['ns']}> {data['msg']}\n")
+            else:
                 self.text_file.write(data["msg"] + "\n")
 
-            if self.html_file is not None:
-                # Build the html output
-                kernel_level = self.kernel_level_pattern.match(data["msg"])
+        if self.html_pages is not None:
+            # Start a new page when needed
+            suite = None
+            signal = STARTRUN.match(data["msg"])
+            if signal:
+                suite = PATTERN.sub("", signal.group(1))
+            self.html_file = self.html_pages.page(self.lineno, suite)
 
-                self.html_file.write(f"""<span id="L{self.lineno}">""")
-                self.html_file.write(
-                    f"""<span class="timestamp">{data['dt']}</span> """
-                )
-                if kernel_level:
-                    cls = self.kernel_log_levels[kernel_level.group(1)]
-                    self.html_file.write(
-                        f"""<span class="{cls}">{html.escape(data["msg"])}</span>"""
-                    )
-                else:
-                    ns = ""
-                    if data["lvl"] == "feedback" and "ns" in data:
-                        ns = f"<span class=\"feedback\">{html.escape('<' + data['ns'] + '> ')}</span>"
-                    self.html_file.write(ns + html.escape(data["msg"]))
-                self.html_file.write("</span>\n")
-                self.lineno += 1
+        if self.html_file is not None:
+            # Build the html output
+            kernel_level = self.kernel_level_pattern.match(data["msg"])
+            if kernel_level:
+                cls = self.kernel_log_levels[kernel_level.group(1)]
+                msg = f"""<span class="{cls}">{html.escape(data["msg"])}</span>"""
+            else:
+                ns = ""
+                if data["lvl"] == "feedback" and "ns" in data:
+                    ns = f"<span class=\"feedback\">{html.escape('<' + data['ns'] + '> ')}</span>"
+                msg = ns + html.escape(data["msg"])
+                if data["lvl"] == "collapsed":
+                    msg = f'<span class="warn">{msg}</span>'
+            self.html_file.write(
+                f"""<span id="L{self.lineno}"><span class="timestamp">{data['dt']}</span> {msg}</span>\n"""
+            )
+            self.lineno += 1